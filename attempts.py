@@ -0,0 +1,122 @@
+"""Background processing of challenge attempts
+
+When ASYNC_ATTEMPTS is on, /complete/<id> saves the upload, adds a row to the
+attempts table and returns straight away. An AttemptQueue worker pool then runs
+the Vision analysis and scoring off the request path. The table is the queue,
+so anything still queued (or stuck processing) when a worker dies is picked up
+again by recover(), which runs on start and then at most every recover_every
+as attempts are enqueued and processed.
+"""
+
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import has_app_context
+from model import Attempt, db
+
+# Statuses that mean a worker is done with the attempt
+FINISHED_STATUSES = ('scored', 'unsafe', 'unreadable', 'failed')
+
+
+class AttemptQueue(object):
+    """Thread pool that processes rows of the attempts table.
+
+    handler is called inside an app context with the claimed Attempt and
+    returns a dict of columns to store on it (status, points_earned, hits).
+    """
+
+    def __init__(self, app, handler, workers=4, stale_after=timedelta(minutes=10),
+                    recover_every=timedelta(minutes=1)):
+        self.app = app
+        self.handler = handler
+        self.workers = workers
+        self.stale_after = stale_after
+        self.recover_every = recover_every
+        self._executor = None
+        self._last_recovery = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the pool and resubmits unfinished attempts"""
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._last_recovery = datetime.now()
+        for attempt_id in self.recover():
+            self._executor.submit(self._run, attempt_id)
+
+    def recover_if_due(self):
+        """Runs recover() again if recover_every has passed since the last
+        time, resubmitting what it finds. Attempts already submitted are
+        skipped by _claim."""
+        with self._lock:
+            executor = self._executor
+            if executor is None or datetime.now() - self._last_recovery < self.recover_every:
+                return
+            self._last_recovery = datetime.now()
+        for attempt_id in self.recover():
+            executor.submit(self._run, attempt_id)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=wait)
+
+    def recover(self):
+        """Requeues attempts whose worker went away and returns the ids of
+        every queued attempt. Uses the caller's app context when there is
+        one: popping a context of our own would remove the session of the
+        request that is enqueueing, detaching the attempt it just added."""
+        if not has_app_context():
+            with self.app.app_context():
+                return self.recover()
+        stale = datetime.now() - self.stale_after
+        Attempt.query.filter((Attempt.status=='processing')&(Attempt.updated_timestamp < stale)).update(
+            {'status': 'queued', 'updated_timestamp': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+        queued = db.session.query(Attempt.id).filter(Attempt.status=='queued').order_by(Attempt.id).all()
+        return [attempt_id for (attempt_id,) in queued]
+
+    def enqueue(self, user_id, challenge_id, image_path):
+        """Stores a new attempt and hands it to the pool. Returns the Attempt."""
+        now = datetime.now()
+        attempt = Attempt(user_id=user_id, challenge_id=challenge_id,
+                            image_path=image_path, status='queued',
+                            created_timestamp=now, updated_timestamp=now)
+        db.session.add(attempt)
+        db.session.commit()
+        self.start()
+        self._executor.submit(self._run, attempt.id)
+        self.recover_if_due()
+        return attempt
+
+    def _claim(self, attempt_id):
+        """Moves the attempt from queued to processing. Only one worker (in any
+        process) can win this update."""
+        claimed = Attempt.query.filter((Attempt.id==attempt_id)&(Attempt.status=='queued')).update(
+            {'status': 'processing', 'updated_timestamp': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+        return claimed == 1
+
+    def _run(self, attempt_id):
+        with self.app.app_context():
+            try:
+                if not self._claim(attempt_id):
+                    return
+                attempt = Attempt.query.get(attempt_id)
+                try:
+                    result = self.handler(attempt)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Attempt %s failed', attempt_id)
+                    result = {'status': 'failed'}
+                attempt = Attempt.query.get(attempt_id)
+                for column, value in result.items():
+                    setattr(attempt, column, value)
+                attempt.updated_timestamp = datetime.now()
+                db.session.commit()
+                self.recover_if_due()
+            finally:
+                db.session.remove()
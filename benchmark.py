@@ -0,0 +1,320 @@
+"""End to end HTTP benchmark for nerve
+
+Seeds a local database at one or more sizes (see seed.py), serves server.app
+over HTTP from a background thread with the Vision API replaced by
+vision.LocalVisionBackend, then has a pool of logged in clients drive a mix of
+traffic for a fixed time: browsing the listing, opening challenges along with
+the JSON calls their pages make, profiles, accepting, completing with an
+upload and logging in. Challenges are picked with the same skew as the seeded
+data, so popular challenges get most of the traffic.
+
+Throughput and p50/p95/p99 latency are reported per route and written to a
+JSON file. Given --baseline (an earlier results file) every route is compared
+against it and the exit status is 1 if any got slower or dropped throughput by
+more than --threshold.
+
+# createdb nerve_bench_small
+# python benchmark.py --sizes small --output bench.json
+# python benchmark.py --sizes small --baseline bench.json
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from io import BytesIO
+import requests
+from PIL import Image
+from werkzeug.serving import make_server
+import seed
+import server
+import vision
+from model import User, connect_to_db, db
+from migrations import stamp
+from storage import ImageStore
+
+# seed.py arguments for each dataset size
+SIZES = {
+    'small': ['--users', '1000', '--challenges', '100', '--categories', '100',
+                '--user-challenges', '10000'],
+    'medium': ['--users', '20000', '--challenges', '2000', '--categories', '1000',
+                '--user-challenges', '200000'],
+    'large': ['--users', '200000', '--challenges', '20000', '--categories', '5000',
+                '--user-challenges', '2000000'],
+}
+
+# Relative weight of each scenario in the traffic mix
+MIX = [('listing', 30), ('challenge', 35), ('profile', 15), ('accept', 10),
+        ('complete', 5), ('login', 5)]
+
+UPLOAD_SIZE = (800, 600)
+MORE_LINK = re.compile(r'href="/challenges\?cursor=([^"]+)"')
+
+
+class Recorder(object):
+    """Collects (route, seconds, status) from every client thread"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.recording = False
+        self._lock = threading.Lock()
+
+    def record(self, route, elapsed, status):
+        if not self.recording:
+            return
+        with self._lock:
+            self.samples[route].append(elapsed)
+            if status >= 500:
+                self.errors[route] += 1
+
+    def record_error(self, route):
+        """A request or scenario that raised instead of getting a response"""
+        if not self.recording:
+            return
+        with self._lock:
+            self.errors[route] += 1
+
+
+class Client(object):
+    """One simulated user with their own cookie session"""
+
+    def __init__(self, base_url, recorder, rng, dataset):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.rng = rng
+        self.dataset = dataset
+        self.http = requests.Session()
+        self.popularity = seed.SkewedChoice(dataset.challenges, dataset.skew)
+
+    def request(self, route, method, path, **kwargs):
+        start = time.time()
+        try:
+            response = self.http.request(method, self.base_url + path, allow_redirects=False, **kwargs)
+        except requests.RequestException:
+            self.recorder.record_error(route)
+            raise
+        self.recorder.record(route, time.time() - start, response.status_code)
+        return response
+
+    def pick_challenge(self):
+        return self.popularity.pick(self.rng) + 1
+
+    def pick_user(self):
+        return self.rng.randint(1, self.dataset.users)
+
+    def login(self):
+        self.request('POST /login', 'POST', '/login',
+                        data={'username': 'user{}'.format(self.pick_user()), 'password': seed.SEED_PASSWORD})
+
+    def listing(self):
+        page = self.request('GET /challenges', 'GET', '/challenges')
+        more = MORE_LINK.search(page.text)
+        if more:
+            self.request('GET /challenges?partial', 'GET', '/challenges',
+                            params={'cursor': more.group(1), 'partial': 1})
+
+    def challenge(self):
+        challenge_id = self.pick_challenge()
+        self.request('GET /challenge/<id>', 'GET', '/challenge/{}'.format(challenge_id))
+        self.request('GET /challenge-page.json', 'GET', '/challenge-page.json',
+                        params={'challenge_id': challenge_id})
+        self.request('GET /leaderboard.json', 'GET', '/leaderboard.json',
+                        params={'challenge_id': challenge_id, 'limit': 20})
+
+    def profile(self):
+        self.request('GET /profile/<username>', 'GET', '/profile/user{}'.format(self.pick_user()))
+
+    def accept(self):
+        self.request('POST /accept.json', 'POST', '/accept.json',
+                        data={'challenge_id': self.pick_challenge()})
+
+    def complete(self):
+        challenge_id = self.pick_challenge()
+        self.http.post(self.base_url + '/accept.json', data={'challenge_id': challenge_id})
+        # A random colour makes every upload, and so its analysis copy, new
+        # to the vision cache
+        image = Image.new('RGB', UPLOAD_SIZE, tuple(self.rng.randint(0, 255) for _ in range(3)))
+        output = BytesIO()
+        image.save(output, 'PNG')
+        content = output.getvalue()
+        name = 'bench-{}.png'.format(threading.current_thread().ident)
+        self.request('POST /complete/<id>', 'POST', '/complete/{}'.format(challenge_id),
+                        files={'file': (name, content, 'image/png')})
+
+    def attempt(self, scenario):
+        """Runs one scenario. An exception counts as an error instead of
+        ending the client."""
+        try:
+            getattr(self, scenario)()
+        except requests.RequestException:
+            pass # request() has recorded it against the route
+        except Exception:
+            self.recorder.record_error('scenario ' + scenario)
+
+    def run(self, deadline):
+        scenarios = [name for name, weight in MIX for _ in xrange(weight)]
+        self.attempt('login')
+        while time.time() < deadline:
+            self.attempt(self.rng.choice(scenarios))
+
+
+def percentile(ordered, p):
+    """Nearest rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)]
+
+
+def summarize(recorder, duration):
+    """{route: {count, errors, rps, p50_ms, p95_ms, p99_ms}}, the
+    percentiles are None for routes that only ever failed"""
+    routes = {}
+    for route in set(recorder.samples) | set(recorder.errors):
+        ordered = sorted(recorder.samples.get(route, []))
+        routes[route] = {'count': len(ordered),
+                        'errors': recorder.errors.get(route, 0),
+                        'rps': round(len(ordered) / duration, 2)}
+        for p in (50, 95, 99):
+            value = percentile(ordered, p)
+            routes[route]['p{}_ms'.format(p)] = round(value * 1000, 2) if value is not None else None
+    return routes
+
+
+def prepare_database(size, args):
+    """Points the app at the database for size, seeding it if empty or
+    --reseed was given. Returns the seed.py arguments used."""
+    seed_args = seed.parse_args(SIZES[size] + ['--seed', str(args.seed)])
+    database = args.database.format(size=size)
+    connect_to_db(server.app, database)
+    if (args.reseed or not db.engine.has_table(User.__tablename__) or
+            not db.session.query(User.id).first()):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        stamp()
+        print "Seeding {}".format(database)
+        seed.seed(seed_args)
+    db.session.remove()
+    server.challenge_tags_cache.clear()
+    server.challenge_graph.invalidate()
+    server.leaderboards.invalidate()
+    return seed_args
+
+
+def run_size(size, args):
+    dataset = prepare_database(size, args)
+    # Uploads go to a throwaway store, each one is a new image, and the
+    # offline backend's made up analyses to a throwaway Vision cache
+    real_store, real_cache = server.image_store, vision.result_cache
+    server.image_store = ImageStore(tempfile.mkdtemp(), '/static/images')
+    vision.result_cache = vision.VisionResultCache(tempfile.mkdtemp(), vision.VISION_CACHE_SIZE)
+    try:
+        return drive_traffic(dataset, args)
+    finally:
+        shutil.rmtree(server.image_store.root)
+        shutil.rmtree(vision.result_cache.directory)
+        server.image_store, vision.result_cache = real_store, real_cache
+
+
+def drive_traffic(dataset, args):
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    base_url = 'http://127.0.0.1:{}'.format(httpd.socket.getsockname()[1])
+    serving = threading.Thread(target=httpd.serve_forever)
+    serving.daemon = True
+    serving.start()
+
+    recorder = Recorder()
+    started = time.time()
+    recording_from = started + args.warmup
+    deadline = recording_from + args.duration
+    threads = []
+    for i in xrange(args.concurrency):
+        client = Client(base_url, recorder, random.Random(args.seed * 1000 + i), dataset)
+        thread = threading.Thread(target=client.run, args=(deadline,))
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+    time.sleep(max(recording_from - time.time(), 0))
+    recorder.recording = True
+    for thread in threads:
+        thread.join()
+    recorder.recording = False
+    httpd.shutdown()
+    return summarize(recorder, args.duration)
+
+
+def compare(results, baseline, threshold):
+    """Prints every route against the baseline, returns the regressions as
+    [(size, route, what)]"""
+    regressions = []
+    print "{:<8} {:<28} {:>8} {:>9} {:>9} {:>9} {:>9}".format('size', 'route', 'rps', 'p50 ms', 'p95 ms',
+                                                            'p99 ms', 'p95 diff')
+    for size, routes in sorted(results.items()):
+        for route, stats in sorted(routes.items()):
+            before = baseline.get(size, {}).get(route) if baseline else None
+            change = ''
+            if before and stats['p95_ms'] is not None and before['p95_ms'] is not None:
+                p95_change = (stats['p95_ms'] - before['p95_ms']) / max(before['p95_ms'], 0.01)
+                change = '{:+.0%}'.format(p95_change)
+                if p95_change > threshold:
+                    regressions.append((size, route, 'p95 {} -> {} ms'.format(before['p95_ms'], stats['p95_ms'])))
+            if before:
+                if stats['rps'] < before['rps'] * (1 - threshold):
+                    regressions.append((size, route, 'rps {} -> {}'.format(before['rps'], stats['rps'])))
+            print "{:<8} {:<28} {:>8} {:>9} {:>9} {:>9} {:>9}".format(size, route, stats['rps'], stats['p50_ms'],
+                                                                    stats['p95_ms'], stats['p99_ms'], change)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the nerve server over HTTP')
+    parser.add_argument('--database', default='postgres:///nerve_bench_{size}',
+                        help='database URI, {size} is replaced by the dataset size')
+    parser.add_argument('--sizes', default='small', help='comma separated, from {}'.format(', '.join(sorted(SIZES))))
+    parser.add_argument('--reseed', action='store_true', help='reseed even if the database has data')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=8, help='simultaneous clients')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of traffic before recording')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of recorded traffic per size')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed fractional slowdown before a route counts as a regression')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    vision.set_backend(vision.LocalVisionBackend())
+    server.app.config['ASYNC_ATTEMPTS'] = False
+
+    results = {}
+    for size in args.sizes.split(','):
+        print "Benchmarking {} for {}s with {} clients".format(size, args.duration, args.concurrency)
+        results[size] = run_size(size, args)
+
+    with open(args.output, 'w') as output:
+        json.dump({'created': datetime.now().isoformat(), 'config': vars(args), 'results': results},
+                    output, indent=2, sort_keys=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as stored:
+            baseline = json.load(stored)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for size, routes in sorted(results.items()):
+        for route, stats in sorted(routes.items()):
+            if stats['errors']:
+                print "ERRORS {} {}: {}".format(size, route, stats['errors'])
+    for size, route, what in regressions:
+        print "REGRESSION {} {}: {}".format(size, route, what)
+    raise SystemExit(1 if regressions else 0)
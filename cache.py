@@ -0,0 +1,67 @@
+"""Small in-process caching helpers for nerve
+
+LRUCache is a bounded, thread-safe mapping that evicts the least recently used
+entry once maxsize is reached. It keeps hit/miss counters so callers can expose
+how well the cache is doing.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded least-recently-used cache with hit/miss counters"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key (marking it as recently used) or
+        default if the key is not cached."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores value under key, evicting the oldest entry if full"""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes key from the cache and returns its value"""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """Empties the cache, counters are left alone"""
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        """Returns a dict of counters describing the cache"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._data),
+                    'maxsize': self.maxsize}
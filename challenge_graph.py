@@ -0,0 +1,113 @@
+"""Challenge similarity graph for the analytics page
+
+Two challenges are linked when they share tags, the weight of the link is the
+number of tags they share. The graph is built with one aggregate query, kept
+in process and updated incrementally as categories are posted for a challenge.
+Each worker reloads it every refresh_after seconds to pick up challenges other
+workers created.
+"""
+
+import threading
+import time
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from model import Challenge, ChallengeCategory, db
+
+
+class ChallengeGraph(object):
+    """Weighted challenge - challenge graph backed by an inverted index of
+    category id -> challenge ids.
+
+    max_edges_per_node caps the payload: an edge is kept only if it is one of
+    the heaviest max_edges_per_node edges of either of its challenges.
+    """
+
+    def __init__(self, max_edges_per_node=None, refresh_after=300):
+        self.max_edges_per_node = max_edges_per_node
+        self.refresh_after = refresh_after
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.titles = {}            # challenge id -> title
+        self.challenges_by_category = {}    # category id -> set of challenge ids
+        self.categories_by_challenge = {}   # challenge id -> set of category ids
+        self.weights = {}           # (lower id, higher id) -> shared tag count
+        self.loaded_at = None
+        self._d3 = None
+
+    def invalidate(self):
+        """Drops the graph, it is rebuilt on the next read"""
+        with self._lock:
+            self._reset()
+
+    def load(self):
+        """Rebuilds the graph from the database"""
+        with self._lock:
+            self._reset()
+            self.titles = dict(db.session.query(Challenge.id, Challenge.title).all())
+            links = db.session.query(ChallengeCategory.category_id, ChallengeCategory.challenge_id).all()
+            for category_id, challenge_id in links:
+                self.challenges_by_category.setdefault(category_id, set()).add(challenge_id)
+                self.categories_by_challenge.setdefault(challenge_id, set()).add(category_id)
+
+            first = aliased(ChallengeCategory)
+            second = aliased(ChallengeCategory)
+            shared = db.session.query(first.challenge_id, second.challenge_id, func.count()).join(
+                                    second, (first.category_id==second.category_id)&
+                                            (first.challenge_id < second.challenge_id)).group_by(
+                                    first.challenge_id, second.challenge_id)
+            for source, target, weight in shared.all():
+                self.weights[(source, target)] = weight
+            self.loaded_at = time.time()
+
+    def _ensure_loaded(self):
+        if self.loaded_at is None or time.time() - self.loaded_at > self.refresh_after:
+            self.load()
+
+    def add_categories(self, challenge_id, category_ids, title=None):
+        """Links a challenge to categories, adjusting weights of the edges to
+        every challenge already in those categories"""
+        with self._lock:
+            if self.loaded_at is None:
+                return # the first load will see them
+            if challenge_id not in self.titles:
+                self.titles[challenge_id] = title or db.session.query(Challenge.title).filter(
+                                                            Challenge.id==challenge_id).scalar()
+            linked = self.categories_by_challenge.setdefault(challenge_id, set())
+            for category_id in set(category_ids).difference(linked):
+                neighbours = self.challenges_by_category.setdefault(category_id, set())
+                for other_id in neighbours:
+                    edge = (min(challenge_id, other_id), max(challenge_id, other_id))
+                    self.weights[edge] = self.weights.get(edge, 0) + 1
+                neighbours.add(challenge_id)
+                linked.add(category_id)
+            self._d3 = None
+
+    def edges(self):
+        """Returns [(source, target, weight)], heaviest first, applying
+        max_edges_per_node"""
+        ordered = sorted(self.weights.items(), key=lambda item: (-item[1], item[0]))
+        if not self.max_edges_per_node:
+            return [(source, target, weight) for (source, target), weight in ordered]
+        degree = {}
+        kept = []
+        for (source, target), weight in ordered:
+            if (degree.get(source, 0) < self.max_edges_per_node or
+                degree.get(target, 0) < self.max_edges_per_node):
+                kept.append((source, target, weight))
+                degree[source] = degree.get(source, 0) + 1
+                degree[target] = degree.get(target, 0) + 1
+        return kept
+
+    def to_d3(self):
+        """Nodes and links in the shape the analytics page's d3 graph uses"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._d3 is None:
+                nodes = [{'id': challenge_id, 'title': title, 'group': i + 1}
+                            for i, (challenge_id, title) in enumerate(sorted(self.titles.items()))]
+                links = [{'source': source, 'target': target, 'value': weight}
+                            for source, target, weight in self.edges()]
+                self._d3 = {'nodes': nodes, 'links': links}
+            return self._d3
@@ -0,0 +1,275 @@
+"""Bulk challenge import for nerve
+
+Creates challenges from a directory of images and a CSV manifest with the
+columns filename, title, description and difficulty, without going through
+/create one image at a time. Each image is preprocessed (see preprocess.py)
+and its analysis copy is sent to Vision in annotate requests of up to
+VISION_BATCH_SIZE images with at most --max-in-flight requests outstanding.
+Safe images are then put in the image store (see storage.py) and their
+challenges, new categories and challenge/category links are written with a
+few multi-row inserts per chunk of challenges, one transaction per chunk.
+
+Every image that has been dealt with is appended to a progress file once its
+chunk is committed, so an interrupted import picks up where it stopped when
+run again with the same arguments. Images Vision couldn't analyze (an outage
+or network error) are counted as failed and left out of the progress file,
+so the next run tries them again.
+
+# python import_challenges.py path/to/images
+# python import_challenges.py path/to/images --manifest spring.csv --max-in-flight 8
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import renditions
+import vision
+from preprocess import UploadRejected, prepare_file
+from storage import ImageStore
+from model import Challenge, ChallengeCategory, connect_to_db, db, get_category_ids, insert_ignoring_duplicates
+from server import ALLOWED_EXTENSIONS, UPLOAD_FOLDER, app
+
+MAX_TITLE_LENGTH = Challenge.__table__.c.title.type.length
+MIN_DIFFICULTY, MAX_DIFFICULTY = 1, 5
+
+# Analysis of an image that can't be read or stored, as opposed to None for
+# one Vision failed to analyze
+UNREADABLE = vision.ImageAnalysis(safe=False, tags=[], key=None)
+
+
+class ImportStats(object):
+    """Counts for the throughput report"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.imported = 0
+        self.unsafe = 0
+        self.unreadable = 0
+        self.failed = 0
+        self.invalid = 0
+        self.resumed = 0
+        self.batches = 0
+        self.vision_seconds = 0.0
+        self.db_seconds = 0.0
+
+    @property
+    def processed(self):
+        return self.imported + self.unsafe + self.unreadable + self.failed + self.invalid
+
+    def report(self):
+        elapsed = time.time() - self.started
+        return ('{processed} images in {elapsed:.1f}s ({rate:.1f} images/s): {imported} imported, '
+                '{unsafe} unsafe, {unreadable} unreadable, {failed} failed (retried next run), '
+                '{invalid} invalid, {resumed} already done. '
+                '{batches} Vision batches ({vision:.1f}s), {db:.1f}s writing to the database').format(
+                    processed=self.processed, elapsed=elapsed, rate=self.processed / max(elapsed, 1e-6),
+                    imported=self.imported, unsafe=self.unsafe, unreadable=self.unreadable,
+                    failed=self.failed, invalid=self.invalid, resumed=self.resumed, batches=self.batches,
+                    vision=self.vision_seconds, db=self.db_seconds)
+
+
+def read_manifest(path):
+    """Yields a dict per row of the CSV manifest"""
+    with open(path, 'rb') as manifest:
+        for row in csv.DictReader(manifest):
+            yield dict((key, (value or '').decode('utf-8').strip()) for key, value in row.items() if key)
+
+
+def read_progress(path):
+    """Filenames already dealt with by an earlier run"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as progress:
+        return set(line.decode('utf-8').rstrip('\n').split('\t')[0] for line in progress if line.strip())
+
+
+def parse_difficulty(value):
+    """Manifest difficulty as an int, MIN_DIFFICULTY when blank, None when
+    it isn't a whole number in range"""
+    if not value:
+        return MIN_DIFFICULTY
+    try:
+        difficulty = int(value)
+    except ValueError:
+        return None
+    return difficulty if MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY else None
+
+
+def valid_row(row):
+    filename = row.get('filename', '')
+    return bool('.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS and
+                row.get('title') and row.get('description') and
+                parse_difficulty(row.get('difficulty')) is not None)
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def analyze_batch(directory, batch, max_tags, store):
+    """Runs in a worker thread: preprocesses the batch's images and sends
+    their analysis copies in one annotate request, then stores the safe ones
+    along with their renditions. Returns (analyses, image keys, seconds), keys
+    being None for images that weren't stored. Images that can't be read or
+    stored get UNREADABLE, ones Vision failed on get None."""
+    start = time.time()
+    uploads = []
+    for row in batch:
+        try:
+            uploads.append(prepare_file(os.path.join(directory, row['filename'])))
+        except (IOError, OSError, UploadRejected):
+            uploads.append(None)
+    readable = [upload.analysis_content for upload in uploads if upload is not None]
+    results = iter(vision.analyze_contents(readable, max_tags))
+    analyses = [next(results) if upload is not None else UNREADABLE for upload in uploads]
+    keys = []
+    for i, (upload, analysis) in enumerate(zip(uploads, analyses)):
+        key = None
+        if analysis and analysis.safe and analysis.tags:
+            try:
+                key = store.put(upload.content, upload.format)
+                renditions.generate(store, key)
+            except Exception:
+                analyses[i], key = UNREADABLE, None
+        keys.append(key)
+    return analyses, keys, time.time() - start
+
+
+def allocate_challenge_ids(count):
+    """Takes count ids from the challenges sequence so the rows can be
+    inserted with one statement and linked to their categories straight away"""
+    rows = db.session.execute(db.text("SELECT nextval(pg_get_serial_sequence('challenges', 'id')) "
+                                        "FROM generate_series(1, :count)"), {'count': count}).fetchall()
+    return [challenge_id for (challenge_id,) in rows]
+
+
+def write_chunk(pending):
+    """Inserts the challenges, categories and links for one chunk of analyzed
+    rows in one transaction"""
+    challenge_ids = allocate_challenge_ids(len(pending))
+    challenges = []
+    links = []
+    category_ids = get_category_ids(set(tag for row, analysis, key in pending for tag in analysis.tags))
+    for challenge_id, (row, analysis, key) in zip(challenge_ids, pending):
+        challenges.append({'id': challenge_id,
+                            'title': row['title'].title()[:MAX_TITLE_LENGTH],
+                            'description': row['description'],
+                            'difficulty': parse_difficulty(row.get('difficulty')),
+                            'image_path': key,
+                            'num_accepted': 0, 'num_completed': 0, 'num_attempts': 0})
+        links.extend({'challenge_id': challenge_id, 'category_id': category_ids[tag]}
+                        for tag in set(analysis.tags))
+    db.session.execute(Challenge.__table__.insert().values(challenges))
+    insert_ignoring_duplicates(ChallengeCategory, links)
+    db.session.commit()
+
+
+def record_progress(progress, done):
+    """Appends (filename, status) pairs once they are committed"""
+    for filename, status in done:
+        progress.write('{}\t{}\n'.format(filename.encode('utf-8'), status))
+    progress.flush()
+    os.fsync(progress.fileno())
+
+
+def import_challenges(args, out=sys.stdout):
+    stats = ImportStats()
+    store = ImageStore(args.upload_folder, '/static/images')
+    done_before = read_progress(args.progress)
+    pending = [] # (row, analysis, image key) waiting to be written
+    done = []    # (filename, status) waiting for the chunk to commit
+    rows = []
+    for row in read_manifest(args.manifest):
+        if row.get('filename') in done_before:
+            stats.resumed += 1
+        elif not valid_row(row):
+            stats.invalid += 1
+            done.append((row.get('filename', ''), 'invalid'))
+        else:
+            rows.append(row)
+    in_flight = deque()
+
+    def flush(progress):
+        if pending:
+            start = time.time()
+            write_chunk(pending)
+            stats.db_seconds += time.time() - start
+            stats.imported += len(pending)
+            del pending[:]
+        record_progress(progress, done)
+        del done[:]
+        out.write(stats.report() + '\n')
+
+    def collect(batch, future, progress):
+        analyses, keys, seconds = future.result()
+        stats.batches += 1
+        stats.vision_seconds += seconds
+        for row, analysis, key in zip(batch, analyses, keys):
+            if analysis is None:
+                stats.failed += 1 # not in done, so the next run retries it
+            elif not analysis.tags:
+                stats.unreadable += 1
+                done.append((row['filename'], 'unreadable'))
+            elif not analysis.safe:
+                stats.unsafe += 1
+                done.append((row['filename'], 'unsafe'))
+            else:
+                pending.append((row, analysis, key))
+                done.append((row['filename'], 'imported'))
+        if len(pending) >= args.chunk_size:
+            flush(progress)
+
+    with open(args.progress, 'a') as progress:
+        executor = ThreadPoolExecutor(max_workers=args.max_in_flight)
+        try:
+            for batch in batches(rows, args.batch_size):
+                future = executor.submit(analyze_batch, args.directory, batch, args.max_tags, store)
+                in_flight.append((batch, future))
+                if len(in_flight) >= args.max_in_flight:
+                    collect(*in_flight.popleft() + (progress,))
+            while in_flight:
+                collect(*in_flight.popleft() + (progress,))
+            flush(progress)
+        finally:
+            executor.shutdown(wait=True)
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Import challenges from a directory of images')
+    parser.add_argument('directory', help='directory holding the images')
+    parser.add_argument('--manifest', help='CSV with filename,title,description,difficulty '
+                                            '(default: DIRECTORY/manifest.csv)')
+    parser.add_argument('--progress', help='progress file (default: DIRECTORY/.import_progress)')
+    parser.add_argument('--database', default='postgres:///nerve', help='SQLAlchemy database URI')
+    parser.add_argument('--upload-folder', default=UPLOAD_FOLDER)
+    parser.add_argument('--batch-size', type=int, default=vision.VISION_BATCH_SIZE,
+                        help='images per annotate request (at most {})'.format(vision.VISION_BATCH_SIZE))
+    parser.add_argument('--max-in-flight', type=int, default=4, help='annotate requests outstanding at once')
+    parser.add_argument('--chunk-size', type=int, default=256, help='challenges per transaction')
+    parser.add_argument('--max-tags', type=int, default=10)
+    args = parser.parse_args(argv)
+    args.manifest = args.manifest or os.path.join(args.directory, 'manifest.csv')
+    args.progress = args.progress or os.path.join(args.directory, '.import_progress')
+    args.batch_size = max(1, min(args.batch_size, vision.VISION_BATCH_SIZE))
+    return args
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    connect_to_db(app, args.database)
+    with app.app_context():
+        stats = import_challenges(args)
+    print "Done. " + stats.report()
@@ -0,0 +1,140 @@
+"""Leaderboards for nerve
+
+Leaderboards keeps a global ranking of users by total points and a ranking per
+challenge, in process, so rank lookups and pages of a ranking never sort the
+user_challenges table. Rankings are loaded with one grouped query the first time
+they are needed and then updated as attempts are scored. They are reloaded
+once they are older than refresh_after, so scores committed by other processes
+show up. Updates are queued on the session by queue_score and applied only
+once that session commits, so a rolled back attempt never shows up in a
+ranking.
+"""
+
+import threading
+import time
+from bisect import bisect_left, insort
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from cache import LRUCache
+from model import UserChallenge, db
+
+
+class RankedScores(object):
+    """Points per member kept sorted, highest first (ties go to the lower
+    member id). rank() is a binary search; set() is a binary search plus a
+    list insert, which is a memmove and fast for the sizes we deal with."""
+
+    def __init__(self, points=None):
+        self._points = dict(points or {})
+        self._keys = sorted((-score, member) for member, score in self._points.items())
+
+    def set(self, member, points):
+        previous = self._points.get(member)
+        if previous is not None:
+            del self._keys[bisect_left(self._keys, (-previous, member))]
+        self._points[member] = points
+        insort(self._keys, (-points, member))
+
+    def get(self, member):
+        return self._points.get(member)
+
+    def rank(self, member):
+        """1 based rank of member or None if they are not ranked"""
+        points = self._points.get(member)
+        if points is None:
+            return None
+        return bisect_left(self._keys, (-points, member)) + 1
+
+    def range(self, offset=0, limit=10):
+        """[(member, points)] for ranks offset+1 .. offset+limit"""
+        return [(member, -score) for score, member in self._keys[offset:offset + limit]]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class Leaderboards(object):
+    """The global ranking plus a bounded cache of per-challenge rankings"""
+
+    def __init__(self, max_challenges=1024, refresh_after=300):
+        self.refresh_after = refresh_after
+        self._global = None
+        self._global_loaded_at = None
+        self._challenges = LRUCache(max_challenges)
+        self._lock = threading.RLock()
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def invalidate(self):
+        """Drops every ranking, they are reloaded on the next read"""
+        with self._lock:
+            self._global = None
+            self._challenges.clear()
+
+    def _global_scores(self):
+        with self._lock:
+            if self._global is None or time.time() - self._global_loaded_at > self.refresh_after:
+                totals = db.session.query(UserChallenge.user_id, func.sum(UserChallenge.points_earned)).filter(
+                                    UserChallenge.is_completed==True).group_by(UserChallenge.user_id).all()
+                self._global = RankedScores((user_id, int(total)) for user_id, total in totals)
+                self._global_loaded_at = time.time()
+            return self._global
+
+    def _challenge_scores(self, challenge_id):
+        challenge_id = int(challenge_id)
+        with self._lock:
+            # (loaded at, RankedScores), reloaded like the global ranking so
+            # scores committed by other processes show up
+            entry = self._challenges.get(challenge_id)
+            if entry is None or time.time() - entry[0] > self.refresh_after:
+                points = db.session.query(UserChallenge.user_id, UserChallenge.points_earned).filter(
+                                    (UserChallenge.challenge_id==challenge_id)&
+                                    (UserChallenge.is_completed==True)).all()
+                entry = (time.time(), RankedScores(points))
+                self._challenges.put(challenge_id, entry)
+            return entry[1]
+
+    def queue_score(self, user_id, challenge_id, previous_points, points):
+        """Records a score change to apply when the current session commits"""
+        updates = db.session().info.setdefault('leaderboard_updates', [])
+        updates.append((int(user_id), int(challenge_id), previous_points or 0, points))
+
+    def _after_commit(self, session):
+        for update in session.info.pop('leaderboard_updates', []):
+            self.record_score(*update)
+
+    def _after_rollback(self, session):
+        session.info.pop('leaderboard_updates', None)
+
+    def record_score(self, user_id, challenge_id, previous_points, points):
+        """Applies a committed score change to the rankings already loaded"""
+        with self._lock:
+            if self._global is not None:
+                total = self._global.get(user_id) or 0
+                self._global.set(user_id, total - previous_points + points)
+            entry = self._challenges.get(challenge_id)
+            if entry is not None:
+                entry[1].set(user_id, points)
+
+    def global_rank(self, user_id):
+        """(rank, total points, number of ranked users), rank is None for
+        users who have not completed anything"""
+        scores = self._global_scores()
+        with self._lock:
+            return scores.rank(int(user_id)), scores.get(int(user_id)) or 0, len(scores)
+
+    def global_range(self, offset=0, limit=10):
+        scores = self._global_scores()
+        with self._lock:
+            return scores.range(offset, limit)
+
+    def challenge_rank(self, challenge_id, user_id):
+        """(rank, points, number of ranked users) within one challenge"""
+        scores = self._challenge_scores(challenge_id)
+        with self._lock:
+            return scores.rank(int(user_id)), scores.get(int(user_id)) or 0, len(scores)
+
+    def challenge_range(self, challenge_id, offset=0, limit=10):
+        scores = self._challenge_scores(challenge_id)
+        with self._lock:
+            return scores.range(offset, limit)
@@ -0,0 +1,234 @@
+"""Request metrics for nerve in the Prometheus text format
+
+Counters and histograms live in a process wide registry and are cheap enough
+to update on every request. RequestMetrics hooks into the Flask app to record
+each request's latency, SQL query count and time (from querycount) and upload
+size per route, and serves everything at /metrics for Prometheus to scrape.
+vision.py records the latency and payload size of every annotate call.
+
+Requests slower than METRICS_SLOW_REQUEST_SECONDS are logged as a single JSON
+line, a sample of them if METRICS_SLOW_SAMPLE_RATE is below 1.
+"""
+
+import json
+import random
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, has_request_context, request
+from querycount import request_query_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(9)) # 1KB .. 64MB
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A named family of values, one per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, key), _number(value))]
+
+
+class Histogram(Metric):
+    """Observations counted into buckets of upper bounds, plus their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [count per bucket, count above the last bucket, sum]
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                state[0][i] += 1
+            else:
+                state[1] += 1
+            state[2] += value
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) + state[1] if state else 0
+
+    def _render_value(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, in_bucket in zip(self.buckets + (float('inf'),), state[0] + [state[1]]):
+            cumulative += in_bucket
+            lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labelnames, key, [('le', _number(bound))]),
+                                                cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, key), _number(state[2])))
+        lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, key), cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram('nerve_http_request_duration_seconds',
+                                    'Time to handle a request', ['route', 'method', 'status']))
+request_queries = registry.register(Histogram('nerve_http_request_sql_queries',
+                                    'SQL queries run by a request', ['route'], QUERY_COUNT_BUCKETS))
+request_query_seconds = registry.register(Histogram('nerve_http_request_sql_duration_seconds',
+                                    'Time a request spent in SQL queries', ['route']))
+upload_bytes = registry.register(Histogram('nerve_upload_bytes',
+                                    'Size of multipart uploads', ['route'], BYTES_BUCKETS))
+slow_requests = registry.register(Counter('nerve_http_slow_requests_total',
+                                    'Requests slower than METRICS_SLOW_REQUEST_SECONDS', ['route']))
+vision_seconds = registry.register(Histogram('nerve_vision_request_duration_seconds',
+                                    'Time for a Vision annotate call', ['backend', 'outcome']))
+vision_request_bytes = registry.register(Histogram('nerve_vision_request_bytes',
+                                    'Encoded image bytes sent to Vision', ['backend'], BYTES_BUCKETS))
+vision_response_bytes = registry.register(Histogram('nerve_vision_response_bytes',
+                                    'Size of Vision annotate responses', ['backend'], BYTES_BUCKETS))
+
+
+def record_vision_call(backend, seconds, request_bytes, response_bytes=None):
+    """Records one annotate call, response_bytes is None when it failed.
+    Calls made while handling a request are added to its slow request log."""
+    vision_seconds.observe(seconds, backend=backend, outcome='ok' if response_bytes is not None else 'error')
+    vision_request_bytes.observe(request_bytes, backend=backend)
+    if response_bytes is not None:
+        vision_response_bytes.observe(response_bytes, backend=backend)
+    if has_request_context():
+        g._vision_calls = getattr(g, '_vision_calls', 0) + 1
+        g._vision_time = getattr(g, '_vision_time', 0.0) + seconds
+
+
+def route_label():
+    """The url rule rather than the path, so ids don't multiply the series"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+class RequestMetrics(object):
+    """Records per request metrics for an app and serves /metrics"""
+
+    def __init__(self, app=None, registry=registry):
+        self.registry = registry
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('METRICS_SLOW_REQUEST_SECONDS', 1.0)
+        app.config.setdefault('METRICS_SLOW_SAMPLE_RATE', 1.0)
+        app.before_request(self._start_request)
+        app.after_request(self._record_request)
+        app.add_url_rule('/metrics', 'metrics', self.expose)
+
+    def expose(self):
+        return Response(self.registry.render(), mimetype=CONTENT_TYPE)
+
+    def _start_request(self):
+        g._request_start = time.time()
+        if request.mimetype == 'multipart/form-data' and request.content_length:
+            upload_bytes.observe(request.content_length, route=route_label())
+
+    def _record_request(self, response):
+        start = getattr(g, '_request_start', None)
+        if start is None:
+            return response
+        elapsed = time.time() - start
+        route = route_label()
+        count, query_time = request_query_stats()
+        request_seconds.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        request_queries.observe(count, route=route)
+        request_query_seconds.observe(query_time, route=route)
+        if elapsed >= self.app.config['METRICS_SLOW_REQUEST_SECONDS']:
+            slow_requests.inc(route=route)
+            if random.random() < self.app.config['METRICS_SLOW_SAMPLE_RATE']:
+                self.app.logger.warning(json.dumps({'event': 'slow_request',
+                                                    'method': request.method,
+                                                    'path': request.path,
+                                                    'route': route,
+                                                    'status': response.status_code,
+                                                    'duration_ms': round(elapsed * 1000, 1),
+                                                    'sql_queries': count,
+                                                    'sql_ms': round(query_time * 1000, 1),
+                                                    'vision_calls': getattr(g, '_vision_calls', 0),
+                                                    'vision_ms': round(getattr(g, '_vision_time', 0.0) * 1000, 1)},
+                                                    sort_keys=True))
+        return response
@@ -0,0 +1,129 @@
+"""Versioned schema migrations for nerve
+
+model.py can only create_all, which never changes a table that already exists.
+Each migration here is a version number and the statements that take the
+schema from the previous version to it. The version a database is at lives in
+the schema_version table, and migrate() applies whatever is missing, each
+migration in its own transaction.
+
+A database with no schema_version table is taken to be at version 1, the
+schema before migrations existed. Databases made by `python model.py` are
+stamped with the latest version since create_all already builds everything.
+
+# python migrations.py              migrates to the latest version
+# python migrations.py --to 3        migrates to version 3
+# python migrations.py stamp 5       records version 5 without running anything
+# python migrations.py status        prints the current version
+"""
+
+from model import RECONCILE_COUNTERS_SQL, db
+
+# (version, description, statements)
+MIGRATIONS = [
+    (1, 'Initial schema', []),
+
+    (2, 'Participation counters on challenges', [
+        'ALTER TABLE challenges ADD COLUMN num_accepted INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE challenges ADD COLUMN num_completed INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE challenges ADD COLUMN num_attempts INTEGER NOT NULL DEFAULT 0',
+        RECONCILE_COUNTERS_SQL,
+    ]),
+
+    (3, 'Attempts queue', [
+        """CREATE TABLE attempts (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            challenge_id INTEGER NOT NULL REFERENCES challenges (id),
+            image_path VARCHAR(50) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            points_earned INTEGER,
+            hits TEXT,
+            created_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            updated_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        )""",
+        'CREATE INDEX attempts_status_idx ON attempts (status, updated_timestamp)',
+    ]),
+
+    (4, 'Keyset pagination indexes', [
+        'CREATE INDEX challenges_listing_idx ON challenges (difficulty, id)',
+        'CREATE INDEX user_challenges_history_idx ON user_challenges (user_id, accepted_timestamp, id)',
+    ]),
+
+    (5, 'Indexes for leaderboards, the analytics graph and title lookups', [
+        """CREATE INDEX user_challenges_leaderboard_idx ON user_challenges
+            (challenge_id, points_earned, user_id) WHERE is_completed""",
+        'CREATE INDEX challenge_categories_category_idx ON challenge_categories (category_id, challenge_id)',
+        'CREATE INDEX challenges_title_idx ON challenges (title)',
+    ]),
+
+    (6, 'Room in image_path for content addressed storage keys', [
+        'ALTER TABLE challenges ALTER COLUMN image_path TYPE VARCHAR(100)',
+        'ALTER TABLE user_challenges ALTER COLUMN image_path TYPE VARCHAR(100)',
+        'ALTER TABLE attempts ALTER COLUMN image_path TYPE VARCHAR(100)',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def ensure_version_table(connection):
+    connection.execute(db.text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+
+
+def current_version(engine=None):
+    """Version the database is at, 1 if it was never migrated or stamped"""
+    with (engine or db.engine).begin() as connection:
+        ensure_version_table(connection)
+        version = connection.execute(db.text('SELECT max(version) FROM schema_version')).scalar()
+    return version or 1
+
+
+def stamp(version=LATEST_VERSION, engine=None):
+    """Records the database as being at version without running anything"""
+    with (engine or db.engine).begin() as connection:
+        ensure_version_table(connection)
+        connection.execute(db.text('DELETE FROM schema_version'))
+        connection.execute(db.text('INSERT INTO schema_version (version) VALUES (:version)'),
+                            version=version)
+
+
+def migrate(target=LATEST_VERSION, engine=None):
+    """Applies the migrations after the current version up to target.
+    Returns the list of versions applied."""
+    engine = engine or db.engine
+    applied = []
+    start = current_version(engine)
+    for version, description, statements in MIGRATIONS:
+        if start < version <= target:
+            with engine.begin() as connection:
+                for statement in statements:
+                    connection.execute(db.text(statement))
+                connection.execute(db.text('DELETE FROM schema_version'))
+                connection.execute(db.text('INSERT INTO schema_version (version) VALUES (:version)'),
+                                    version=version)
+            applied.append(version)
+    return applied
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from model import init_app
+
+    parser = argparse.ArgumentParser(description='Migrate the nerve database')
+    parser.add_argument('command', nargs='?', default='migrate', choices=['migrate', 'stamp', 'status'])
+    parser.add_argument('version', nargs='?', type=int, default=LATEST_VERSION,
+                        help='version to stamp')
+    parser.add_argument('--to', type=int, default=LATEST_VERSION, help='version to migrate to')
+    args = parser.parse_args()
+
+    init_app()
+    if args.command == 'migrate':
+        for version in migrate(args.to):
+            print "Applied migration {}.".format(version)
+        print "Database is at version {}.".format(current_version())
+    elif args.command == 'stamp':
+        stamp(args.version)
+        print "Database stamped at version {}.".format(args.version)
+    else:
+        print "Database is at version {} (latest is {}).".format(current_version(), LATEST_VERSION)
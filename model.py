@@ -1,6 +1,6 @@
 """Database model for nerve
-V3: six tables: User, UserChallenge and Challenge, ChallengeCategory, Category,
-UserChallengeCategory
+V4: seven tables: User, UserChallenge and Challenge, ChallengeCategory, Category,
+UserChallengeCategory, Attempt
 
 User will store id, username, password, email and phone (for verification)
 
@@ -9,7 +9,9 @@ accepted_timestamp, completed_timestamp, lat, long, image_path, points_earned
 and number of attempts.
 Related to User and Challenge by .user and .challenge
 
-Challenge will store id, title, description, difficulty, image_path 
+Challenge will store id, title, description, difficulty, image_path (a
+storage.ImageStore key, or a static path for older rows) and counters of how
+many users accepted, completed and attempted it
 
 ChallengeCategory stores id, category_id and challenge_id
 Related to Challenge and Category by .challenge and .category
@@ -19,9 +21,22 @@ Category stores categories that were recieved via api at challenge creation
 UserChallengeCategory stores information about the categories a user returned
 upon sucessful attempt of a challenge.
 
+Attempt is the queue of uploads waiting to be analyzed when attempts are
+processed in the background (see attempts.py).
+
 Class names are singular - table names are plural
+
+Many-to-one relationships that are read along with their rows are loaded
+eagerly (joined) so walking them never runs a query per row. Backref
+collections stay lazy since they can be large; hot paths should select just
+the columns they need.
+
+Large columns that listings never show (Challenge.description, User.password)
+are deferred. Hot reads project the few columns they need into the small
+namedtuple rows defined below instead of loading entities.
 """
 
+from collections import namedtuple
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
@@ -36,7 +51,7 @@ class User(db.Model):
                     autoincrement=True, 
                     primary_key=True)
     username = db.Column(db.String(50), nullable=False, unique=True)
-    password = db.Column(db.String(100), nullable=False)
+    password = db.deferred(db.Column(db.String(100), nullable=False))
     email = db.Column(db.String(50), nullable=False)
     phone = db.Column(db.String(30))
 
@@ -61,7 +76,7 @@ class UserChallenge(db.Model):
     is_removed = db.Column(db.Boolean, nullable=False, default=False)
     accepted_timestamp = db.Column(db.TIMESTAMP, nullable=False)
     completed_timestamp = db.Column(db.TIMESTAMP, nullable=True)
-    image_path = db.Column(db.String(50))
+    image_path = db.Column(db.String(100))
     points_earned = db.Column(db.Integer, default=0, nullable=False)
     attempts = db.Column(db.Integer, default=0, nullable=False)
 
@@ -69,6 +84,12 @@ class UserChallenge(db.Model):
     challenge = db.relationship('Challenge', backref=db.backref('user_challenges'))
 
     user_challenges_index = db.Index('unique_user_challenge_constraint', user_id, challenge_id, unique=True)
+    # Keyset pagination of a user's history on the profile page
+    user_history_index = db.Index('user_challenges_history_idx', user_id, accepted_timestamp, id)
+    # Leaderboards read a challenge's completed rows by score. Partial, so it
+    # only holds completed rows, and it covers user_id for index only scans.
+    leaderboard_index = db.Index('user_challenges_leaderboard_idx', challenge_id, points_earned, user_id,
+                                    postgresql_where=is_completed)
 
     def __repr__(self):
         return '<UserChallenge challenge_id:{challenge_id} id:{id}>'.format(challenge_id=self.challenge_id, 
@@ -84,9 +105,19 @@ class Challenge(db.Model):
                     autoincrement=True, 
                     primary_key=True)
     title = db.Column(db.String(35), nullable=False)
-    description = db.Column(db.Text, nullable=False)
+    description = db.deferred(db.Column(db.Text, nullable=False))
     difficulty = db.Column(db.Integer, nullable=False)
-    image_path = db.Column(db.String(50))
+    image_path = db.Column(db.String(100))
+    # Denormalized from user_challenges, kept up to date by the server in the 
+    # same transaction as accepting/attempting (see reconcile_challenge_counters)
+    num_accepted = db.Column(db.Integer, default=0, nullable=False)
+    num_completed = db.Column(db.Integer, default=0, nullable=False)
+    num_attempts = db.Column(db.Integer, default=0, nullable=False)
+
+    # Keyset pagination of the challenges listing
+    listing_index = db.Index('challenges_listing_idx', difficulty, id)
+    # create_challenge looks the new challenge up by title
+    title_index = db.Index('challenges_title_idx', title)
 
     def __repr__(self):
         return '<Challenge title:{title} id:{id}>'.format(title=self.title, 
@@ -104,10 +135,14 @@ class ChallengeCategory(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
     challenge_id = db.Column(db.Integer, db.ForeignKey('challenges.id'))
 
-    challenge = db.relationship('Challenge', backref=db.backref('challenge_categories'))
-    category = db.relationship('Category', backref=db.backref('challenge_categories'))
+    challenge = db.relationship('Challenge', lazy='joined', 
+                                backref=db.backref('challenge_categories'))
+    category = db.relationship('Category', lazy='joined', 
+                                backref=db.backref('challenge_categories'))
 
     challenge_categories_index = db.Index('quicksearchCC', challenge_id, category_id, unique=True)
+    # The analytics graph joins challenges through their shared categories
+    category_challenges_index = db.Index('challenge_categories_category_idx', category_id, challenge_id)
 
     def __repr__(self):
         return '<ChallengeCategory id: {id}>'.format(id=self.id)
@@ -140,7 +175,8 @@ class UserChallengeCategory(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
 
     user_challenge = db.relationship('UserChallenge', backref=db.backref('user_challenge_categories'))
-    category = db.relationship('Category', backref=db.backref('user_challenge_categories'))
+    category = db.relationship('Category', lazy='joined', 
+                                backref=db.backref('user_challenge_categories'))
 
     user_challenge_categories_index = db.Index('quicksearchUCC', user_challenge_id, category_id, unique=True)
 
@@ -148,6 +184,67 @@ class UserChallengeCategory(db.Model):
         return '<UserChallengeCategory UC: {UCID} C: {CID}>'.format(UCID=self.user_challenge_id,
                                                                     CID=self.category_id)
 
+class Attempt(db.Model):
+    """Durable queue of uploaded attempts waiting to be analyzed and scored.
+    Rows move from queued -> processing -> scored / unsafe / unreadable / failed
+    Related to User and Challenge by .user and .challenge
+    """
+
+    __tablename__ = 'attempts'
+
+    id = db.Column(db.Integer, 
+                    nullable=False, 
+                    autoincrement=True, 
+                    primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    challenge_id = db.Column(db.Integer, db.ForeignKey('challenges.id'), nullable=False)
+    image_path = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    points_earned = db.Column(db.Integer)
+    hits = db.Column(db.Text) # comma separated tags that matched
+    created_timestamp = db.Column(db.TIMESTAMP, nullable=False)
+    updated_timestamp = db.Column(db.TIMESTAMP, nullable=False)
+
+    user = db.relationship('User')
+    challenge = db.relationship('Challenge')
+
+    attempts_status_index = db.Index('attempts_status_idx', status, updated_timestamp)
+
+    def __repr__(self):
+        return '<Attempt id:{id} status:{status}>'.format(id=self.id, 
+                                                            status=self.status)
+
+################################################################################
+# Read only rows for hot paths
+
+# One card of the challenges listing
+ChallengeCard = namedtuple('ChallengeCard', ['id', 'title', 'description', 'difficulty', 
+                                                'image_path', 'num_accepted'])
+# One row of a challenge leaderboard
+LeaderboardRow = namedtuple('LeaderboardRow', ['user_challenge_id', 'user_id', 'username', 'points_earned'])
+
+def project(row_type, model):
+    """Query selecting just the columns of model named by row_type's fields"""
+    return db.session.query(*[getattr(model, field) for field in row_type._fields])
+
+def as_rows(row_type, results):
+    """Turns query results into row_type namedtuples"""
+    return [row_type._make(result) for result in results]
+
+def get_username(user_id):
+    """Username for a user id or None"""
+    return db.session.query(User.username).filter(User.id==user_id).scalar()
+
+def get_usernames(user_ids):
+    """{user id: username} for the given ids in one query"""
+    if not user_ids:
+        return {}
+    return dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)).all())
+
+def get_user_id(username):
+    """User id for a username or None"""
+    return db.session.query(User.id).filter(User.username==username).scalar()
+
 ################################################################################
 
 def init_app():
@@ -169,6 +266,84 @@ def connect_to_db(app, database_URI):
     db.app = app
     db.init_app(app)
 
+def insert_ignoring_duplicates(model, rows, returning=None):
+    """Inserts rows (dicts with the same keys) into the model's table with a
+    single multi-row INSERT, skipping rows that would violate a unique
+    constraint. Needs PostgreSQL 9.5+ (or SQLite 3.24+).
+    returning is an optional list of columns to return for inserted rows."""
+    if not rows:
+        return []
+    columns = sorted(rows[0])
+    params = {}
+    values = []
+    for i, row in enumerate(rows):
+        names = []
+        for column in columns:
+            name = '{}_{}'.format(column, i)
+            params[name] = row[column]
+            names.append(':' + name)
+        values.append('({})'.format(', '.join(names)))
+    sql = 'INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT DO NOTHING'.format(
+                table=model.__tablename__, columns=', '.join(columns), values=', '.join(values))
+    if returning:
+        sql += ' RETURNING ' + ', '.join(returning)
+        return db.session.execute(db.text(sql), params).fetchall()
+    db.session.execute(db.text(sql), params)
+    return []
+
+def get_category_ids(tags):
+    """Returns {tag: category id} for tags, adding the categories that don't
+    exist yet with one upsert. Leaves the transaction open for the caller."""
+    tags = set(tags)
+    if not tags:
+        return {}
+    category_ids = dict(db.session.query(Category.tag, Category.id).filter(Category.tag.in_(tags)).all())
+    missing = tags.difference(category_ids)
+    if missing:
+        inserted = insert_ignoring_duplicates(Category, [{'tag': tag} for tag in missing], 
+                                                returning=['tag', 'id'])
+        category_ids.update(inserted)
+        # Tags another transaction added since the first query
+        if len(inserted) < len(missing):
+            category_ids.update(db.session.query(Category.tag, Category.id).filter(Category.tag.in_(missing)).all())
+    return category_ids
+
+RECONCILE_COUNTERS_SQL = """
+        UPDATE challenges SET
+            num_accepted = (SELECT count(*) FROM user_challenges 
+                            WHERE user_challenges.challenge_id = challenges.id),
+            num_completed = (SELECT count(*) FROM user_challenges 
+                            WHERE user_challenges.challenge_id = challenges.id 
+                            AND user_challenges.is_completed),
+            num_attempts = (SELECT coalesce(sum(attempts), 0) FROM user_challenges 
+                            WHERE user_challenges.challenge_id = challenges.id)
+        """
+
+def reconcile_challenge_counters():
+    """Rebuilds the participation counters on every challenge from the
+    user_challenges table"""
+    db.session.execute(db.text(RECONCILE_COUNTERS_SQL))
+    db.session.commit()
+
+def run_command(command, engine=None):
+    """Runs a `python model.py` command against the connected database (or
+    engine, for 'create') and returns what to report"""
+    if command == 'create':
+        from migrations import current_version, migrate, stamp
+        engine = engine or db.engine
+        if engine.has_table(Challenge.__tablename__):
+            # create_all never changes existing tables, migrate them instead
+            applied = migrate(engine=engine)
+            if not applied:
+                return "Tables already up to date."
+            return "Applied migrations {}, database is at version {}.".format(applied, current_version(engine))
+        db.metadata.create_all(bind=engine)
+        stamp(engine=engine) # create_all builds the latest schema
+        return "Tables created."
+    elif command == 'reconcile-counters':
+        reconcile_challenge_counters()
+        return "Challenge counters rebuilt."
+
 def example_data():
     """Generates example data for test purposes. Create users with
     different characteristics:
@@ -268,13 +443,23 @@ def example_data():
                     cg1, cg2, cg3, cg4, cg5, cg6, cg7])
 
     db.session.commit()
+    reconcile_challenge_counters()
 
 
 if __name__ == '__main__':
 
 # in terminal: createdb nerve
+# python model.py                     creates the tables, or migrates existing ones
+# python model.py reconcile-counters  rebuilds challenge participation counters
+# existing databases are upgraded with python migrations.py
+
+        import argparse
+        parser = argparse.ArgumentParser(description='Manage the nerve database')
+        parser.add_argument('command', nargs='?', default='create', 
+                            choices=['create', 'reconcile-counters'])
+        args = parser.parse_args()
 
         init_app()
-        db.create_all()
+        print run_command(args.command)
 
 
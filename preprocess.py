@@ -0,0 +1,102 @@
+"""Upload preprocessing for nerve
+
+Phones upload 5-12 MB photos and the Vision API doesn't need anything close
+to that to tag an image. prepare_upload checks that an upload really is an
+image (by its magic bytes, before any API call), turns it upright according
+to its EXIF orientation and makes a small JPEG analysis copy, at most
+ANALYSIS_MAX_EDGE pixels on the long edge, which is what gets sent to Vision.
+The upload itself is only re-encoded when it had to be rotated.
+"""
+
+from collections import namedtuple
+from io import BytesIO
+from PIL import Image, ImageOps
+
+ANALYSIS_MAX_EDGE = 1024
+ANALYSIS_JPEG_QUALITY = 85
+# Rotated JPEG uploads are stored again at close to their original quality
+ROTATED_JPEG_QUALITY = 95
+
+# (format, magic bytes at the start of the file)
+MAGIC_BYTES = [
+    ('jpeg', b'\xff\xd8\xff'),
+    ('png', b'\x89PNG\r\n\x1a\n'),
+    ('gif', b'GIF87a'),
+    ('gif', b'GIF89a'),
+    ('bmp', b'BM'),
+    ('ico', b'\x00\x00\x01\x00'),
+    ('tiff', b'II*\x00'),
+    ('tiff', b'MM\x00*'),
+]
+
+# File extensions uploads of each format may have, one entry per format
+# sniff_image_type can report (WebP is sniffed separately from MAGIC_BYTES)
+FORMAT_EXTENSIONS = {
+    'jpeg': ('jpg', 'jpeg'),
+    'png': ('png',),
+    'gif': ('gif',),
+    'bmp': ('bmp',),
+    'ico': ('ico',),
+    'tiff': ('tif', 'tiff'),
+    'webp': ('webp',),
+}
+ALLOWED_EXTENSIONS = set(extension for extensions in FORMAT_EXTENSIONS.values() for extension in extensions)
+
+EXIF_ORIENTATION = 0x0112
+
+# content is the upload to store, rotated says whether it was re-encoded
+PreparedUpload = namedtuple('PreparedUpload', ['content', 'analysis_content', 'format', 'rotated'])
+
+
+class UploadRejected(ValueError):
+    """The upload is not an image we can read"""
+
+
+def sniff_image_type(header):
+    """Image format from the first bytes of a file, or None"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for image_format, magic in MAGIC_BYTES:
+        if header.startswith(magic):
+            return image_format
+    return None
+
+
+def analysis_copy(image):
+    """JPEG bytes of image scaled down to ANALYSIS_MAX_EDGE on the long edge"""
+    image = image.convert('RGB')
+    image.thumbnail((ANALYSIS_MAX_EDGE, ANALYSIS_MAX_EDGE), Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=ANALYSIS_JPEG_QUALITY)
+    return output.getvalue()
+
+
+def prepare_upload(content):
+    """Validates raw upload bytes and returns a PreparedUpload, raises
+    UploadRejected for anything that isn't a readable image"""
+    image_format = sniff_image_type(content[:16])
+    if image_format is None:
+        raise UploadRejected('Unrecognized file type')
+    try:
+        image = Image.open(BytesIO(content))
+        image.load()
+    except (IOError, SyntaxError, ValueError, Image.DecompressionBombError) as error:
+        raise UploadRejected(str(error))
+
+    rotated = image.getexif().get(EXIF_ORIENTATION, 1) != 1
+    if rotated:
+        original_format = image.format
+        image = ImageOps.exif_transpose(image)
+        output = BytesIO()
+        if original_format == 'JPEG':
+            image.save(output, original_format, quality=ROTATED_JPEG_QUALITY)
+        else:
+            image.save(output, original_format)
+        content = output.getvalue()
+    return PreparedUpload(content, analysis_copy(image), image_format, rotated)
+
+
+def prepare_file(path):
+    """prepare_upload for a file that was already saved"""
+    with open(path, 'rb') as upload:
+        return prepare_upload(upload.read())
@@ -0,0 +1,75 @@
+"""Per-request SQL query counting
+
+QueryCounter counts the queries (and the time spent in them) for every
+request through SQLAlchemy engine events. Routes declare how many queries they
+are expected to need with @query_budget(n); with QUERY_BUDGET_DEBUG on, any
+request that goes over its route's budget is logged with the offending
+statements so N+1 patterns show up as soon as they are introduced.
+"""
+
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def query_budget(limit):
+    """Decorator (below @app.route) setting the number of queries a route is
+    expected to run"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+def request_query_stats():
+    """(query count, seconds spent in queries) for the current request"""
+    return getattr(g, '_query_count', 0), getattr(g, '_query_time', 0.0)
+
+
+class QueryCounter(object):
+    """Counts queries per request, warns about routes over their budget"""
+
+    def __init__(self, app=None, default_budget=10):
+        self.default_budget = default_budget
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('QUERY_BUDGET_DEBUG', False)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._check_budget)
+
+    def _start_request(self):
+        g._query_count = 0
+        g._query_time = 0.0
+        g._query_statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['query_start_time'].pop()
+        # Queries from background workers have no request to charge
+        if has_request_context() and hasattr(g, '_query_count'):
+            g._query_count += 1
+            g._query_time += elapsed
+            if self.app.config['QUERY_BUDGET_DEBUG']:
+                g._query_statements.append(statement)
+
+    def budget_for(self, endpoint):
+        view = self.app.view_functions.get(endpoint)
+        return getattr(view, 'query_budget', self.default_budget)
+
+    def _check_budget(self, response):
+        if self.app.config['QUERY_BUDGET_DEBUG']:
+            count, elapsed = request_query_stats()
+            budget = self.budget_for(request.endpoint)
+            if count > budget:
+                self.app.logger.warning('%s %s ran %d queries (budget %d, %.1fms):\n%s',
+                                        request.method, request.path, count, budget,
+                                        elapsed * 1000, '\n'.join(g._query_statements))
+        return response
@@ -0,0 +1,189 @@
+"""Resized renditions of uploaded images for nerve
+
+Listing and profile pages used to show every upload at its original size.
+Each stored image now gets a thumb, card and full rendition in WebP and JPEG
+next to it in the image store, e.g. 3f2a...9c.card.webp beside 3f2a...9c.jpg.
+Templates offer them to the browser with srcset (see _image.html) and fall
+back to the original until all of them exist.
+
+/create and /complete/<id> hand new images to a RenditionPool so the resizing
+happens off the request path. Images stored before renditions existed, or
+whose renditions went missing, are filled in with:
+
+# python renditions.py
+# python renditions.py --database postgres:///nerve --workers 8
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from cache import LRUCache
+
+# (name, width in pixels), smallest first
+RENDITIONS = [('thumb', 320), ('card', 640), ('full', 1280)]
+
+# (extension, Pillow format, save options)
+FORMATS = [('webp', 'WEBP', {'quality': 80, 'method': 4}),
+            ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True})]
+
+# Very tall images are limited to this many times their rendition width
+MAX_ASPECT = 4
+
+log = logging.getLogger(__name__)
+
+
+def rendition_key(key, name, extension):
+    """'3f2a...9c.jpg' -> '3f2a...9c.card.webp', the original's shard"""
+    return '{}.{}.{}'.format(key.rsplit('.', 1)[0], name, extension)
+
+
+def rendition_keys(key):
+    return [rendition_key(key, name, extension) for name, width in RENDITIONS for extension, _, _ in FORMATS]
+
+
+def render(image, width, image_format, options):
+    """Encoded bytes of image scaled down to width, never up"""
+    image = image.copy()
+    image.thumbnail((width, width * MAX_ASPECT), Image.LANCZOS)
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = flatten(image)
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    output = BytesIO()
+    image.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def flatten(image):
+    """RGB copy with any transparency on white, JPEG has no alpha"""
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.split()[3])
+    return background
+
+
+def generate(store, key):
+    """Writes the renditions of a stored image that are missing, returns how
+    many were written"""
+    missing = [(name, width, extension, image_format, options)
+                for name, width in RENDITIONS for extension, image_format, options in FORMATS
+                if not store.exists(rendition_key(key, name, extension))]
+    if not missing:
+        return 0
+    image = Image.open(store.path(key))
+    image.load()
+    for name, width, extension, image_format, options in missing:
+        store.write(rendition_key(key, name, extension), render(image, width, image_format, options))
+    return len(missing)
+
+
+def delete(store, key):
+    for rendition in rendition_keys(key):
+        store.delete(rendition)
+
+
+class RenditionPool(object):
+    """Thread pool that generates renditions for newly stored images, and
+    remembers which images have all of theirs"""
+
+    def __init__(self, app, workers=2, remember=10000):
+        self.app = app
+        self.workers = workers
+        self._ready = LRUCache(maxsize=remember)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, store, key):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor.submit(self._run, store, key)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=wait)
+
+    def ready(self, store, key):
+        """Whether every rendition of key exists. Only positive answers are
+        remembered since the pool may still be working on the rest."""
+        path = store.path(key)
+        if path in self._ready:
+            return True
+        if all(store.exists(rendition) for rendition in rendition_keys(key)):
+            self._ready.put(path, True)
+            return True
+        return False
+
+    def forget(self, store, key):
+        self._ready.pop(store.path(key))
+
+    def srcset(self, store, key, extension):
+        return ', '.join('{} {}w'.format(store.url(rendition_key(key, name, extension)), width)
+                        for name, width in RENDITIONS)
+
+    def _run(self, store, key):
+        try:
+            generate(store, key)
+        except Exception:
+            self.app.logger.exception('Renditions of %s failed', key)
+
+
+def backfill(store, keys, workers=4, max_in_flight=64):
+    """Generates missing renditions for every key, returns (images that got
+    new renditions, images already done, images that failed). A failure is
+    logged and the backfill carries on with the next image."""
+    counts = {'generated': 0, 'done': 0, 'failed': 0}
+    in_flight = deque()
+
+    def collect(key, future):
+        try:
+            counts['generated' if future.result() else 'done'] += 1
+        except Exception:
+            # Pillow raises more than IOError for bad files, e.g. ValueError,
+            # SyntaxError and DecompressionBombError
+            log.exception('Renditions of %s failed', key)
+            counts['failed'] += 1
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for key in keys:
+            in_flight.append((key, executor.submit(generate, store, key)))
+            if len(in_flight) >= max_in_flight:
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+    finally:
+        executor.shutdown(wait=True)
+    return counts['generated'], counts['done'], counts['failed']
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from flask import Flask
+    from sqlalchemy import union
+    from model import Challenge, UserChallenge, connect_to_db, db
+    from storage import ImageStore
+
+    parser = argparse.ArgumentParser(description='Generate missing image renditions')
+    parser.add_argument('--database', default='postgres:///nerve', help='SQLAlchemy database URI')
+    parser.add_argument('--upload-folder', default='static/images')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(message)s')
+    connect_to_db(Flask(__name__), args.database)
+    store = ImageStore(args.upload_folder, '/static/images')
+    images = union(db.select([Challenge.image_path]).where(Challenge.image_path != None),
+                    db.select([UserChallenge.image_path]).where(UserChallenge.image_path != None))
+    start = time.time()
+    keys = (key for (key,) in db.session.execute(images))
+    generated, done, failed = backfill(store, keys, args.workers)
+    print "{} images got renditions, {} already had them, {} failed in {:.1f}s".format(
+        generated, done, failed, time.time() - start)
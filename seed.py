@@ -0,0 +1,293 @@
+"""Large synthetic datasets for nerve
+
+example_data() is enough for the tests but far too small to show how a change
+behaves at scale. seed.py fills an empty database with as many users,
+challenges, categories and user challenges as asked for, streaming every row
+through COPY (or batched multi-row inserts on databases other than
+PostgreSQL) so memory use stays flat however large the dataset.
+
+The data is skewed the way real usage is: a few challenges are far more
+popular than the rest, a few tags far more common, and most users accept a
+handful of challenges while a few accept hundreds. Everything comes from
+random.Random seeded with --seed, so the same arguments always produce the
+same database and performance changes can be measured against it.
+
+# createdb nerve_large
+# python seed.py --database postgres:///nerve_large --reset
+# python seed.py --database postgres:///nerve_large --reset --users 1000000 \\
+#     --challenges 100000 --categories 20000 --user-challenges 10000000
+"""
+
+import argparse
+import bisect
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+from flask.ext.bcrypt import generate_password_hash
+from model import Category, Challenge, ChallengeCategory, User, UserChallenge, UserChallengeCategory
+from model import RECONCILE_COUNTERS_SQL, connect_to_db, db
+from vision import LOCAL_VOCABULARY
+
+# Every seeded user logs in with this password
+SEED_PASSWORD = 'password'
+# Seeded timestamps count back from here rather than from now, to be reproducible
+SEED_EPOCH = datetime(2017, 6, 1)
+SEED_IMAGE_PATH = 'static/images/butter.png'
+# Caps the long tail of the per user challenge count
+MAX_CHALLENGES_PER_USER = 1000
+DESCRIPTION_WORDS = ['a', 'an', 'the', 'find', 'photograph', 'build', 'draw', 'wear', 'eat',
+                    'climb', 'with', 'near', 'under', 'your', 'friend', 'favourite', 'tiny',
+                    'enormous', 'red', 'blue', 'robot', 'hat', 'sandwich', 'bridge', 'dog']
+# Slots in the random seed for each table, so changing one table's size does
+# not change the rows generated for another
+STREAMS = {'challenges': 1, 'challenge_categories': 2, 'user_challenges': 3}
+
+
+class SkewedChoice(object):
+    """Picks 0 .. n-1 with Zipf-like weights 1 / (i + 1) ** exponent"""
+
+    def __init__(self, n, exponent):
+        total = 0.0
+        self.cumulative = []
+        for i in xrange(n):
+            total += 1.0 / (i + 1) ** exponent
+            self.cumulative.append(total)
+        self.total = total
+
+    def pick(self, rng):
+        return bisect.bisect(self.cumulative, rng.random() * self.total)
+
+    def sample(self, rng, k):
+        """k distinct picks"""
+        picked = set()
+        while len(picked) < k:
+            picked.add(self.pick(rng))
+        return picked
+
+
+class RowStream(object):
+    """File-like object feeding rows to COPY ... FROM STDIN as they are
+    generated"""
+
+    def __init__(self, rows):
+        self._lines = ('\t'.join(copy_value(value) for value in row) + '\n' for row in rows)
+        self._buffer = ''
+
+    def read(self, size=65536):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
+
+    readline = read
+
+
+def copy_value(value):
+    """A value in COPY's text format. Generated strings never contain tabs,
+    newlines or backslashes so nothing needs escaping."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value)
+
+
+def stream(seed, name):
+    return random.Random(seed * 100 + STREAMS[name])
+
+
+def user_rows(args, password_hash):
+    for user_id in xrange(1, args.users + 1):
+        username = 'user{}'.format(user_id)
+        yield (user_id, username, password_hash, '{}@example.com'.format(username), '555-0100')
+
+
+def category_rows(args):
+    for category_id in xrange(1, args.categories + 1):
+        if category_id <= len(LOCAL_VOCABULARY):
+            tag = LOCAL_VOCABULARY[category_id - 1]
+        else:
+            tag = 'tag{}'.format(category_id)
+        yield (category_id, tag)
+
+
+def challenge_difficulties(args):
+    rng = stream(args.seed, 'challenges')
+    return [rng.randint(1, 5) for _ in xrange(args.challenges)]
+
+
+def challenge_rows(args, difficulties):
+    rng = stream(args.seed, 'challenges')
+    rng.jumpahead(1) # different draws from challenge_difficulties
+    for challenge_id, difficulty in enumerate(difficulties, 1):
+        description = ' '.join(rng.choice(DESCRIPTION_WORDS) for _ in xrange(rng.randint(6, 20)))
+        yield (challenge_id, 'Challenge {}'.format(challenge_id), description.capitalize(),
+                difficulty, SEED_IMAGE_PATH)
+
+
+def challenge_category_ids(args):
+    """Category ids of every challenge, popular tags are used most"""
+    rng = stream(args.seed, 'challenge_categories')
+    tags = SkewedChoice(args.categories, args.skew)
+    per_challenge = min(args.tags_per_challenge, args.categories)
+    return [sorted(category + 1 for category in tags.sample(rng, per_challenge))
+            for _ in xrange(args.challenges)]
+
+
+def challenge_category_rows(category_ids):
+    for challenge_id, categories in enumerate(category_ids, 1):
+        for category_id in categories:
+            yield (challenge_id, category_id)
+
+
+def user_challenge_rows(args, difficulties, category_ids):
+    """Yields (user challenge row, category ids it won on). Ids are assigned
+    here so user_challenge_categories can be generated from a second pass
+    with the same seed."""
+    rng = stream(args.seed, 'user_challenges')
+    popularity = SkewedChoice(args.challenges, args.skew)
+    mean = float(args.user_challenges) / max(args.users, 1)
+    # Pareto with shape alpha has mean alpha / (alpha - 1) times its minimum
+    alpha = 1.5
+    scale = mean * (alpha - 1) / alpha
+    most = max(min(args.challenges // 2, MAX_CHALLENGES_PER_USER), 1)
+    user_challenge_id = 0
+    for user_id in xrange(1, args.users + 1):
+        accepted = min(int(round(scale * rng.paretovariate(alpha))), most)
+        for challenge in sorted(popularity.sample(rng, accepted)):
+            user_challenge_id += 1
+            accepted_timestamp = SEED_EPOCH - timedelta(seconds=rng.randint(0, 2 * 365 * 24 * 3600))
+            attempts = rng.choice([0, 0, 1, 1, 2, 3, 5])
+            is_completed = attempts > 0 and rng.random() < 0.6
+            hits = []
+            completed_timestamp = image_path = None
+            points = 0
+            if is_completed:
+                hits = rng.sample(category_ids[challenge], rng.randint(1, len(category_ids[challenge])))
+                points = (10 * difficulties[challenge] / attempts) * len(hits)
+                completed_timestamp = accepted_timestamp + timedelta(seconds=rng.randint(60, 30 * 24 * 3600))
+                image_path = SEED_IMAGE_PATH
+            yield ((user_challenge_id, user_id, challenge + 1, is_completed, False, accepted_timestamp,
+                    completed_timestamp, image_path, points, attempts), hits)
+
+
+def copy_rows(model, columns, rows, batch_size):
+    """Streams rows into model's table, returns how many were written"""
+    counted = itertools.count(1)
+    rows = (row for row, _ in itertools.izip(rows, counted))
+    if db.engine.dialect.name == 'postgresql':
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(model.__tablename__, ', '.join(columns)),
+                                RowStream(rows), size=batch_size)
+            connection.commit()
+        finally:
+            connection.close()
+    else:
+        table = model.__table__
+        while True:
+            batch = [dict(zip(columns, row)) for row in itertools.islice(rows, batch_size)]
+            if not batch:
+                break
+            db.engine.execute(table.insert(), batch)
+    return next(counted) - 1
+
+
+def seed_table(model, columns, rows, batch_size):
+    start = time.time()
+    written = copy_rows(model, columns, rows, batch_size)
+    elapsed = time.time() - start
+    print "{:>28} {:>10} rows {:8.1f}s {:>10.0f} rows/s".format(model.__tablename__, written, elapsed,
+                                                                written / max(elapsed, 1e-6))
+
+
+def reset_sequences():
+    """Moves the id sequences past the ids COPY wrote explicitly"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in (User, Category, Challenge, UserChallenge):
+        table = model.__tablename__
+        db.engine.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                            "coalesce((SELECT max(id) FROM {0}), 0) + 1, false)".format(table))
+
+
+def seed(args):
+    """Fills the database, tables must exist and be empty"""
+    difficulties = challenge_difficulties(args)
+    category_ids = challenge_category_ids(args)
+
+    seed_table(User, ['id', 'username', 'password', 'email', 'phone'],
+                user_rows(args, generate_password_hash(SEED_PASSWORD)), args.batch_size)
+    seed_table(Category, ['id', 'tag'], category_rows(args), args.batch_size)
+    seed_table(Challenge, ['id', 'title', 'description', 'difficulty', 'image_path'],
+                challenge_rows(args, difficulties), args.batch_size)
+    seed_table(ChallengeCategory, ['challenge_id', 'category_id'],
+                challenge_category_rows(category_ids), args.batch_size)
+    seed_table(UserChallenge, ['id', 'user_id', 'challenge_id', 'is_completed', 'is_removed',
+                                'accepted_timestamp', 'completed_timestamp', 'image_path',
+                                'points_earned', 'attempts'],
+                (row for row, hits in user_challenge_rows(args, difficulties, category_ids)),
+                args.batch_size)
+    # Same seed, same rows: this pass only keeps the winning hits
+    seed_table(UserChallengeCategory, ['user_challenge_id', 'category_id'],
+                ((row[0], category_id) for row, hits in user_challenge_rows(args, difficulties, category_ids)
+                    for category_id in hits),
+                args.batch_size)
+
+    reset_sequences()
+    start = time.time()
+    db.engine.execute(db.text(RECONCILE_COUNTERS_SQL))
+    if db.engine.dialect.name == 'postgresql':
+        db.engine.execute(db.text('ANALYZE').execution_options(autocommit=True))
+    print "Counters reconciled and tables analyzed in {:.1f}s".format(time.time() - start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fill a nerve database with a large synthetic dataset')
+    parser.add_argument('--database', default='postgres:///nerve', help='SQLAlchemy database URI')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--challenges', type=int, default=1000)
+    parser.add_argument('--categories', type=int, default=500)
+    parser.add_argument('--user-challenges', type=int, default=100000,
+                        help='roughly how many user challenges to create')
+    parser.add_argument('--tags-per-challenge', type=int, default=5)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent for challenge and tag popularity, 0 is uniform')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=65536,
+                        help='bytes per COPY read, rows per insert elsewhere')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate every table first')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+
+    from flask import Flask
+    from migrations import stamp
+
+    args = parse_args()
+    app = Flask(__name__)
+    connect_to_db(app, args.database)
+
+    if args.reset:
+        db.drop_all()
+        db.create_all()
+        stamp()
+    elif db.session.query(User.id).first():
+        raise SystemExit('{} already has users, pass --reset to replace them'.format(args.database))
+
+    start = time.time()
+    seed(args)
+    print "Seeded {} in {:.1f}s".format(args.database, time.time() - start)
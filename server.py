@@ -1,13 +1,25 @@
 from jinja2 import StrictUndefined
 import os, sys
+from collections import namedtuple
 from datetime import datetime
 from flask_debugtoolbar import DebugToolbarExtension
 from flask import Flask, jsonify, render_template, redirect, request, flash, session
-from werkzeug.utils import secure_filename
-from model import User, UserChallenge, Challenge, ChallengeCategory, Category, UserChallengeCategory, connect_to_db, db, example_data
-from vision import get_tags_for_image, image_is_safe
+from model import User, UserChallenge, Challenge, ChallengeCategory, Category, UserChallengeCategory, Attempt, connect_to_db, db, example_data, insert_ignoring_duplicates
+from model import ChallengeCard, LeaderboardRow, project, as_rows, get_username, get_usernames, get_user_id, get_category_ids
+from vision import analyze_content
+from preprocess import ALLOWED_EXTENSIONS, UploadRejected, prepare_upload, prepare_file
+from storage import ImageStore
+from renditions import RenditionPool, rendition_key
+import renditions
+from attempts import AttemptQueue, FINISHED_STATUSES
+from cache import LRUCache
+from challenge_graph import ChallengeGraph
+from leaderboard import Leaderboards
+from querycount import QueryCounter, query_budget
+from metrics import RequestMetrics
 from flask.ext.bcrypt import Bcrypt
-from sqlalchemy import exc, desc
+from sqlalchemy import exc, desc, tuple_
+from sqlalchemy.orm import undefer
 import arrow
 
 
@@ -18,13 +30,55 @@ bcrypt = Bcrypt(app)
 app.secret_key = "81CAEB25176HDG36710KSXZ2320"
 
 UPLOAD_FOLDER = 'static/images'
-# To be compatible with cloudvision api:
-ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'bmp', 'raw', 'ico']) 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Uploads are stored by content hash, image_path columns hold the key
+image_store = ImageStore(UPLOAD_FOLDER, '/static/images')
+# Thumb/card/full renditions of new images are made in a background pool
+app.config['RENDITION_WORKERS'] = int(os.environ.get('NERVE_RENDITION_WORKERS', 2))
+rendition_pool = RenditionPool(app, workers=app.config['RENDITION_WORKERS'])
+# Larger uploads are refused with a 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('NERVE_MAX_UPLOAD_MB', 16)) * 1024 * 1024
+# Analyze and score /complete/<id> uploads in a background worker pool
+app.config['ASYNC_ATTEMPTS'] = os.environ.get('NERVE_ASYNC_ATTEMPTS') == '1'
+app.config['ATTEMPT_WORKERS'] = int(os.environ.get('NERVE_ATTEMPT_WORKERS', 4))
+# Keeps the analytics graph payload small when there are many challenges
+app.config['GRAPH_MAX_EDGES_PER_NODE'] = int(os.environ.get('NERVE_GRAPH_MAX_EDGES_PER_NODE', 10))
+
+# Page sizes for keyset paginated lists
+CHALLENGES_PER_PAGE = 30
+USER_CHALLENGES_PER_PAGE = 20
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 # Raise error for undefined variable in Jinja2
 app.jinja_env.undefined = StrictUndefined
 
+@app.template_filter('image_url')
+def image_url(key):
+    """URL of a stored image, {{ challenge.image_path|image_url }}"""
+    return image_store.url(key) if key else None
+
+@app.template_filter('rendition_url')
+def rendition_url(key, name):
+    """URL of one JPEG rendition of a stored image"""
+    return image_store.url(rendition_key(key, name, 'jpg'))
+
+@app.template_filter('image_srcset')
+def image_srcset(key, extension):
+    """srcset listing every rendition of a stored image in one format"""
+    return rendition_pool.srcset(image_store, key, extension)
+
+@app.template_filter('has_renditions')
+def has_renditions(key):
+    return bool(key) and rendition_pool.ready(image_store, key)
+
+# Log requests that run more queries than their route's @query_budget
+app.config['QUERY_BUDGET_DEBUG'] = os.environ.get('NERVE_QUERY_BUDGET_DEBUG') == '1'
+query_counter = QueryCounter(app)
+# Per route latency, SQL and upload histograms at /metrics, slow request logs
+app.config['METRICS_SLOW_REQUEST_SECONDS'] = float(os.environ.get('NERVE_SLOW_REQUEST_SECONDS', 1.0))
+app.config['METRICS_SLOW_SAMPLE_RATE'] = float(os.environ.get('NERVE_SLOW_SAMPLE_RATE', 1.0))
+request_metrics = RequestMetrics(app)
+
 def is_session_active():
     """Checks if a user is logged in or not, if there is no active key stored
     in the session one is created"""
@@ -52,44 +106,110 @@ def get_user_by_id(user_id):
     user = User.query.filter(User.id==user_id).first()
     return user
 
-def get_profile_page_info(user_id):
-    """Return relevant data to be displayed on profile page.
+def get_profile_page_info(user_id, cursor=None, limit=USER_CHALLENGES_PER_PAGE):
+    """Return relevant data to be displayed on profile page, newest accepted
+    first, one page at a time. cursor is the next_cursor of the previous page.
+    Returns (list of (UserChallenge, Challenge) tuples, next_cursor or None)
 
-        >>> get_profile_page_info('Schmlandula')
-        [(<UserChallenge challenge_id:2 id:6>, <Challenge title:Bring Down the Federation id:2>)]
-        >>> get_profile_page_info('Shmlony')
-        []
+        >>> get_profile_page_info(5)
+        ([(<UserChallenge challenge_id:2 id:6>, <Challenge title:Bring Down the Federation id:2>)], None)
+        >>> get_profile_page_info(1)
+        ([], None)
     """
     info = db.session.query(UserChallenge, 
-            Challenge).join(Challenge).filter(UserChallenge.user_id==user_id)
-    return info.all()
+            Challenge).join(Challenge).options(undefer(Challenge.description)).filter(
+            UserChallenge.user_id==user_id).order_by(
+            desc(UserChallenge.accepted_timestamp), desc(UserChallenge.id))
+    after = parse_profile_cursor(cursor)
+    if after:
+        info = info.filter(tuple_(UserChallenge.accepted_timestamp, UserChallenge.id) < tuple_(*after))
+    rows = info.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1].UserChallenge
+        next_cursor = '{}_{}'.format(last.accepted_timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), last.id)
+    return rows[:limit], next_cursor
+
+def parse_profile_cursor(cursor):
+    """'<accepted timestamp>_<user challenge id>' -> (datetime, id) or None"""
+    try:
+        timestamp, user_challenge_id = cursor.rsplit('_', 1)
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(user_challenge_id)
+    except (AttributeError, ValueError):
+        return None
+
+def get_challenges_page(cursor=None, limit=CHALLENGES_PER_PAGE):
+    """Challenges hardest first, one page at a time. cursor is the next_cursor
+    of the previous page. Returns (list of ChallengeCards, next_cursor or None)"""
+    query = project(ChallengeCard, Challenge).order_by(desc(Challenge.difficulty), desc(Challenge.id))
+    after = parse_challenges_cursor(cursor)
+    if after:
+        query = query.filter(tuple_(Challenge.difficulty, Challenge.id) < tuple_(*after))
+    challenges = as_rows(ChallengeCard, query.limit(limit + 1))
+    next_cursor = None
+    if len(challenges) > limit:
+        last = challenges[limit - 1]
+        next_cursor = '{}_{}'.format(last.difficulty, last.id)
+    return challenges[:limit], next_cursor
+
+def parse_challenges_cursor(cursor):
+    """'<difficulty>_<challenge id>' -> (difficulty, id) or None"""
+    try:
+        difficulty, challenge_id = cursor.split('_')
+        return int(difficulty), int(challenge_id)
+    except (AttributeError, ValueError):
+        return None
 
 @app.route('/profile/id/<user_id>')
 def to_profile_from_id(user_id):
     """Redirect to user profile through user id"""
-    user = get_user_by_id(user_id)
-    if user:
-        return redirect('/profile/{}'.format(user.username))
+    username = get_username(user_id)
+    if username:
+        return redirect('/profile/{}'.format(username))
     return redirect('/')
 
 
 @app.route('/profile/<username>')
+@query_budget(4)
 def load_user_profile(username):
     """Shows the profile of the specified User and their UserChallenges
     If the user clicks their own profile icon they will go to their profile, if
     they click another profile it will load that users profile and challenges.
     """
-    user = get_user_by_username(username)
-    is_logged_in_user = (user.id == session['user_id'])
-    if user:
-        info = get_profile_page_info(user.id)
+    user_id = get_user_id(username)
+    if user_id:
+        is_logged_in_user = (user_id == session['user_id'])
+        info, next_cursor = get_profile_page_info(user_id, request.args.get('cursor'))
+        rank, points, num_ranked = leaderboards.global_rank(user_id)
         return render_template('profile.html', 
                                 username=username, 
                                 info=info, 
-                                is_logged_in_user=is_logged_in_user)
+                                next_cursor=next_cursor,
+                                is_logged_in_user=is_logged_in_user,
+                                rank=rank, points=points, num_ranked=num_ranked)
     else:
         return redirect('/challenges')
 
+@app.route('/profile/<username>/challenges.json')
+@query_budget(2)
+def user_challenges_page(username):
+    """One page of a user's challenges as JSON, ?cursor= for the next page"""
+    user_id = get_user_id(username)
+    if not user_id:
+        return jsonify({'user_challenges': [], 'next_cursor': None})
+    info, next_cursor = get_profile_page_info(user_id, request.args.get('cursor'))
+    user_challenges = [{'user_challenge_id': user_challenge.id,
+                        'challenge_id': challenge.id,
+                        'title': challenge.title,
+                        'is_completed': user_challenge.is_completed,
+                        'accepted_timestamp': user_challenge.accepted_timestamp.isoformat(),
+                        'points_earned': user_challenge.points_earned,
+                        'attempts': user_challenge.attempts,
+                        'image_path': user_challenge.image_path,
+                        'image_url': image_url(user_challenge.image_path)}
+                        for user_challenge, challenge in info]
+    return jsonify({'user_challenges': user_challenges, 'next_cursor': next_cursor})
+
 @app.route('/time.json')
 def humanize_timestamp():
     """Takes ISO string passed from challenge object and converts it to
@@ -99,12 +219,12 @@ def humanize_timestamp():
     return arrow_time_object.humanize()
 
 @app.route('/num-players.json')
+@query_budget(1)
 def num_players():
     """Counts how many users are participating in each challenge"""
     challenge_id = request.args.get('challenge_id')
-    query = UserChallenge.query.filter(UserChallenge.challenge_id==challenge_id)
-    print query.count()
-    return str(query.count())
+    num_accepted = db.session.query(Challenge.num_accepted).filter(Challenge.id==challenge_id).scalar()
+    return str(num_accepted or 0)
 
 def check_password(db_password, password):
     """Checks to see if entered password matches the db password"""
@@ -116,23 +236,24 @@ def show_entry_forms():
     return render_template('login-register.html')
 
 @app.route('/username_taken.json')
+@query_budget(1)
 def is_username_taken():
     """Checks if username exists in Users table, returns T/F"""
     username = request.args.get('username')
-    print username
-    user = get_user_by_username(username)
-    print bool(user)
-    is_user = {'username-taken': bool(user)}
+    user_id = get_user_id(username)
+    is_user = {'username-taken': bool(user_id)}
     return jsonify(is_user)
 
 @app.route('/login', methods=['POST'])
+@query_budget(1)
 def show_login_form():
     """Handles login attempts"""
     username = request.form.get('username')
     password = request.form.get('password')
     # print username, password
 
-    user = get_user_by_username(username)
+    # password is deferred on User, select just what's needed to log in
+    user = db.session.query(User.id, User.password).filter(User.username==username).first()
 
     if user: # user exists
         if check_password(user.password, password):
@@ -168,77 +289,111 @@ def register_user():
     phone = request.form.get('tel')
     email = request.form.get('email')
 
-    user = get_user_by_username(username) # None evaluates to False
+    user_id = get_user_id(username) # None evaluates to False
 
-    if user:
+    if user_id:
         flash('Username taken')
         return redirect('/register')
     else:
         post_user(username, password, email, phone)
         # Add newly created user to the session
         session['active'] = True
-        session['user_id'] = User.query.filter(User.username==username).first().id
+        session['user_id'] = get_user_id(username)
         return redirect('/challenges')
 
 def allowed_file(filename):
     """Makes sure that the uploaded file is valid type"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def remove_unused_image(key):
+    """Deletes a stored image unless a challenge or a completed attempt shows
+    it. Identical uploads share one file."""
+    used = (db.session.query(Challenge.id).filter(Challenge.image_path==key).first() or
+            db.session.query(UserChallenge.id).filter(UserChallenge.image_path==key).first())
+    if not used:
+        image_store.delete(key)
+        renditions.delete(image_store, key)
+        rendition_pool.forget(image_store, key)
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    """MAX_CONTENT_LENGTH was exceeded"""
+    if request.is_xhr:
+        return jsonify({'error': 'File too large'}), 413
+    flash('That image is too large. Please choose a smaller one')
+    return redirect(request.referrer or '/challenges')
+
 
 def post_challenge(t, d, l, f):
-    """Creates a new challenge and adds it to the db"""
+    """Creates a new challenge and adds it to the db, returns its id"""
     new_challenge = Challenge(title=t, description=d, difficulty=l, image_path=f)
     db.session.add(new_challenge)
     db.session.commit()
+    return new_challenge.id
 
 def post_categories(tag):
     """Adds new categories to db that are unique."""
     new_category = Category(tag=tag)
     db.session.add(new_category)
-    print 'posted', tag
     try:
         db.session.commit()
         return new_category
     except exc.IntegrityError:
         db.session.rollback()
-        print "{} already exists in the Category table.".format(tag)
+        app.logger.debug('%s already exists in the Category table.', tag)
+
+# A challenge's tags never change after create_challenge, so matching and the
+# analytics page read them from here. tags is a frozenset, category_ids maps
+# tag -> category id and must not be modified. Challenges without tags are not
+# cached: their categories may not be committed yet, and another worker adding
+# them can't invalidate this process's cache.
+ChallengeTags = namedtuple('ChallengeTags', ['tags', 'category_ids'])
+challenge_tags_cache = LRUCache(maxsize=int(os.environ.get('NERVE_CHALLENGE_TAGS_CACHE_SIZE', 4096)))
+
+def get_challenge_tags(challenge_id):
+    """Returns the ChallengeTags for a challenge, loading them in one query on
+    a cache miss. An empty result is loaded again on the next call."""
+    challenge_id = int(challenge_id)
+    challenge_tags = challenge_tags_cache.get(challenge_id)
+    if challenge_tags is None:
+        category_ids = dict(db.session.query(Category.tag, Category.id).join(ChallengeCategory).filter(
+                                                            ChallengeCategory.challenge_id==challenge_id).all())
+        challenge_tags = ChallengeTags(frozenset(category_ids), category_ids)
+        if category_ids:
+            challenge_tags_cache.put(challenge_id, challenge_tags)
+    return challenge_tags
 
 def post_challenge_categories(tag_set, challenge_id):
     """Adds records describing relations between an individual challenge and 
                 multiple categories. If the category doesn't exist in the db it
                 gets added and the relation is created. Does not create 
-                duplicate records in ChallengeCategory table either. """
-  
-    for tag in tag_set:
-        category = db.session.query(Category).filter(Category.tag==tag).first()
-        if category:
-            print category, 'is in the Categories table and is ready to be added as a ChallengeCategory'
-            new_challenge_category = ChallengeCategory(category_id=category.id, 
-                                                        challenge_id=challenge_id)
-            db.session.add(new_challenge_category)
-            try:
-                db.session.commit()
-            except exc.IntegrityError:
-                db.session.rollback()
-                print "Relation between {tag} and challenge {id} already exists.".format(tag=tag, id=challenge_id)
-        else:
-            print tag, 'was not in the Categories table and needs to be added'
-            # commits new category
-            category = post_categories(tag)
-            # new transaction
-            new_challenge_category = ChallengeCategory(category_id=category.id, 
-                                                        challenge_id=challenge_id)
-            db.session.add(new_challenge_category)
-            # Following try/except block catches exceptions that may arise from
-            # the category&challenge unique constraint via the composite index
-            try:
-                db.session.commit()
-            except exc.IntegrityError:
-                db.session.rollback()
-                print "Relation between {tag} and challenge {id} already exists.".format(tag=tag, id=challenge_id)
+                duplicate records in ChallengeCategory table either. 
+
+    Runs in one transaction: one query resolves the existing tags, one upsert
+    adds the missing categories and one insert creates the relations.
+    Returns a dict of tag -> category id ({} if nothing was saved)."""
+
+    tags = set(tag_set)
+    if not tags:
+        return {}
+
+    try:
+        category_ids = get_category_ids(tags)
+        insert_ignoring_duplicates(ChallengeCategory, [{'challenge_id': challenge_id, 'category_id': category_id}
+                                                        for category_id in category_ids.values()])
+        db.session.commit()
+    except exc.IntegrityError:
+        # challenge_id is not a valid challenge
+        db.session.rollback()
+        app.logger.warning('Challenge %s does not exist, no categories added.', challenge_id)
+        return {}
+    challenge_tags_cache.pop(int(challenge_id))
+    challenge_graph.add_categories(int(challenge_id), category_ids.values())
+    return category_ids
 
 
 @app.route('/create', methods=['GET', 'POST'])
+@query_budget(8)
 def create_challenge():
     """Render new challenge form and post newly created challenges if valid"""
     if request.method == 'POST':
@@ -250,33 +405,97 @@ def create_challenge():
         if file.filename == '':
             return redirect('/challenges')
         elif file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            filename = 'static/images/' + filename
-            if image_is_safe(filename):
-                tag_list = get_tags_for_image(filename, 10)
-                if tag_list:
-                    post_challenge(title, description, difficulty, filename)
-                    challenge_id = db.session.query(Challenge.id).filter(Challenge.title==title).first()
-                    post_challenge_categories(tag_list, challenge_id[0])
-                    return redirect('/challenge/{}'.format(challenge_id[0]))
-                else:
-                    flash("""We weren't able to analyze your image. Please 
-                        choose another and try again""")
-                    return redirect('/challenges')
+            try:
+                upload = prepare_upload(file.read())
+            except UploadRejected:
+                flash('That file is not an image. Please choose another and try again')
+                return redirect('/challenges')
+            # Only the small analysis copy goes to Vision, and only safe
+            # images are saved
+            analysis = analyze_content(upload.analysis_content, 10)
+            if analysis and not analysis.safe:
+                flash('Try another image')
+                return redirect('/challenges')
+            elif analysis and analysis.tags:
+                image_key = image_store.put(upload.content, upload.format)
+                challenge_id = post_challenge(title, description, difficulty, image_key)
+                rendition_pool.submit(image_store, image_key)
+                post_challenge_categories(analysis.tags, challenge_id)
+                return redirect('/challenge/{}'.format(challenge_id))
+            else:
+                flash("""We weren't able to analyze your image. Please 
+                    choose another and try again""")
+                return redirect('/challenges')
 
 @app.route('/challenges')
+@query_budget(3)
 def show_all_challenges():
     """Shows a list of all available challenges"""
     if session['active']:
-        user = get_user_by_id(session['user_id'])
-        username = user.username
+        username = get_username(session['user_id'])
     else:
         username = ''
-    challenges = Challenge.query.order_by(desc(Challenge.difficulty)).all()
-    return render_template('challenges.html', challenges=challenges, username=username)
+    challenges, next_cursor = get_challenges_page(request.args.get('cursor'))
+    challenge_status = get_challenges_status(challenges, session['user_id'])
+    # Infinite scroll asks for just the next batch of cards
+    template = '_challenge_cards.html' if request.args.get('partial') else 'challenges.html'
+    return render_template(template, challenges=challenges, username=username,
+                            challenge_status=challenge_status, next_cursor=next_cursor)
+
+@app.route('/challenges.json')
+@query_budget(1)
+def challenges_page():
+    """One page of the challenges listing as JSON, ?cursor= for the next page"""
+    challenges, next_cursor = get_challenges_page(request.args.get('cursor'))
+    return jsonify({'challenges': [{'id': challenge.id,
+                                    'title': challenge.title,
+                                    'description': challenge.description,
+                                    'difficulty': challenge.difficulty,
+                                    'image_path': challenge.image_path,
+                                    'image_url': image_url(challenge.image_path),
+                                    'players': challenge.num_accepted}
+                                    for challenge in challenges],
+                    'next_cursor': next_cursor})
+
+def get_challenges_status(challenges, user_id):
+    """Returns {challenge id: {'players': n, 'status': s}} for every challenge
+    where s is 'accepted', 'completed' or '' for the given user. challenges are
+    Challenges, ChallengeCards or ids, the user's statuses take one grouped query."""
+    challenge_ids = [getattr(challenge, 'id', challenge) for challenge in challenges]
+    if not challenge_ids:
+        return {}
+    if all(isinstance(challenge, (Challenge, ChallengeCard)) for challenge in challenges):
+        players = {challenge.id: challenge.num_accepted for challenge in challenges}
+    else:
+        players = dict(db.session.query(Challenge.id, 
+                                        Challenge.num_accepted).filter(Challenge.id.in_(challenge_ids)).all())
+    completed = {}
+    if user_id:
+        completed = dict(db.session.query(UserChallenge.challenge_id, UserChallenge.is_completed).filter(
+                            (UserChallenge.user_id==user_id)&(UserChallenge.challenge_id.in_(challenge_ids))).all())
+    status = {}
+    for challenge_id, num_players in players.items():
+        if challenge_id not in completed:
+            state = ''
+        elif completed[challenge_id]:
+            state = 'completed'
+        else:
+            state = 'accepted'
+        status[challenge_id] = {'players': num_players, 'status': state}
+    return status
+
+@app.route('/challenges-status.json')
+@query_budget(2)
+def challenges_status():
+    """Player counts and the session user's accepted/completed state for a 
+    comma separated list of challenge ids, in one response"""
+    challenge_ids = [int(challenge_id) for challenge_id in 
+                        request.args.get('challenge_ids', '').split(',')[:500] if challenge_id.isdigit()]
+    user_id = session['user_id'] if is_session_active() else None
+    return jsonify({'challenges': get_challenges_status(challenge_ids, user_id)})
 
 @app.route('/is_completed.json')
+@query_budget(1)
 def is_challenge_completed():
     """Returns accepted or copmleted (not accepted is default - empty string 
         returned to JS) for each challenge on the page 
@@ -297,37 +516,135 @@ def is_challenge_completed():
     else:
         return ''
 
-def leaderboard(challenge_id):
-    """Given a challenge id return list of tuples ordered by highest score that
-        contain username and score"""
-    query = UserChallenge.query.filter((UserChallenge.challenge_id==challenge_id)&(UserChallenge.is_completed==True)).order_by(desc(UserChallenge.points_earned))
-    winners_list = query.limit(6).all()
-    print "hello ", winners_list
-    return winners_list
+leaderboards = Leaderboards()
+
+def leaderboard(challenge_id, limit=6, offset=0):
+    """Given a challenge id return list of LeaderboardRows ordered by highest 
+        score. Ranks come from the in-process leaderboard, usernames and user
+        challenge ids from one query for the page of users."""
+    ranked = leaderboards.challenge_range(challenge_id, offset, limit)
+    if not ranked:
+        return []
+    rows = db.session.query(UserChallenge.user_id, UserChallenge.id, User.username).join(User).filter(
+                            (UserChallenge.challenge_id==challenge_id)&
+                            (UserChallenge.user_id.in_([user_id for user_id, points in ranked]))).all()
+    details = {user_id: (user_challenge_id, username) for user_id, user_challenge_id, username in rows}
+    return [LeaderboardRow(details[user_id][0], user_id, details[user_id][1], points) 
+            for user_id, points in ranked if user_id in details]
+
+@app.route('/leaderboard.json')
+@query_budget(3)
+def leaderboard_page():
+    """A page of the global ranking, or of one challenge's ranking when 
+    challenge_id is given: ?challenge_id=&offset=&limit="""
+    try:
+        challenge_id = int(request.args['challenge_id']) if request.args.get('challenge_id') else None
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 10)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'challenge_id, offset and limit must be integers'}), 400
+    if challenge_id:
+        rows = [{'rank': offset + i + 1, 'user_id': row.user_id, 'username': row.username, 
+                'points': row.points_earned} for i, row in enumerate(leaderboard(challenge_id, limit, offset))]
+    else:
+        ranked = leaderboards.global_range(offset, limit)
+        usernames = get_usernames([user_id for user_id, points in ranked])
+        rows = [{'rank': offset + i + 1, 'user_id': user_id, 'username': usernames.get(user_id), 
+                'points': points} for i, (user_id, points) in enumerate(ranked)]
+    return jsonify({'offset': offset, 'limit': limit, 'rows': rows})
+
+@app.route('/rank.json')
+@query_budget(1)
+def user_rank():
+    """Global rank of a user (the session user by default), or their rank 
+    within a challenge when challenge_id is given"""
+    try:
+        user_id = request.args.get('user_id') or session.get('user_id')
+        user_id = int(user_id) if user_id else None
+        challenge_id = int(request.args['challenge_id']) if request.args.get('challenge_id') else None
+    except ValueError:
+        return jsonify({'error': 'user_id and challenge_id must be integers'}), 400
+    if not user_id:
+        return jsonify({'rank': None})
+    if challenge_id:
+        rank, points, num_ranked = leaderboards.challenge_rank(challenge_id, user_id)
+    else:
+        rank, points, num_ranked = leaderboards.global_rank(user_id)
+    return jsonify({'rank': rank, 'points': points, 'of': num_ranked})
+
+def get_matched_tags(user_challenge_ids):
+    """Returns {user challenge id: sorted list of tags it won on} in one query"""
+    matched = {user_challenge_id: [] for user_challenge_id in user_challenge_ids}
+    if matched:
+        rows = db.session.query(UserChallengeCategory.user_challenge_id, Category.tag).join(Category).filter(
+                            UserChallengeCategory.user_challenge_id.in_(matched)).order_by(Category.tag).all()
+        for user_challenge_id, tag in rows:
+            matched[user_challenge_id].append(tag)
+    return matched
+
+def build_challenge_page(challenge):
+    """Everything the challenge page needs in one dict: the challenge, its
+    attributes, completion stats, the leaderboard with matched tags and the
+    analytics graph. Costs a fixed number of queries however many winners."""
+    winners = leaderboard(challenge.id)
+    matched = get_matched_tags([winner.user_challenge_id for winner in winners])
+    return {
+        'challenge': {'id': challenge.id,
+                        'title': challenge.title,
+                        'description': challenge.description,
+                        'difficulty': challenge.difficulty,
+                        'image_path': challenge.image_path,
+                        'image_url': image_url(challenge.image_path)},
+        'attributes': sorted(get_challenge_tags(challenge.id).tags),
+        'completion': {'finished': challenge.num_completed,
+                        'unfinished': challenge.num_accepted - challenge.num_completed},
+        'leaderboard': [dict(winner._asdict(), matched=matched[winner.user_challenge_id]) 
+                        for winner in winners],
+        'analytics': challenge_graph.to_d3(),
+    }
 
 @app.route('/challenge/<id>')
+@query_budget(14)
 def challenge_details(id):
     """Renders that challenge details and analytics page"""
-    username = get_user_by_id(session['user_id']).username
-    challenge = db.session.query(Challenge, ChallengeCategory).filter(Challenge.id==id).join(ChallengeCategory).all()
-    winners = leaderboard(id)
-    print winners, "route print"
-    return render_template('challenge.html', challenge=challenge, username=username, winners=winners)
+    if is_session_active():
+        username = get_username(session['user_id'])
+    else:
+        username = ''
+    challenge = Challenge.query.options(undefer(Challenge.description)).get(id)
+    if not challenge:
+        return redirect('/challenges')
+    page = build_challenge_page(challenge)
+    challenge_status = get_challenges_status([challenge], session['user_id'])
+    rank = leaderboards.challenge_rank(challenge.id, session['user_id'])[0] if username else None
+    return render_template('challenge.html', challenge=challenge, username=username, 
+                            winners=page['leaderboard'], page=page, challenge_status=challenge_status,
+                            rank=rank, attempt_id=request.args.get('attempt_id', ''))
+
+@app.route('/challenge-page.json')
+@query_budget(10)
+def challenge_page():
+    """The challenge page payload (see build_challenge_page) as JSON"""
+    challenge = Challenge.query.options(undefer(Challenge.description)).get(request.args.get('challenge_id'))
+    if not challenge:
+        return jsonify({})
+    return jsonify(build_challenge_page(challenge))
 
 @app.route('/completion-stats.json')
+@query_budget(1)
 def get_completion_stats():
     """Generates a dictionary of data to be used by chart.js on challenge analytics
         page"""
     challenge_id = request.args.get('challenge_id')
-    query = UserChallenge.query.filter(UserChallenge.challenge_id==challenge_id)
-    finished = query.filter(UserChallenge.is_completed==True).count()
-    unfinished = query.filter(UserChallenge.is_completed==False).count()
+    counters = db.session.query(Challenge.num_accepted, 
+                                Challenge.num_completed).filter(Challenge.id==challenge_id).first()
+    accepted, finished = counters or (0, 0)
 
-    data = {'finished':int(finished), 'unfinished':int(unfinished)}
-    print data
+    data = {'finished':int(finished), 'unfinished':int(accepted - finished)}
     return jsonify(data)
 
 @app.route('/accept.json', methods=['POST'])
+@query_budget(2)
 def accept_challenge():
     """Called whenever a user clicks 'accept' on a challenge."""
     challenge_id = int(request.form.get('challenge_id'))
@@ -337,14 +654,16 @@ def accept_challenge():
                                         accepted_timestamp=datetime.now())
     db.session.add(accepted_challenge)
     try:
+        db.session.flush()
+        Challenge.query.filter(Challenge.id==challenge_id).update(
+            {Challenge.num_accepted: Challenge.num_accepted + 1}, synchronize_session=False)
         db.session.commit()
     except exc.IntegrityError:
         db.session.rollback()
-        print 'User has already accepted this challenge.'
+        app.logger.debug('User %s has already accepted challenge %s.', user_id, challenge_id)
         return ''
 
-    accepted_challenge = UserChallenge.query.filter(user_id==user_id, challenge_id==challenge_id)
-    return str(accepted_challenge.first().id)
+    return str(accepted_challenge.id)
 
 @app.route('/remove.json', methods=['POST'])
 def remove_challenge():
@@ -362,39 +681,98 @@ def calculate_score(hits, difficulty, attempts):
     score = (10 * difficulty/(attempts+1))*len(hits)
     return score
 
-def attempt_challenge(id, hits, filename):
+def attempt_challenge(id, hits, image_key, user_id=None, commit=True):
     """Updates the UserChallenge record with details of attempt 
-    returns UserChallenge object"""
+    returns UserChallenge object. user_id defaults to the user in session.
+    Pass commit=False to leave the update in the caller's transaction."""
 
-    user =  session['user_id']
-    update = UserChallenge.query.filter((UserChallenge.user_id==session['user_id'])&(UserChallenge.challenge_id==id)).first()
-    difficulty = Challenge.query.get(id).difficulty
+    if user_id is None:
+        user_id = session['user_id']
+    # Locked until the caller commits, so two queue workers scoring the same
+    # user and challenge can't both read the same attempts and score
+    update = (UserChallenge.query.filter((UserChallenge.user_id==user_id)&(UserChallenge.challenge_id==id))
+                .with_for_update().populate_existing().first())
+    difficulty = db.session.query(Challenge.difficulty).filter(Challenge.id==id).scalar()
 
+    counters = {Challenge.num_attempts: Challenge.num_attempts + 1}
     # empty set is false
     if hits:
+        if not update.is_completed:
+            counters[Challenge.num_completed] = Challenge.num_completed + 1
         score = calculate_score(hits, difficulty, update.attempts)
+        leaderboards.queue_score(user_id, id, update.points_earned if update.is_completed else 0, score)
         update.points_earned = score
         update.is_completed = True
-        update.image_path = filename
-        print filename +  ':filename'
+        update.image_path = image_key
         update.completed_timestamp = datetime.now()
     update.attempts += 1
-    db.session.commit()
+    Challenge.query.filter(Challenge.id==id).update(counters, synchronize_session=False)
+    if commit:
+        db.session.commit()
     return update
 
-def save_winning_hits(tag_set, user_challenge_id):
-    """Adds information relating UserChallenge to Category
-       At this point the categories must exist in Category to be mapped
+def save_winning_hits(tag_set, user_challenge_id, category_ids=None, commit=True):
+    """Adds information relating UserChallenge to Category in one insert.
+       At this point the categories must exist in Category to be mapped.
+       category_ids (tag -> category id) saves looking the tags up again, 
+       pass commit=False to leave the insert in the caller's transaction.
     """
-    for tag in tag_set:
-        # Get category id for hit
-        category = Category.query.filter(Category.tag==tag).first()
-        new_user_challenge_category = UserChallengeCategory(user_challenge_id=user_challenge_id,
-                                                            category_id=category.id)
-        db.session.add(new_user_challenge_category)
+    if category_ids is None:
+        category_ids = dict(db.session.query(Category.tag, Category.id).filter(Category.tag.in_(tag_set)).all())
+    insert_ignoring_duplicates(UserChallengeCategory, [{'user_challenge_id': user_challenge_id, 
+                                                        'category_id': category_ids[tag]}
+                                                        for tag in tag_set])
+    if commit:
         db.session.commit()
 
+def process_attempt(user_id, challenge_id, image_key, analysis_content=None):
+    """Analyzes an uploaded attempt and scores it. Shared by the /complete/<id>
+    route and the attempt queue workers. The score and the winning hits are
+    written in a single transaction. analysis_content is the preprocessed
+    analysis copy of the image, made from the stored image if not given.
+    Returns (outcome, user_challenge, hits) where outcome is one of 'scored',
+    'unsafe' (the image has been deleted) or 'unreadable'."""
+
+    if analysis_content is None:
+        try:
+            analysis_content = prepare_file(image_store.path(image_key)).analysis_content
+        except (UploadRejected, IOError):
+            return 'unreadable', None, set()
+    analysis = analyze_content(analysis_content, 5)
+    if not analysis:
+        return 'unreadable', None, set()
+    elif not analysis.safe:
+        remove_unused_image(image_key)
+        return 'unsafe', None, set()
+
+    challenge_tags = get_challenge_tags(challenge_id)
+
+    hits = challenge_tags.tags.intersection(analysis.tags)
+
+    user_challenge = attempt_challenge(challenge_id, hits, image_key, user_id, commit=False)
+
+    if len(hits) != 0:
+        save_winning_hits(hits, user_challenge.id, challenge_tags.category_ids, commit=False)
+    db.session.commit()
+    if hits:
+        rendition_pool.submit(image_store, image_key)
+    return 'scored', user_challenge, hits
+
+def process_queued_attempt(attempt):
+    """AttemptQueue handler, returns the columns to store on the Attempt"""
+    outcome, user_challenge, hits = process_attempt(attempt.user_id, 
+                                                    attempt.challenge_id, 
+                                                    attempt.image_path)
+    result = {'status': outcome}
+    if user_challenge:
+        result['points_earned'] = user_challenge.points_earned if hits else 0
+        result['hits'] = ','.join(sorted(hits))
+    return result
+
+attempt_queue = AttemptQueue(app, process_queued_attempt, workers=app.config['ATTEMPT_WORKERS'])
+
 @app.route('/complete/<id>', methods=['POST'])
+@query_budget(8)
 def complete_challenge(id):
     """Gets UserChallenge page for uncompleted challenge and allows user
         to complete"""
@@ -403,98 +781,76 @@ def complete_challenge(id):
         flash('No file selected')
         return redirect('/challenge/{}'.format(id))
     elif file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        filename = 'static/images/' + filename
-
-        if image_is_safe(filename):
-            tag_set = get_tags_for_image(filename, 5)
-            print tag_set
-            categories = ChallengeCategory.query.filter(ChallengeCategory.challenge_id==id).all()
-            winning_tags = {i.category.tag for i in categories}
-            
-            hits = winning_tags.intersection(tag_set)
-
-            user_challenge = attempt_challenge(id, hits, filename)
-
-            if len(hits) != 0:
-                save_winning_hits(hits, user_challenge.id)
+        try:
+            upload = prepare_upload(file.read())
+        except UploadRejected:
+            flash('That file is not an image. Please choose another and try again')
             return redirect('/challenge/{}'.format(id))
-        else:
-            os.remove(filename)
+        image_key = image_store.put(upload.content, upload.format)
+
+        if app.config['ASYNC_ATTEMPTS']:
+            attempt = attempt_queue.enqueue(session['user_id'], int(id), image_key)
+            if request.is_xhr:
+                return jsonify({'attempt_id': attempt.id})
+            flash('Your image is being analyzed')
+            return redirect('/challenge/{}?attempt_id={}'.format(id, attempt.id))
+
+        outcome, user_challenge, hits = process_attempt(session['user_id'], id, image_key,
+                                                        upload.analysis_content)
+        if outcome == 'unreadable':
+            flash("""We weren't able to analyze your image. Please 
+                choose another and try again""")
+        elif outcome == 'unsafe':
             flash('Try another image')
-            return redirect('/challenge/{}'.format(id))
+        return redirect('/challenge/{}'.format(id))
+
+@app.route('/attempt-status.json')
+@query_budget(1)
+def attempt_status():
+    """Reports how far along a queued attempt is. Only the user who uploaded
+    the attempt can see it."""
+    attempt = Attempt.query.get(request.args.get('attempt_id'))
+    if not attempt or attempt.user_id != session.get('user_id'):
+        return jsonify({'status': 'unknown', 'finished': True})
+    return jsonify({'attempt_id': attempt.id,
+                    'challenge_id': attempt.challenge_id,
+                    'status': attempt.status,
+                    'finished': attempt.status in FINISHED_STATUSES,
+                    'points_earned': attempt.points_earned,
+                    'hits': attempt.hits.split(',') if attempt.hits else []})
 
 @app.route('/matched_attributes.json')
+@query_budget(1)
 def matched_attributes():
     """Using challenge id and user_id from the session, get all attributes that
     matched for that user to complete the challenge"""
-    user_challenge_id = request.args.get('user_challenge_id')
-    categories = UserChallengeCategory.query.filter(UserChallengeCategory.user_challenge_id==user_challenge_id).all()
-    winning_tags_to_display = {i.category.tag for i in categories}
+    user_challenge_id = int(request.args.get('user_challenge_id'))
+    winning_tags_to_display = get_matched_tags([user_challenge_id])[user_challenge_id]
     dict = {}
     for tag in winning_tags_to_display:
         dict.setdefault(tag, 0)
     return jsonify(dict)
 
 @app.route('/challenge_attributes.json')
+@query_budget(1)
 def challenge_attributes():
     """Returns a dict of all challenge attributes for analytics page"""
     challenge_id = request.args.get('challenge_id')
-    categories = ChallengeCategory.query.filter(ChallengeCategory.challenge_id==challenge_id).all()
-    tags_to_display = [i.category.tag for i in categories]
-    print tags_to_display
+    tags_to_display = get_challenge_tags(challenge_id).tags
     dict = {}
     for tag in tags_to_display:
         dict.setdefault(tag, 0)
     return jsonify(dict)
 
-def make_d3_nodes():
-    """Create individual dictionaries for each challenge
-        >>> make_d3_nodes()
-        [{u'Bridge': 1}, {u'Bird': 2}]
-    """
-    # get all challenge objects
-    challenges = Challenge.query.all()
-    # make the challenge nodes
-    nodes_list = []
-    i = 0
-    for challenge in challenges:
-        node = {"id": challenge.title, "group": i+1}
-        # node.setdefault(challenge.title, i+1)
-        nodes_list.append(node)
-        i += 1
-    return nodes_list
-
-def make_d3_links():
-    """create the individual dictionaries for each link betweek categories
-
-    """
-    # get all challenge categories in order of challenge id
-    challege_categories = db.session.query(ChallengeCategory).order_by(ChallengeCategory.category_id).all()
-    links_list = []
-    for i in range(len(challege_categories) - 1):
-        if challege_categories[i].category_id == challege_categories[i + 1].category_id:
-            link = {"source": challege_categories[i].challenge.title,
-                    "target": challege_categories[i + 1].challenge.title,
-                    "value": challege_categories[i].category.tag
-                    }
-            links_list.append(link)
-        i += 1
-    return links_list
+challenge_graph = ChallengeGraph(max_edges_per_node=app.config['GRAPH_MAX_EDGES_PER_NODE'])
 
 @app.route('/challenge_analytics.json')
+@query_budget(3)
 def challenge_analytics():
     """Returns information to resolve D3 diagram that shows the relationship
-                between challenges by keywords they have in common"""
-    node_values = make_d3_nodes()
-    link_values = make_d3_links()
-
-    d3_dict = {"nodes": node_values, "links": link_values}
-
-    print d3_dict
-
-    return jsonify(d3_dict)
+                between challenges by keywords they have in common. Links are
+                weighted by the number of tags two challenges share."""
+    return jsonify(challenge_graph.to_d3())
 
 @app.route('/send-feedback')
 def send_feedback():
@@ -525,6 +881,9 @@ if __name__ == "__main__":
     connect_to_db(app, 'postgres:///nerve')
     # db.create_all()
 
+    if app.config['ASYNC_ATTEMPTS']:
+        attempt_queue.start()
+
     # make sure templates, etc. are not cached in debug mode
     # app.jinja_env.auto_reload = app.debug
 
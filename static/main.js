@@ -13,63 +13,108 @@
 // Accept button IIFE (Works both on challenge list and challenge details page)
 (function (){
 
-    function getNumPlayers(){
-    var that = this;
-    $.get('/num-players.json', {'challenge_id':$(this).attr('data-challenge_id')},
-      function(result){
-        $(that).text(result);
-      }
-    );
-  };
-
-  $('.num-players').each(getNumPlayers);
-
   function toggleAccepted(button){
     // accept-btn > span
-    // console.log(button);
     $(button).prop('disabled', true);
     $(button).children().removeClass('glyphicon-plus');
     $(button).children().addClass('glyphicon-ok');
     $(button).children().addClass('ok-accepted');
-
-    // console.log("called toggleAccepted");
   }
 
   function toggleCompleted(button){
-    // console.log(button);
     $(button).prop('disabled', true);
     $(button).children().removeClass('glyphicon-plus');
     $(button).children().addClass('glyphicon-ok');
     $(button).children().addClass('ok-finished');
-    // console.log("called toggleCompleted");
+  }
 
+  // results maps challenge id -> {'players': n, 'status': 'accepted'/'completed'/''}
+  function applyStatus(results){
+    $('.num-players').each(function(){
+      var challenge = results[$(this).attr('data-challenge_id')];
+      if (challenge){
+        $(this).text(challenge['players']);
+      }
+    });
+    $('.accept-btn').each(function(){
+      var challenge = results[$(this).attr('data-challenge_id')];
+      if (challenge && challenge['status'] == 'accepted'){
+        toggleAccepted(this);
+      }
+      else if (challenge && challenge['status'] == 'completed'){
+        toggleCompleted(this);
+      }
+    });
   }
 
-  function isCompleted(){
-    var that = this;
-    $.get('/is_completed.json', {'challenge_id':$(this).attr('data-challenge_id')},
-      function (results){
-        // console.log(results);
-        // console.log($(this).attr('data-challenge_id'));
-        if (results['status'] == 'accepted'){
-          toggleAccepted(that); 
-        }
-        else if (results['status'] == 'completed'){
-          toggleCompleted(that);
-        }
+  // One request covers every challenge on the page
+  function refreshStatus(){
+    var ids = {};
+    $('.num-players, .accept-btn').each(function(){
+      ids[$(this).attr('data-challenge_id')] = true;
+    });
+    var challengeIds = Object.keys(ids);
+    if (challengeIds.length == 0){
+      return;
+    }
+    $.get('/challenges-status.json', {'challenge_ids': challengeIds.join(',')},
+      function(results){
+        applyStatus(results['challenges']);
+      }
+    );
+  }
 
-      } );
+  // The challenge page and each batch of listing cards embed the status 
+  // payload, other pages ask for it
+  if (typeof challengeStatus !== 'undefined'){
+    applyStatus(challengeStatus);
+  }
+  else if ($('.challenge-cards').length){
+    $('.challenge-cards').each(function(){
+      applyStatus($(this).data('status'));
+    });
+  }
+  else {
+    refreshStatus();
   }
 
-  $('.accept-btn').each(isCompleted);
-  $('.accept-btn').on('click', function(e) {
+  // Infinite scroll: fetch the next batch of cards when the "More" link
+  // comes into view (or is clicked)
+  var loadingMore = false;
+  function loadMore(e){
+    if (e){
+      e.preventDefault();
+    }
+    var link = $('.more-link');
+    if (loadingMore || link.length == 0){
+      return;
+    }
+    loadingMore = true;
+    $.get(link.attr('href') + '&partial=1', function(html){
+      var batch = $(html);
+      link.replaceWith(batch);
+      batch.filter('.challenge-cards').each(function(){
+        applyStatus($(this).data('status'));
+      });
+      loadingMore = false;
+    });
+  }
+  $(document).on('click', '.more-link', loadMore);
+  $(window).on('scroll', function(){
+    var link = $('.more-link');
+    if (link.length && link.offset().top < $(window).scrollTop() + $(window).height() + 200){
+      loadMore();
+    }
+  });
+
+  $(document).on('click', '.accept-btn', function(e) {
     e.preventDefault();
 
     var btn = $(this);
     $.post('/accept.json', {'challenge_id':btn.attr('data-challenge_id')}, 
       function (results){ 
         toggleAccepted(btn);
-        $('.num-players').each(getNumPlayers); 
+        refreshStatus();
       } );
   });
 
@@ -180,21 +225,49 @@
 
 })();
 
-// get tags for challenge (challenge view)
+// Tags for the challenge (challenge view)
 (function(){
+  if (typeof challengePage === 'undefined'){
+    return;
+  }
 
-$.get('/challenge_attributes.json', {'challenge_id':$('.challenge-attributes').attr('data-challenge_id')}, 
-  function(results){
-    // console.log(results, "challenge_attributes");
-    $.each(results, function(key){
-      // console.log(key);
-      $('.challenge-attributes').append('<li>' + key + '</li>');
-      
-    });
+  $.each(challengePage.attributes, function(i, tag){
+    $('.challenge-attributes').append('<li>' + tag + '</li>');
   });
 
 })();
 
+// Poll a queued attempt until a worker has scored it (challenge view)
+(function(){
+  var statusMessages = {
+    'scored': 'Your attempt has been scored!',
+    'unsafe': 'Try another image',
+    'unreadable': "We weren't able to analyze your image. Please choose another and try again",
+    'failed': 'Something went wrong analyzing your image. Please try again',
+    'unknown': ''
+  };
+
+  function pollAttempt(){
+    var that = this;
+    $.get('/attempt-status.json', {'attempt_id':$(this).attr('data-attempt_id')},
+      function(result){
+        if (!result['finished']){
+          setTimeout(function(){ pollAttempt.call(that); }, 1000);
+        }
+        else if (result['status'] == 'scored'){
+          // Reload without the attempt id to show the updated leaderboard
+          window.location = '/challenge/' + result['challenge_id'];
+        }
+        else {
+          $(that).text(statusMessages[result['status']]);
+        }
+      }
+    );
+  };
+  $('.attempt-status').each(pollAttempt);
+
+})();
+
 // Cool stuff down here
 $(document).on('keydown', function(e){
     console.log(e.keyCode);
@@ -245,7 +318,9 @@ $(document).on('keydown', function(e){
 //   }
 
 //   $.get('/challenge_attributes.json', {'challenge_id':challenge_id}, makeCategoriesChart);
-  $.get('/completion-stats.json', {'challenge_id':challenge_id}, makeChart);
+  if (typeof challengePage !== 'undefined'){
+    makeChart(challengePage.completion);
+  }
 
 })();
 
@@ -0,0 +1,89 @@
+"""Content addressed image storage for nerve
+
+Uploads are stored under the sha256 of their bytes, so two users uploading
+IMG_0001.jpg no longer overwrite each other and identical uploads are kept
+once. The key, e.g. '3f2a...9c.jpg', is what image_path columns hold and the
+file lives two directory levels down, at ROOT/3f/2a/3f2a...9c.jpg, so no
+directory ends up with more than a few thousand files. Files are written to a
+temporary name in their shard and renamed into place, so a reader never sees
+half an image.
+
+image_path values from before the store existed are paths such as
+'static/images/butter.png'. Keys never contain a '/', so those keep working
+with path() and url().
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+# File extensions for the formats preprocess.sniff_image_type reports
+EXTENSIONS = {'jpeg': 'jpg', 'tiff': 'tif'}
+FILE_MODE = 0644
+
+
+def is_legacy(key):
+    return '/' in key
+
+
+class ImageStore(object):
+    """Images under root, served from url_prefix"""
+
+    def __init__(self, root, url_prefix):
+        self.root = root
+        self.url_prefix = url_prefix.rstrip('/')
+
+    @staticmethod
+    def key_for(content, image_format):
+        return '{}.{}'.format(hashlib.sha256(content).hexdigest(), EXTENSIONS.get(image_format, image_format))
+
+    def path(self, key):
+        if is_legacy(key):
+            return key.lstrip('/')
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def url(self, key):
+        if is_legacy(key):
+            return '/' + key.lstrip('/')
+        return '/'.join([self.url_prefix, key[:2], key[2:4], key])
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, content, image_format):
+        """Stores content unless an identical image is already stored,
+        returns its key"""
+        key = self.key_for(content, image_format)
+        if not self.exists(key):
+            self.write(key, content)
+        return key
+
+    def write(self, key, content):
+        """Atomically writes content under key, replacing what was there"""
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(descriptor, 'wb') as output:
+                output.write(content)
+                output.flush()
+                os.fsync(output.fileno())
+            os.chmod(temporary, FILE_MODE)
+            os.rename(temporary, path)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+    def delete(self, key):
+        """Removes a stored image, callers check that nothing refers to it"""
+        try:
+            os.remove(self.path(key))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
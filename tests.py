@@ -1,30 +1,162 @@
 import unittest
-import sys, os, io
+import sys, os, io, hashlib, json, random, shutil, tempfile, time
 
 # uncomment below when ready to test server
 from server import app
 from StringIO import StringIO 
 
 from model import User, UserChallenge, Challenge, ChallengeCategory, Category, db, example_data, connect_to_db, init_app
+from model import UserChallengeCategory, Attempt
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+import datetime
+import migrations
+import model
+import seed
+import benchmark
+import import_challenges
+import metrics
+import preprocess
 # from server import get_user_by_username, get_profile_page_info, post_categories, post_challenge, post_challenge_categories, post_user, allowed_file
 import server
-class NerveTestsServerHelperFunctinos(unittest.TestCase):
-    """Make sure the helper functions in the server work"""
+import vision
+import attempts
+from attempts import AttemptQueue
+from cache import LRUCache
+from leaderboard import RankedScores
+from PIL import Image
+from flask import render_template_string
+from storage import ImageStore
+import renditions
+
+
+# postgresql:///test_nerve by default. {pid} is replaced by the process id so
+# parallel runs each get their own database, e.g.
+#   NERVE_TEST_DATABASE_URI='postgresql:///test_nerve_{pid}'
+# The server helper tests also run on SQLite 3.35+ in memory:
+#   NERVE_TEST_DATABASE_URI=sqlite://
+TEST_DATABASE_URI = os.environ.get('NERVE_TEST_DATABASE_URI', 'postgresql:///test_nerve').format(pid=os.getpid())
+IS_POSTGRES = TEST_DATABASE_URI.startswith('postgres')
+VISION_CACHE_DIR = tempfile.mkdtemp()
+IMAGE_STORE_DIR = tempfile.mkdtemp()
+
+
+def make_image(size, image_format, orientation=None):
+    """Encoded bytes of a solid image, optionally with an EXIF orientation"""
+    output = io.BytesIO()
+    options = {}
+    if orientation:
+        exif = Image.Exif()
+        exif[preprocess.EXIF_ORIENTATION] = orientation
+        options['exif'] = exif.tobytes()
+    Image.new('RGB', size, (200, 120, 40)).save(output, image_format, **options)
+    return output.getvalue()
+
+
+def stored_images():
+    """Every original image in the test image store, leaving out renditions
+    the background pool may still be writing"""
+    return sorted(name for directory, subdirectories, names in os.walk(IMAGE_STORE_DIR) for name in names
+                    if name.count('.') == 1 and not name.startswith('.'))
+
+
+class recorded_statements(object):
+    """Context manager collecting (statement, parameters) for every query
+    the engine runs, leaving out the SAVEPOINTs the test harness adds"""
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self.statements
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+            self.statements.append((statement, parameters))
+
+
+def setUpModule():
+    """Creates the schema and example data once for the whole run, and
+    points Vision at the offline backend"""
+    if IS_POSTGRES:
+        database = make_url(TEST_DATABASE_URI).database
+        os.system('dropdb --if-exists {0} && createdb {0}'.format(database))
+    connect_to_db(app, TEST_DATABASE_URI)
+    if db.engine.dialect.name == 'sqlite':
+        # pysqlite's own transaction handling breaks SAVEPOINTs
+        @event.listens_for(db.engine, 'connect')
+        def sqlite_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+            dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+        @event.listens_for(db.engine, 'begin')
+        def sqlite_begin(connection):
+            connection.execute('BEGIN')
+    db.create_all()
+    example_data()
+    migrations.stamp()
+    db.session.remove()
+    vision.set_backend(vision.LocalVisionBackend())
+    vision.result_cache = vision.VisionResultCache(VISION_CACHE_DIR)
+    server.image_store = ImageStore(IMAGE_STORE_DIR, '/static/images')
+
+
+def tearDownModule():
+    db.session.remove()
+    if IS_POSTGRES and '{pid}' in os.environ.get('NERVE_TEST_DATABASE_URI', ''):
+        db.engine.dispose()
+        os.system('dropdb {}'.format(make_url(TEST_DATABASE_URI).database))
+    vision.set_backend(None)
+    server.rendition_pool.shutdown()
+    shutil.rmtree(VISION_CACHE_DIR)
+    shutil.rmtree(IMAGE_STORE_DIR)
+
+
+def reset_caches():
+    """Forget in-process state built from the database of the last test"""
+    server.challenge_tags_cache.clear()
+    server.challenge_graph.invalidate()
+    server.leaderboards.invalidate()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Runs each test inside a transaction that is rolled back afterwards, so
+    the schema and example_data() are only built once per run. A commit in
+    the code under test releases a SAVEPOINT and starts the next one, and a
+    rollback only goes back to the last SAVEPOINT."""
 
     def setUp(self):
-        """Set testing to true, import functions from server"""
-        
         self.client = app.test_client()
         app.config['TESTING'] = True
-        connect_to_db(app, 'postgresql:///test_nerve')
-        db.create_all()
-        example_data()
+        self.app_session = db.session
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = scoped_session(sessionmaker(bind=self.connection))
+        # The app removes its session after every request, keep this one
+        self.session.remove = lambda: None
+        self.session.begin_nested()
+
+        @event.listens_for(self.session(), 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        db.session = self.session
 
     def tearDown(self):
-        """Runs at the end of every test."""
+        db.session = self.app_session
+        self.session.close()
+        self.transaction.rollback()
+        self.connection.close()
+        reset_caches()
 
-        db.session.close()
-        db.drop_all()
+
+class NerveTestsServerHelperFunctinos(DatabaseTestCase):
+    """Make sure the helper functions in the server work"""
 
     def test_get_user_by_username(self):
         """should return none for non-users, get user_id for users"""
@@ -58,6 +190,76 @@ class NerveTestsServerHelperFunctinos(unittest.TestCase):
         cc_count = db.session.query(ChallengeCategory).filter(ChallengeCategory.challenge_id==100).count()
         self.assertEqual(cc_count, 0, 'Records for invalid Challenge added to ChallengeCategory table. Violated foreign key constraint.')
 
+    def test_post_challenge_categories_bulk(self):
+        """Does a mix of existing, new and repeated tags produce exactly one
+        relation per tag, even when posted twice"""
+        test_tag_list = [u'art', u'cartoon', u'snail', u'snail', u'slug']
+        category_ids = server.post_challenge_categories(test_tag_list, 1)
+        server.post_challenge_categories(test_tag_list, 1)
+        self.assertEqual(sorted(category_ids), [u'art', u'cartoon', u'slug', u'snail'])
+        cc_count = db.session.query(ChallengeCategory).filter(ChallengeCategory.challenge_id==1).count()
+        self.assertEqual(cc_count, 6, 'Expected the 4 example relations plus snail and slug.')
+        snail_count = db.session.query(Category).filter(Category.tag==u'snail').count()
+        self.assertEqual(snail_count, 1, 'Duplicate records were added to Category table.')
+
+    def test_challenge_tags_cache_invalidated(self):
+        """Posting categories for a challenge should drop its cached tags"""
+        self.assertEqual(server.get_challenge_tags(2).tags, 
+                        frozenset([u'text', u'cartoon', u'font', u'games']))
+        server.post_challenge_categories([u'snail'], 2)
+        challenge_tags = server.get_challenge_tags(2)
+        self.assertIn(u'snail', challenge_tags.tags, 'Stale tags were served from the cache.')
+        self.assertIn(u'snail', challenge_tags.category_ids)
+
+    def test_empty_challenge_tags_not_cached(self):
+        """Categories committed by another worker after an empty lookup show
+        up without any invalidation in this process"""
+        challenge_id = server.post_challenge('Untagged', 'No tags yet', 1, 'untagged.jpg')
+        self.assertEqual(server.get_challenge_tags(challenge_id).tags, frozenset())
+        snail = Category(tag=u'snail')
+        db.session.add(snail)
+        db.session.flush()
+        db.session.add(ChallengeCategory(challenge_id=challenge_id, category_id=snail.id))
+        db.session.commit()
+        self.assertEqual(server.get_challenge_tags(challenge_id).tags, frozenset([u'snail']))
+
+    def test_challenge_graph_incremental(self):
+        """Are link weights the number of shared tags, and does posting
+        categories update them without a reload"""
+        graph = server.challenge_graph
+        self.assertEqual(graph.to_d3()['links'], [{'source': 1, 'target': 2, 'value': 1}])
+        server.post_challenge_categories([u'art', u'machine'], 2)
+        self.assertEqual(graph.to_d3()['links'], [{'source': 1, 'target': 2, 'value': 3}])
+        graph.load()
+        self.assertEqual(graph.to_d3()['links'], [{'source': 1, 'target': 2, 'value': 3}])
+
+    def test_challenges_keyset_pagination(self):
+        """Does each page pick up after the previous page's cursor"""
+        first_page, cursor = server.get_challenges_page(limit=1)
+        self.assertEqual([challenge.id for challenge in first_page], [1], 'Hardest challenge was not first.')
+        self.assertEqual(cursor, '5_1')
+        second_page, cursor = server.get_challenges_page(cursor, limit=1)
+        self.assertEqual([challenge.id for challenge in second_page], [2])
+        self.assertEqual(cursor, None, 'Last page should not have a next cursor.')
+
+    def test_profile_keyset_pagination(self):
+        """Are a user's challenges paged newest accepted first"""
+        first_page, cursor = server.get_profile_page_info(6, limit=1)
+        self.assertEqual(first_page[0].Challenge.id, 2)
+        second_page, cursor = server.get_profile_page_info(6, cursor, limit=1)
+        self.assertEqual(second_page[0].Challenge.id, 1)
+        self.assertEqual(cursor, None)
+
+    def test_read_helpers(self):
+        """Do the read helpers return plain rows instead of entities"""
+        self.assertEqual(server.get_username(1), 'Shmlony')
+        self.assertEqual(server.get_user_id('Shmlony'), 1)
+        self.assertEqual(server.get_user_id('Jeffry'), None)
+        challenges, cursor = server.get_challenges_page()
+        self.assertTrue(all(isinstance(challenge, server.ChallengeCard) for challenge in challenges))
+        self.assertEqual(challenges[0].description,
+                        'Build an unnecessarily complex robot to do a simple task')
+
     def test_post_challenge(self):
         """Does the post challenge function add challenge to the db"""
         title = 'Oh Hello' 
@@ -87,41 +289,41 @@ class NerveTestsServerHelperFunctinos(unittest.TestCase):
         self.assertTrue(server.allowed_file('cat.cat.cat.png'), 'Files with multiple . should be considered valid')
         self.assertTrue(server.allowed_file('hi.JPG'), 'File hi.JPG should be recognized as valid.')
         self.assertFalse(server.allowed_file('nope.txt'), '.txt files are not valid input.')
+        self.assertFalse(server.allowed_file('photo.raw'), 'RAW files can not be preprocessed.')
+        self.assertTrue(server.allowed_file('photo.webp') and server.allowed_file('scan.tiff'))
+
+    def test_allowed_extensions_match_sniffed_formats(self):
+        """Every format the upload sniffing recognizes can be uploaded, and
+        nothing else"""
+        sniffed = set(image_format for image_format, magic in preprocess.MAGIC_BYTES) | set(['webp'])
+        self.assertEqual(set(preprocess.FORMAT_EXTENSIONS), sniffed)
+        self.assertEqual(server.ALLOWED_EXTENSIONS, set(extension for extensions in
+                                                    preprocess.FORMAT_EXTENSIONS.values() for extension in extensions))
 
 
-class NerveTestsRegistration(unittest.TestCase):
+class NerveTestsRegistration(DatabaseTestCase):
     """Do post requests to create new users/ accept challenges/ create new challenges
     sucessfully create records in the db"""
 
     def setUp(self):
         """Runs before every test."""
 
-        self.client = app.test_client()
-        app.config['TESTING'] = True
-
-        # test_nerve is the name of the test database
-        # connect_to_db comes from model.py
+        super(NerveTestsRegistration, self).setUp()
 
-        connect_to_db(app, 'postgresql:///test_nerve')
+        def _mock_analyze_content(content, x):
+            self.analyzed.append(content)
+            tags = [u'snails and slugs', u'snail', u'invertebrate', u'fauna', u'insect', u'macro photography', u'molluscs', u'slug']
+            return vision.ImageAnalysis(safe=True, tags=tags[:x], key='snails')
 
-        def _mock_image_is_safe(photo_file):
-            return True
-
-        def _mock_get_tags_for_image(photo_file, x):
-            return [u'snails and slugs', u'snail', u'invertebrate', u'fauna', u'insect', u'macro photography', u'molluscs', u'slug']
-
-        server.image_is_safe = _mock_image_is_safe
-        server.get_tags_for_image = _mock_get_tags_for_image
-
-        # Create tables and adds sample data
-        db.create_all()
-        example_data()
+        self.analyzed = []
+        self.analyze_content = server.analyze_content
+        server.analyze_content = _mock_analyze_content
 
     def tearDown(self):
         """Runs at the end of every test."""
 
-        db.session.close()
-        db.drop_all()
+        server.analyze_content = self.analyze_content
+        super(NerveTestsRegistration, self).tearDown()
 
     def test_create_user(self):
         """Is registration sucessful
@@ -150,7 +352,7 @@ class NerveTestsRegistration(unittest.TestCase):
                                   data={'title': 'Cinnamon Challenge',
                                         'description': 'Eat a whole spoonful of cinnamon',
                                         'difficulty': '3',
-                                        'file': (io.BytesIO(b'test'), 'test_file.jpg')},
+                                        'file': (io.BytesIO(make_image((2000, 1000), 'JPEG')), 'test_file.jpg')},
                                   follow_redirects=True)
         self.assertNotIn('Title', result.data, 'Challenge detail page did not load, still on input form page.')
         self.assertNotIn('Welcome', result.data, 'Challenge detail page did not load, redirected to homepage.')
@@ -159,36 +361,158 @@ class NerveTestsRegistration(unittest.TestCase):
         self.assertEqual(new_challenge_obj.description, 
                         'Eat a whole spoonful of cinnamon', 
                         'Challenge record was not sucessfully created')
+        self.assertEqual(Image.open(io.BytesIO(self.analyzed[0])).size, (1024, 512),
+                        'Vision was not sent the downscaled analysis copy.')
+        self.assertTrue(server.image_store.exists(new_challenge_obj.image_path),
+                        'Challenge image_path is not a key in the image store.')
+
+    def test_create_challenge_with_a_duplicate_title(self):
+        """Tags go to the challenge just created, not an older one that has
+        the same title"""
+        older = db.session.query(Challenge.id).filter(Challenge.title=='Existential Crisis').first()[0]
+        result = self.client.post('/create', content_type='multipart/form-data',
+                                  data={'title': 'existential crisis',
+                                        'description': 'The same title again',
+                                        'difficulty': '2',
+                                        'file': (io.BytesIO(make_image((40, 30), 'PNG')), 'again.png')})
+        newest = db.session.query(Challenge.id).order_by(Challenge.id.desc()).first()[0]
+        self.assertNotEqual(newest, older)
+        self.assertTrue(result.location.endswith('/challenge/{}'.format(newest)), result.location)
+        tagged = db.session.query(ChallengeCategory.challenge_id).filter(
+                    ChallengeCategory.challenge_id.in_([older, newest])).distinct().all()
+        self.assertIn((newest,), tagged, 'The new challenge got no tags.')
+
+    def test_create_challenge_rejects_non_images(self):
+        """Uploads that aren't images never reach the Vision API or the disk"""
+
+        before = stored_images()
+        result = self.client.post('/create', content_type='multipart/form-data',
+                                  data={'title': 'Not An Image',
+                                        'description': 'A text file in disguise',
+                                        'difficulty': '1',
+                                        'file': (io.BytesIO(b'just some text'), 'not_an_image.jpg')},
+                                  follow_redirects=True)
+        self.assertIn('not an image', result.data)
+        self.assertEqual(self.analyzed, [])
+        self.assertEqual(stored_images(), before)
+        self.assertIsNone(db.session.query(Challenge).filter(Challenge.title=='Not An Image').first())
+
+    def test_unsafe_attempt_is_removed(self):
+        """An unsafe /complete/<id> upload is deleted from the image store and
+        not recorded"""
+        with self.client as c:
+            with c.session_transaction() as s:
+                s['active'] = True
+                s['user_id'] = 1
+        self.client.post('/accept.json', data={'challenge_id': '2'})
+        server.analyze_content = lambda content, x: vision.ImageAnalysis(safe=False, tags=[], key='unsafe')
+
+        before = stored_images()
+        result = self.client.post('/complete/2', content_type='multipart/form-data',
+                                  data={'file': (io.BytesIO(make_image((50, 60), 'PNG')), 'unsafe.png')},
+                                  follow_redirects=True)
+        self.assertIn('Try another image', result.data)
+        self.assertEqual(stored_images(), before)
+        user_challenge = db.session.query(UserChallenge).filter((UserChallenge.user_id==1)&(UserChallenge.challenge_id==2)).one()
+        self.assertFalse(user_challenge.is_completed)
 
     def test_accept_challenge(self):
-        """Does accepting a challenge add the correct record to UserChallenge"""
-        pass
+        """Does accepting a challenge add the correct record to UserChallenge
+        and bump the challenge's participation counter exactly once"""
+        with self.client as c:
+            with c.session_transaction() as s:
+                s['active'] = True
+                s['user_id'] = 1
 
+        result = self.client.post('/accept.json', data={'challenge_id': '2'})
+        new_user_challenge = db.session.query(UserChallenge).filter((UserChallenge.user_id==1)&(UserChallenge.challenge_id==2)).one()
+        self.assertEqual(result.data, str(new_user_challenge.id), 'Route did not return the new UserChallenge id.')
+        self.client.post('/accept.json', data={'challenge_id': '2'})
+        result = self.client.get('/num-players.json?challenge_id=2')
+        self.assertEqual(result.data, '5', 'Participation counter did not match user_challenges.')
 
-class NerveTestsDatabaseQueries(unittest.TestCase):
+
+class NerveTestsDatabaseQueries(DatabaseTestCase):
     """Tests that query the database
     TODO: test for pagination when user has many challenges"""
 
-    def setUp(self):
-        """Runs before every test."""
-
-        self.client = app.test_client()
-        app.config['TESTING'] = True
-
-        # test_nerve is the name of the test database
-        # connect_to_db comes from model.py
-
-        connect_to_db(app, 'postgresql:///test_nerve')
-
-        # Create tables and adds sample data
-        db.create_all()
-        example_data()
-
-    def tearDown(self):
-        """Runs at the end of every test."""
-
-        db.session.close()
-        db.drop_all()
+    def test_challenge_ranking_refreshes(self):
+        """Scores written by another process show up once the cached
+        ranking is older than refresh_after"""
+        leaderboards = server.leaderboards
+        before = leaderboards.challenge_rank(2, 4)
+        # Not through queue_score, as if another process had scored it
+        UserChallenge.query.filter((UserChallenge.user_id==4)&(UserChallenge.challenge_id==2)).update(
+            {'points_earned': 1000}, synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(leaderboards.challenge_rank(2, 4), before)
+        refresh_after = leaderboards.refresh_after
+        leaderboards.refresh_after = -1
+        try:
+            self.assertEqual(leaderboards.challenge_rank(2, 4)[:2], (1, 1000))
+        finally:
+            leaderboards.refresh_after = refresh_after
+
+    def test_scoring_an_attempt_saves_hits_in_one_insert(self):
+        """process_attempt records every winning hit with a single insert in
+        the same transaction as the score"""
+        now = datetime.datetime.now()
+        db.session.add(UserChallenge(user_id=1, challenge_id=2, accepted_timestamp=now))
+        db.session.commit()
+        challenge_tags = server.get_challenge_tags(2)
+        hits = set(sorted(challenge_tags.tags)[:3])
+        real_analyze_content = server.analyze_content
+        server.analyze_content = lambda content, x: vision.ImageAnalysis(safe=True, tags=list(hits) + [u'unrelated'],
+                                                                        key='hits')
+        key = server.image_store.put(make_image((30, 30), 'PNG'), 'png')
+        try:
+            with recorded_statements() as statements:
+                outcome, user_challenge, scored_hits = server.process_attempt(1, 2, key, b'analysis copy')
+        finally:
+            server.analyze_content = real_analyze_content
+
+        self.assertEqual((outcome, scored_hits), ('scored', hits))
+        saved = db.session.query(UserChallengeCategory.category_id).filter(
+                    UserChallengeCategory.user_challenge_id==user_challenge.id).all()
+        self.assertEqual(set(category_id for (category_id,) in saved),
+                        set(challenge_tags.category_ids[tag] for tag in hits))
+        inserts = [statement for statement, parameters in statements
+                    if statement.lstrip().upper().startswith('INSERT INTO USER_CHALLENGE_CATEGORIES')]
+        self.assertEqual(len(inserts), 1, 'Winning hits were not saved in one insert.')
+        # Lock and read the UserChallenge, read the difficulty, bump the
+        # challenge counters, write the score, insert the hits
+        self.assertLessEqual(len(statements), 5, '\n'.join(statement for statement, parameters in statements))
+
+    def test_reconcile_counters(self):
+        """Corrupted participation counters are rebuilt from user_challenges,
+        by reconcile_challenge_counters and `python model.py reconcile-counters`"""
+        def counters():
+            return db.session.query(Challenge.id, Challenge.num_accepted, Challenge.num_completed,
+                                    Challenge.num_attempts).order_by(Challenge.id).all()
+
+        def expected(challenge_id):
+            rows = UserChallenge.query.filter(UserChallenge.challenge_id==challenge_id).all()
+            return (challenge_id, len(rows), len([row for row in rows if row.is_completed]),
+                    sum(row.attempts for row in rows))
+
+        for reconcile in (model.reconcile_challenge_counters, lambda: model.run_command('reconcile-counters')):
+            Challenge.query.update({'num_accepted': 99, 'num_completed': -1, 'num_attempts': 7},
+                                    synchronize_session=False)
+            db.session.commit()
+            reconcile()
+            self.assertEqual(counters(), [expected(challenge_id) for challenge_id, _, _, _ in counters()])
+            self.assertNotEqual(counters()[0][1:], (99, -1, 7))
+
+    def test_leaderboard_rejects_bad_parameters(self):
+        for query in ('offset=abc', 'limit=x', 'challenge_id=two'):
+            result = self.client.get('/leaderboard.json?' + query)
+            self.assertEqual(result.status_code, 400, query)
+
+    def test_rank_rejects_bad_parameters(self):
+        for query in ('user_id=abc', 'user_id=1&challenge_id=two', 'challenge_id=1.5&user_id=1'):
+            result = self.client.get('/rank.json?' + query)
+            self.assertEqual(result.status_code, 400, query)
+        self.assertEqual(json.loads(self.client.get('/rank.json?challenge_id=1').data), {'rank': None})
 
     def test_redirect_from_id(self):
         """ Redirect through /profile/id/<user_id>
@@ -304,6 +628,51 @@ class NerveTestsDatabaseQueries(unittest.TestCase):
             self.assertIn('View', result.data, 'Logged in user not provided option to navigate to challenge details')        
             self.assertNotIn('Log In', result.data, 'Logged in user presented with option to log in.')
 
+    def test_challenges_status_bulk(self):
+        """Does one request return player counts and the user's state for
+        every requested challenge"""
+        with self.client as c:
+            with c.session_transaction() as s:
+                s['active'] = True
+                s['user_id'] = 4
+
+        result = self.client.get('/challenges-status.json?challenge_ids=1,2')
+        challenges = json.loads(result.data)['challenges']
+        self.assertEqual(challenges['1'], {'players': 4, 'status': 'accepted'})
+        self.assertEqual(challenges['2'], {'players': 4, 'status': 'completed'})
+
+    def test_challenge_page_payload(self):
+        """Does the challenge page payload hold attributes, stats, leaderboard
+        and graph for the challenge"""
+        result = self.client.get('/challenge-page.json?challenge_id=2')
+        page = json.loads(result.data)
+        self.assertEqual(page['challenge']['title'], 'Bring Down the Federation')
+        self.assertEqual(page['attributes'], ['cartoon', 'font', 'games', 'text'])
+        self.assertEqual(page['completion'], {'finished': 3, 'unfinished': 1})
+        self.assertEqual(sorted(winner['username'] for winner in page['leaderboard']), 
+                        ['Schmlandula', 'Schmlonathan', 'Schmlove'])
+        self.assertIn('nodes', page['analytics'])
+
+    def test_routes_within_query_budget(self):
+        """Do the challenge routes stay within their @query_budget"""
+        over_budget = []
+        real_warning = app.logger.warning
+        app.logger.warning = lambda *args: over_budget.append(args)
+        app.config['QUERY_BUDGET_DEBUG'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as s:
+                    s['active'] = True
+                    s['user_id'] = 6
+            for url in ['/challenges', '/challenge/1', '/challenge-page.json?challenge_id=2',
+                        '/challenges-status.json?challenge_ids=1,2', '/profile/Schmlonathan',
+                        '/matched_attributes.json?user_challenge_id=7', '/challenge_analytics.json']:
+                self.client.get(url)
+        finally:
+            app.logger.warning = real_warning
+            app.config['QUERY_BUDGET_DEBUG'] = False
+        self.assertEqual(over_budget, [], 'Routes went over their query budget.')
+
     def test_view_single_challenge(self):
         """Does the challenge details page show the correct results"""
         with self.client as c:
@@ -315,6 +684,722 @@ class NerveTestsDatabaseQueries(unittest.TestCase):
         self.assertIn('Find a Challenge', result.data, 'User not provided option to navigate back to challenge list')
 
 
+@unittest.skipUnless(IS_POSTGRES, 'challenge ids are allocated from a PostgreSQL sequence')
+class NerveTestsImport(DatabaseTestCase):
+    """Does the bulk importer insert each row once and resume where it stopped"""
+
+    def setUp(self):
+        super(NerveTestsImport, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.upload_folder = tempfile.mkdtemp()
+        for name, size, image_format in (('alpha.png', (40, 30), 'PNG'), ('beta.jpg', (30, 40), 'JPEG'),
+                                            ('gamma.png', (20, 20), 'PNG')):
+            with open(os.path.join(self.directory, name), 'wb') as image:
+                image.write(make_image(size, image_format))
+        with open(os.path.join(self.directory, 'manifest.csv'), 'wb') as manifest:
+            manifest.write('filename,title,description,difficulty\n'
+                            'alpha.png,imported alpha,First,2\n'
+                            'beta.jpg,imported beta,Second,\n'
+                            'gamma.png,imported gamma,Not a number,hard\n'
+                            'missing.png,imported missing,No such file,3\n'
+                            'notes.txt,imported notes,Not an image,1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.upload_folder)
+        super(NerveTestsImport, self).tearDown()
+
+    def run_import(self):
+        args = import_challenges.parse_args([self.directory, '--upload-folder', self.upload_folder])
+        return import_challenges.import_challenges(args, out=StringIO())
+
+    def imported(self):
+        return sorted(db.session.query(Challenge.title, Challenge.difficulty).filter(
+                        Challenge.title.like('Imported %')).all())
+
+    def test_import_and_resume(self):
+        stats = self.run_import()
+        self.assertEqual((stats.imported, stats.invalid, stats.unreadable, stats.resumed), (2, 2, 1, 0))
+        self.assertEqual(self.imported(), [('Imported Alpha', 2), ('Imported Beta', 1)])
+        image_path = db.session.query(Challenge.image_path).filter(Challenge.title=='Imported Alpha').scalar()
+        self.assertTrue(ImageStore(self.upload_folder, '/static/images').exists(image_path))
+
+        stats = self.run_import()
+        self.assertEqual((stats.imported, stats.resumed), (0, 5))
+        self.assertEqual(self.imported(), [('Imported Alpha', 2), ('Imported Beta', 1)],
+                        'Rows were imported again on resume.')
+
+    def test_storage_failures_are_unreadable(self):
+        class FullStore(ImageStore):
+            def put(self, content, image_format):
+                raise IOError('No space left on device')
+        store = FullStore(self.upload_folder, '/static/images')
+        analyses, keys, seconds = import_challenges.analyze_batch(self.directory, [{'filename': 'alpha.png'}], 5, store)
+        self.assertEqual((analyses, keys), ([import_challenges.UNREADABLE], [None]))
+
+    def test_vision_failures_are_retried(self):
+        """Images Vision couldn't analyze aren't recorded as done, so the
+        next run imports them"""
+        class DownBackend(vision.LocalVisionBackend):
+            def annotate(self, body):
+                raise IOError('503 Service Unavailable')
+        vision.set_backend(DownBackend())
+        try:
+            stats = self.run_import()
+        finally:
+            vision.set_backend(vision.LocalVisionBackend())
+        self.assertEqual((stats.imported, stats.failed, stats.unreadable, stats.invalid), (0, 2, 1, 2))
+        stats = self.run_import()
+        self.assertEqual((stats.imported, stats.failed, stats.resumed), (2, 0, 3))
+        self.assertEqual(self.imported(), [('Imported Alpha', 2), ('Imported Beta', 1)])
+
+    def test_parse_difficulty(self):
+        self.assertEqual(import_challenges.parse_difficulty(''), 1)
+        self.assertEqual(import_challenges.parse_difficulty('5'), 5)
+        self.assertEqual(import_challenges.parse_difficulty('6'), None)
+        self.assertEqual(import_challenges.parse_difficulty('hard'), None)
+
+
+class RecordingExecutor(object):
+    """Stands in for the AttemptQueue pool so tests run attempts themselves"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class NerveTestsAttempts(DatabaseTestCase):
+    """Is the attempts table a queue each attempt leaves exactly once"""
+
+    def setUp(self):
+        super(NerveTestsAttempts, self).setUp()
+        self.handled = []
+        self.queue = AttemptQueue(app, self.handle)
+        self.queue._executor = RecordingExecutor()
+        self.queue._last_recovery = datetime.datetime.now()
+
+    def handle(self, attempt):
+        self.handled.append(attempt.id)
+        return {'status': 'scored', 'points_earned': 12, 'hits': 'fauna,snail'}
+
+    def add_attempt(self, status, age=datetime.timedelta(0), user_id=1):
+        when = datetime.datetime.now() - age
+        attempt = Attempt(user_id=user_id, challenge_id=2, image_path='abc.jpg', status=status,
+                            created_timestamp=when, updated_timestamp=when)
+        db.session.add(attempt)
+        db.session.commit()
+        return attempt.id
+
+    def test_enqueue(self):
+        attempt = self.queue.enqueue(1, 2, 'abc.jpg')
+        self.assertEqual(db.session.query(Attempt.status).filter(Attempt.id==attempt.id).scalar(), 'queued')
+        self.assertEqual(self.queue._executor.submitted, [(attempt.id,)])
+
+    def test_enqueue_on_a_cold_queue(self):
+        """The first enqueue in a request starts the pool without removing
+        the request's session, so the attempt it returns is still usable"""
+        del self.session.remove # the real scoped_session.remove
+        queue = AttemptQueue(app, self.handle)
+        real_executor = attempts.ThreadPoolExecutor
+        attempts.ThreadPoolExecutor = lambda max_workers: RecordingExecutor()
+        try:
+            with app.test_request_context():
+                attempt = queue.enqueue(1, 2, 'abc.jpg')
+                self.assertEqual(queue._executor.submitted[-1], (attempt.id,))
+                self.assertEqual(attempt.status, 'queued')
+        finally:
+            attempts.ThreadPoolExecutor = real_executor
+
+    def test_claimed_once(self):
+        attempt_id = self.add_attempt('queued')
+        self.assertTrue(self.queue._claim(attempt_id))
+        self.assertFalse(self.queue._claim(attempt_id), 'An attempt was claimed twice.')
+        self.queue._run(attempt_id)
+        self.assertEqual(self.handled, [], 'A claimed attempt was processed again.')
+
+    def test_run_stores_the_result(self):
+        attempt_id = self.add_attempt('queued')
+        self.queue._run(attempt_id)
+        attempt = Attempt.query.get(attempt_id)
+        self.assertEqual((attempt.status, attempt.points_earned, attempt.hits), ('scored', 12, 'fauna,snail'))
+        self.assertEqual(self.handled, [attempt_id])
+
+    def test_failing_handler(self):
+        def broken(attempt):
+            raise ValueError('no')
+        self.queue.handler = broken
+        attempt_id = self.add_attempt('queued')
+        self.queue._run(attempt_id)
+        self.assertEqual(Attempt.query.get(attempt_id).status, 'failed')
+
+    def test_recover_stale_attempts(self):
+        """Only attempts processing for longer than stale_after go back in
+        the queue"""
+        stale = self.add_attempt('processing', age=datetime.timedelta(hours=1))
+        busy = self.add_attempt('processing')
+        queued = self.add_attempt('queued')
+        self.assertEqual(self.queue.recover(), [stale, queued])
+        self.assertEqual(Attempt.query.get(stale).status, 'queued')
+        self.assertEqual(Attempt.query.get(busy).status, 'processing')
+
+    def test_recover_if_due(self):
+        """Stuck attempts are picked up without a restart"""
+        stale = self.add_attempt('processing', age=datetime.timedelta(hours=1))
+        self.queue.recover_if_due()
+        self.assertEqual(self.queue._executor.submitted, [], 'Recovered before recover_every passed.')
+        self.queue._last_recovery -= self.queue.recover_every
+        self.queue.recover_if_due()
+        self.assertEqual(self.queue._executor.submitted, [(stale,)])
+
+    def test_attempt_status(self):
+        """Only the uploader sees an attempt's status"""
+        attempt_id = self.add_attempt('queued')
+        self.queue._run(attempt_id)
+        with self.client as c:
+            with c.session_transaction() as s:
+                s['active'] = True
+                s['user_id'] = 1
+        status = json.loads(self.client.get('/attempt-status.json?attempt_id={}'.format(attempt_id)).data)
+        self.assertEqual(status, {'attempt_id': attempt_id, 'challenge_id': 2, 'status': 'scored',
+                                    'finished': True, 'points_earned': 12, 'hits': ['fauna', 'snail']})
+        with self.client as c:
+            with c.session_transaction() as s:
+                s['user_id'] = 2
+        status = json.loads(self.client.get('/attempt-status.json?attempt_id={}'.format(attempt_id)).data)
+        self.assertEqual(status, {'status': 'unknown', 'finished': True})
+
+
+class NerveTestsCaching(unittest.TestCase):
+    """Do the in-process and on-disk caches behave"""
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        """Reading a key should protect it from the next eviction"""
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertNotIn('b', cache, 'Least recently used key was not evicted.')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_vision_cache_survives_restart(self):
+        """Entries written by one cache should be readable from the disk tier
+        by a fresh cache pointed at the same directory"""
+        directory = tempfile.mkdtemp()
+        try:
+            vision.VisionResultCache(directory).update('abc123', safe=True)
+            fresh = vision.VisionResultCache(directory)
+            self.assertEqual(fresh.get('abc123'), {'safe': True})
+            self.assertEqual(fresh.stats()['disk_hits'], 1)
+            self.assertEqual(fresh.get('not-cached'), None)
+            self.assertEqual(fresh.stats()['misses'], 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_local_vision_backend_is_deterministic(self):
+        """The offline backend should give the same answer for the same bytes
+        and the answer should go through the normal response parsing"""
+        directory = tempfile.mkdtemp()
+        real_cache = vision.result_cache
+        vision.result_cache = vision.VisionResultCache(directory)
+        try:
+            first = vision.analyze_content(b'not really a png', 5)
+            vision.result_cache = vision.VisionResultCache(directory, maxsize=0)
+            os.remove(os.path.join(directory, first.key[:2], first.key + '.json'))
+            second = vision.analyze_content(b'not really a png', 5)
+            self.assertTrue(first.safe)
+            self.assertEqual(len(first.tags), 5)
+            self.assertEqual(first, second)
+        finally:
+            vision.result_cache = real_cache
+            shutil.rmtree(directory)
+
+    def test_backends_do_not_share_cache_entries(self):
+        """Answers from the offline and stand-in backends are cached apart
+        from each other and from the key the Google backend reads"""
+        directory = tempfile.mkdtemp()
+        real_cache = vision.result_cache
+        vision.result_cache = vision.VisionResultCache(directory)
+        content = b'shared bytes'
+        try:
+            local = vision.analyze_content(content, 5)
+            self.assertIsNone(vision.result_cache.get(hashlib.sha256(content).hexdigest()),
+                                'An offline answer was cached where the Google backend reads.')
+            self.assertEqual(vision._cache_key(vision.GoogleVisionBackend(), content),
+                            hashlib.sha256(content).hexdigest())
+            keys = set([local.key,
+                        vision._cache_key(vision.LocalVisionBackend(directory), content),
+                        vision._cache_key(vision.HttpVisionBackend('http://127.0.0.1:5050/a'), content),
+                        vision._cache_key(vision.HttpVisionBackend('http://127.0.0.1:5051/a'), content)])
+            self.assertEqual(len(keys), 4)
+        finally:
+            vision.result_cache = real_cache
+            shutil.rmtree(directory)
+
+    def test_analyze_contents_batches(self):
+        """Are uncached images sent 16 to a request, in order"""
+        requests = []
+
+        class CountingBackend(vision.LocalVisionBackend):
+            def annotate(self, body):
+                requests.append(len(body['requests']))
+                return super(CountingBackend, self).annotate(body)
+
+        directory = tempfile.mkdtemp()
+        real_cache = vision.result_cache
+        vision.result_cache = vision.VisionResultCache(directory)
+        vision.set_backend(CountingBackend())
+        try:
+            contents = [b'image {}'.format(i) for i in range(20)]
+            vision.analyze_content(contents[3], 5)
+            analyses = vision.analyze_contents(contents, 5)
+            self.assertEqual(requests, [1, 16, 3])
+            self.assertEqual(analyses[7], vision.analyze_content(contents[7], 5))
+            self.assertEqual(requests, [1, 16, 3], 'A cached image was sent again.')
+        finally:
+            vision.result_cache = real_cache
+            vision.set_backend(vision.LocalVisionBackend())
+            shutil.rmtree(directory)
+
+    def test_bundled_discovery_document(self):
+        """Does the bundled discovery document describe images.annotate"""
+        with open(vision.VISION_DISCOVERY_DOCUMENT) as document:
+            discovery = json.load(document)
+        annotate = discovery['resources']['images']['methods']['annotate']
+        self.assertEqual(annotate['httpMethod'], 'POST')
+        self.assertEqual(discovery['rootUrl'] + annotate['path'], 'https://vision.googleapis.com/v1/images:annotate')
+
+
+    def test_safe_needs_both_likelihoods_unlikely(self):
+        """An image LIKELY to be adult or LIKELY to be violent is unsafe,
+        even when the other likelihood is VERY_UNLIKELY"""
+        def is_safe(adult, violence):
+            annotation = {'safeSearchAnnotation': {'adult': adult, 'violence': violence}}
+            return vision._parse_annotation(annotation, 5)['safe']
+
+        self.assertTrue(is_safe('VERY_UNLIKELY', 'UNLIKELY'))
+        self.assertFalse(is_safe('LIKELY', 'VERY_UNLIKELY'))
+        self.assertFalse(is_safe('VERY_UNLIKELY', 'VERY_LIKELY'))
+        self.assertFalse(is_safe('POSSIBLE', 'UNLIKELY'))
+
+
+class NerveTestsPreprocess(unittest.TestCase):
+    """Is every upload checked and shrunk before it goes to Vision"""
+
+    def test_sniff_image_type(self):
+        self.assertEqual(preprocess.sniff_image_type(make_image((4, 4), 'PNG')[:16]), 'png')
+        self.assertEqual(preprocess.sniff_image_type(make_image((4, 4), 'JPEG')[:16]), 'jpeg')
+        self.assertEqual(preprocess.sniff_image_type(b'GIF89a\x01\x00'), 'gif')
+        self.assertEqual(preprocess.sniff_image_type(b'RIFF\x00\x00\x00\x00WEBPVP8 '), 'webp')
+        self.assertIsNone(preprocess.sniff_image_type(b'<?php echo 1; ?>'))
+
+    def test_rejects_non_images(self):
+        self.assertRaises(preprocess.UploadRejected, preprocess.prepare_upload, b'just some text')
+        # Right magic bytes, nothing readable behind them
+        self.assertRaises(preprocess.UploadRejected, preprocess.prepare_upload, b'\x89PNG\r\n\x1a\n' + b'\x00' * 64)
+
+    def test_analysis_copy_is_a_small_jpeg(self):
+        content = make_image((3000, 1500), 'PNG')
+        upload = preprocess.prepare_upload(content)
+        self.assertEqual(upload.format, 'png')
+        self.assertFalse(upload.rotated)
+        self.assertIs(upload.content, content, 'An upright upload should be stored untouched.')
+        analysis = Image.open(io.BytesIO(upload.analysis_content))
+        self.assertEqual(analysis.format, 'JPEG')
+        self.assertEqual(analysis.size, (1024, 512))
+
+    def test_small_images_are_not_upscaled(self):
+        upload = preprocess.prepare_upload(make_image((300, 200), 'PNG'))
+        self.assertEqual(Image.open(io.BytesIO(upload.analysis_content)).size, (300, 200))
+
+    def test_exif_orientation_is_applied(self):
+        """Orientation 6 means the camera was turned, the stored image and the
+        analysis copy should both come out upright"""
+        upload = preprocess.prepare_upload(make_image((400, 200), 'JPEG', orientation=6))
+        self.assertTrue(upload.rotated)
+        stored = Image.open(io.BytesIO(upload.content))
+        self.assertEqual(stored.size, (200, 400))
+        self.assertEqual(stored.getexif().get(preprocess.EXIF_ORIENTATION, 1), 1)
+        self.assertEqual(Image.open(io.BytesIO(upload.analysis_content)).size, (200, 400))
+
+
+class NerveTestsStorage(unittest.TestCase):
+    """Are images stored once, by content, in sharded directories"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ImageStore(self.root, '/static/images')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_identical_uploads_are_stored_once(self):
+        content = make_image((10, 10), 'PNG')
+        key = self.store.put(content, 'png')
+        self.assertEqual(self.store.put(content, 'png'), key)
+        self.assertTrue(key.endswith('.png'))
+        self.assertEqual(self.store.path(key), os.path.join(self.root, key[:2], key[2:4], key))
+        with open(self.store.path(key), 'rb') as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertEqual(os.listdir(os.path.dirname(self.store.path(key))), [key],
+                        'Temporary files were left behind.')
+        self.assertNotEqual(self.store.put(make_image((10, 11), 'JPEG'), 'jpeg'), key)
+
+    def test_urls(self):
+        key = 'ab' * 32 + '.jpg'
+        self.assertEqual(self.store.url(key), '/static/images/ab/ab/' + key)
+        # image_path values from before the store
+        self.assertEqual(self.store.url('static/images/butter.png'), '/static/images/butter.png')
+        self.assertEqual(self.store.url('/static/images/butter.png'), '/static/images/butter.png')
+        self.assertEqual(server.image_url(None), None)
+
+    def test_delete(self):
+        key = self.store.put(make_image((10, 10), 'PNG'), 'png')
+        self.store.delete(key)
+        self.assertFalse(self.store.exists(key))
+        self.store.delete(key)
+
+
+class NerveTestsRenditions(unittest.TestCase):
+    """Are thumb, card and full renditions made once, at the right sizes"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ImageStore(self.root, '/static/images')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_generate(self):
+        key = self.store.put(make_image((2000, 1000), 'JPEG'), 'jpeg')
+        self.assertEqual(renditions.generate(self.store, key), 6)
+        self.assertEqual(renditions.generate(self.store, key), 0, 'Existing renditions were made again.')
+        card = Image.open(self.store.path(renditions.rendition_key(key, 'card', 'webp')))
+        self.assertEqual((card.format, card.size), ('WEBP', (640, 320)))
+        full = Image.open(self.store.path(renditions.rendition_key(key, 'full', 'jpg')))
+        self.assertEqual((full.format, full.size), ('JPEG', (1280, 640)))
+
+    def test_small_and_transparent_images(self):
+        """Renditions never upscale, and JPEG ones of transparent images
+        are flattened"""
+        output = io.BytesIO()
+        Image.new('RGBA', (200, 100), (0, 0, 0, 0)).save(output, 'PNG')
+        key = self.store.put(output.getvalue(), 'png')
+        renditions.generate(self.store, key)
+        thumb = Image.open(self.store.path(renditions.rendition_key(key, 'thumb', 'jpg')))
+        self.assertEqual((thumb.mode, thumb.size), ('RGB', (200, 100)))
+        self.assertEqual(thumb.getpixel((0, 0)), (255, 255, 255))
+
+    def test_ready_and_srcset(self):
+        pool = renditions.RenditionPool(app)
+        key = self.store.put(make_image((10, 10), 'PNG'), 'png')
+        self.assertFalse(pool.ready(self.store, key))
+        try:
+            pool.submit(self.store, key).result()
+        finally:
+            pool.shutdown()
+        self.assertTrue(pool.ready(self.store, key))
+        base = '/static/images/{}/{}/{}'.format(key[:2], key[2:4], key[:-4])
+        self.assertEqual(pool.srcset(self.store, key, 'webp'),
+                        '{0}.thumb.webp 320w, {0}.card.webp 640w, {0}.full.webp 1280w'.format(base))
+        renditions.delete(self.store, key)
+        pool.forget(self.store, key)
+        self.assertFalse(pool.ready(self.store, key))
+
+    def test_backfill(self):
+        done = self.store.put(make_image((10, 10), 'PNG'), 'png')
+        renditions.generate(self.store, done)
+        new = self.store.put(make_image((10, 20), 'PNG'), 'png')
+        self.assertEqual(renditions.backfill(self.store, [done, new, 'ab' * 32 + '.jpg'], workers=2), (1, 1, 1))
+
+    def test_backfill_carries_on_after_any_error(self):
+        broken = self.store.put(make_image((10, 10), 'PNG'), 'png')
+        fine = self.store.put(make_image((20, 10), 'PNG'), 'png')
+        real_generate = renditions.generate
+
+        def generate(store, key):
+            if key == broken:
+                raise Image.DecompressionBombError('Image size exceeds limit')
+            return real_generate(store, key)
+        renditions.generate = generate
+        try:
+            self.assertEqual(renditions.backfill(self.store, [broken, fine], workers=1), (1, 0, 1))
+        finally:
+            renditions.generate = real_generate
+
+    def test_templates_fall_back_to_the_original(self):
+        """Images without renditions are shown as they are"""
+        real_store = server.image_store
+        server.image_store = self.store
+        try:
+            key = self.store.put(make_image((10, 10), 'PNG'), 'png')
+            template = "{% from '_image.html' import responsive_image %}{{ responsive_image(key, '100vw') }}"
+            with app.test_request_context():
+                before = render_template_string(template, key=key)
+                renditions.generate(self.store, key)
+                after = render_template_string(template, key=key)
+        finally:
+            server.image_store = real_store
+        self.assertIn('<img src="{}">'.format(self.store.url(key)), before)
+        self.assertNotIn('<picture>', before)
+        self.assertIn('<source type="image/webp"', after)
+        self.assertIn(renditions.rendition_key(key, 'card', 'jpg'), after)
+
+
+class NerveTestsLeaderboard(unittest.TestCase):
+    """Does the in-process ranking order and page scores correctly"""
+
+    def test_ranked_scores(self):
+        """Highest points rank first, ties go to the lower id, and updating a
+        score moves the member"""
+        scores = RankedScores({1: 10, 2: 30, 3: 10})
+        self.assertEqual(scores.range(0, 3), [(2, 30), (1, 10), (3, 10)])
+        self.assertEqual(scores.rank(3), 3)
+        scores.set(3, 40)
+        self.assertEqual(scores.rank(3), 1)
+        self.assertEqual(scores.range(1, 2), [(2, 30), (1, 10)])
+        self.assertEqual(scores.rank(4), None)
+        self.assertEqual(len(scores), 3)
+
+
+class NerveTestsSeed(unittest.TestCase):
+    """Is the synthetic dataset reproducible and consistent"""
+
+    def test_same_seed_same_rows(self):
+        args = seed.parse_args(['--users', '50', '--challenges', '20', '--categories', '10',
+                                '--user-challenges', '200'])
+        difficulties = seed.challenge_difficulties(args)
+        category_ids = seed.challenge_category_ids(args)
+        rows = list(seed.user_challenge_rows(args, difficulties, category_ids))
+        self.assertEqual(rows, list(seed.user_challenge_rows(args, difficulties, category_ids)))
+        pairs = [(row[1], row[2]) for row, hits in rows]
+        self.assertEqual(len(pairs), len(set(pairs)), 'A user accepted the same challenge twice.')
+        for row, hits in rows:
+            self.assertTrue(set(hits).issubset(category_ids[row[2] - 1]))
+            self.assertEqual(bool(hits), row[3], 'Only completed challenges should have hits.')
+
+    def test_row_stream(self):
+        """Does COPY get every row however it sizes its reads"""
+        stream = seed.RowStream([(1, None, True), (2, 'b', False)])
+        data = ''.join(iter(lambda: stream.read(5), ''))
+        self.assertEqual(data, '1\t\\N\tt\n2\tb\tf\n')
+
+
+class NerveTestsBenchmark(unittest.TestCase):
+    """Are benchmark results summarized and compared correctly"""
+
+    def test_percentile(self):
+        ordered = range(1, 101)
+        self.assertEqual(benchmark.percentile(ordered, 50), 50)
+        self.assertEqual(benchmark.percentile(ordered, 99), 99)
+        self.assertEqual(benchmark.percentile([7], 95), 7)
+        self.assertEqual(benchmark.percentile([], 95), None)
+
+    def test_compare_flags_regressions(self):
+        stats = {'rps': 100, 'p50_ms': 5, 'p95_ms': 10, 'p99_ms': 20}
+        baseline = {'small': {'GET /challenges': stats, 'GET /challenge/<id>': stats}}
+        results = {'small': {'GET /challenges': dict(stats, p95_ms=11),
+                            'GET /challenge/<id>': dict(stats, p95_ms=15, rps=50)}}
+        regressions = benchmark.compare(results, baseline, 0.2)
+        self.assertEqual([(size, route) for size, route, what in regressions],
+                        [('small', 'GET /challenge/<id>'), ('small', 'GET /challenge/<id>')])
+
+
+    def test_failures_are_counted_not_fatal(self):
+        """A client whose requests fail keeps going and every failure is an
+        error for its route"""
+        recorder = benchmark.Recorder()
+        recorder.recording = True
+        dataset = seed.parse_args(['--users', '10', '--challenges', '5'])
+        # Nothing listens on port 1
+        client = benchmark.Client('http://127.0.0.1:1', recorder, random.Random(1), dataset)
+        client.run(time.time() + 0.2)
+        self.assertGreater(recorder.errors['POST /login'], 0)
+        self.assertGreater(sum(recorder.errors.values()), recorder.errors['POST /login'],
+                            'The client stopped after its first failure.')
+        summary = benchmark.summarize(recorder, 0.2)
+        self.assertEqual(summary['POST /login']['count'], 0)
+        self.assertEqual(summary['POST /login']['p95_ms'], None)
+
+    def test_scenario_exceptions_are_errors(self):
+        recorder = benchmark.Recorder()
+        recorder.recording = True
+        dataset = seed.parse_args(['--users', '10', '--challenges', '5'])
+        client = benchmark.Client('http://127.0.0.1:1', recorder, random.Random(1), dataset)
+        client.broken = lambda: 1 / 0
+        client.attempt('broken')
+        self.assertEqual(recorder.errors['scenario broken'], 1)
+
+
+class NerveTestsMetrics(unittest.TestCase):
+    """Are metrics recorded and exposed in the Prometheus text format"""
+
+    def test_histogram_render(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', ['route'], buckets=(0.1, 1))
+        histogram.observe(0.05, route='/a')
+        histogram.observe(0.1, route='/a')
+        histogram.observe(3, route='/a')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="/a",le="0.1"} 2',
+            'test_seconds_bucket{route="/a",le="1.0"} 2',
+            'test_seconds_bucket{route="/a",le="+Inf"} 3',
+            'test_seconds_sum{route="/a"} 3.15',
+            'test_seconds_count{route="/a"} 3'])
+
+    def test_label_escaping(self):
+        counter = metrics.Counter('test_total', 'Test', ['path'])
+        counter.inc(path='a"b\\c')
+        self.assertEqual(counter.render()[-1], 'test_total{path="a\\"b\\\\c"} 1')
+
+    def test_metrics_endpoint(self):
+        app.config['TESTING'] = True
+        client = app.test_client()
+        before = metrics.request_seconds.count(route='/metrics', method='GET', status=200)
+        client.get('/metrics')
+        result = client.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('# TYPE nerve_http_request_duration_seconds histogram', result.data)
+        self.assertIn('route="/metrics"', result.data)
+        self.assertEqual(metrics.request_seconds.count(route='/metrics', method='GET', status=200), before + 2)
+
+
+def hot_requests(client):
+    """The page views and background work whose queries have to stay on an
+    index, by name. Whole table loads (the global leaderboard and the
+    analytics graph) are expected to scan and are left out."""
+    get = client.get
+    return {
+        'challenge leaderboard': lambda: get('/leaderboard.json?challenge_id=1'),
+        'user challenge statuses': lambda: get('/challenges-status.json?challenge_ids=1,2'),
+        'challenge tags': lambda: get('/challenge_attributes.json?challenge_id=1'),
+        'matched tags': lambda: get('/matched_attributes.json?user_challenge_id=7'),
+        'challenges listing': lambda: get('/challenges.json?cursor=5_2'),
+        'profile history': lambda: get('/profile/Schmlonathan/challenges.json?cursor=2017-05-01T00:00:00.000000_9'),
+        'queued attempts': server.attempt_queue.recover,
+    }
+
+
+def plan_node_types(plan):
+    """Every node type in an EXPLAIN (FORMAT JSON) plan tree"""
+    types = [plan['Node Type']]
+    for child in plan.get('Plans', []):
+        types.extend(plan_node_types(child))
+    return types
+
+
+@unittest.skipUnless(IS_POSTGRES, 'query plans are checked on PostgreSQL')
+class NerveTestsQueryPlans(DatabaseTestCase):
+    """Do the hot queries have an index to use. Sequential scans are priced
+    out of the planner, so any that remain mean there was no other way."""
+
+    def explain(self, statement, parameters):
+        """Plan of a statement as the engine sent it to the database"""
+        connection = db.session.connection()
+        connection.execute('SET LOCAL enable_seqscan = off')
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def test_hot_queries_use_indexes(self):
+        """EXPLAIN every SELECT the hot requests actually run"""
+        with self.client.session_transaction() as s:
+            s['active'] = True
+            s['user_id'] = 6
+        for name, run in sorted(hot_requests(self.client).items()):
+            with recorded_statements() as statements:
+                run()
+            selects = [(statement, parameters) for statement, parameters in statements
+                        if statement.lstrip().upper().startswith('SELECT')]
+            self.assertTrue(selects, '{} ran no queries'.format(name))
+            for statement, parameters in selects:
+                node_types = plan_node_types(self.explain(statement, parameters))
+                self.assertNotIn('Seq Scan', node_types, 
+                                '{} fell back to a sequential scan: {}\n{}'.format(name, node_types, statement))
+
+    def test_migrations_up_to_date(self):
+        """Is a database built by create_all at the latest version"""
+        self.assertEqual(migrations.current_version(), migrations.LATEST_VERSION)
+        self.assertEqual(migrations.migrate(), [])
+
+
+# Undoes migrations 2-6 on a schema built by create_all
+VERSION_1_SCHEMA = [
+    'DROP TABLE attempts',
+    'DROP INDEX challenges_listing_idx',
+    'DROP INDEX user_challenges_history_idx',
+    'DROP INDEX user_challenges_leaderboard_idx',
+    'DROP INDEX challenge_categories_category_idx',
+    'DROP INDEX challenges_title_idx',
+    'ALTER TABLE challenges DROP COLUMN num_accepted',
+    'ALTER TABLE challenges DROP COLUMN num_completed',
+    'ALTER TABLE challenges DROP COLUMN num_attempts',
+    'ALTER TABLE challenges ALTER COLUMN image_path TYPE VARCHAR(50)',
+    'ALTER TABLE user_challenges ALTER COLUMN image_path TYPE VARCHAR(50)',
+]
+
+
+@unittest.skipUnless(IS_POSTGRES, 'migrations are written for PostgreSQL')
+class NerveTestsMigrations(unittest.TestCase):
+    """Does migrate() take a version 1 database to the schema create_all
+    builds. Runs in its own database since migrations commit."""
+
+    def setUp(self):
+        url = make_url(TEST_DATABASE_URI)
+        url.database = '{}_migrations'.format(url.database)
+        os.system('dropdb --if-exists {0} && createdb {0}'.format(url.database))
+        self.engine = create_engine(url)
+        db.metadata.create_all(bind=self.engine)
+        with self.engine.begin() as connection:
+            for statement in VERSION_1_SCHEMA:
+                connection.execute(statement)
+
+    def tearDown(self):
+        database = self.engine.url.database
+        self.engine.dispose()
+        os.system('dropdb {}'.format(database))
+
+    def schema(self, engine):
+        """{table: (column names, index names, image_path length)}"""
+        inspector = inspect(engine)
+        schema = {}
+        for table in db.metadata.tables:
+            columns = {column['name']: column['type'] for column in inspector.get_columns(table)}
+            schema[table] = (sorted(columns), sorted(index['name'] for index in inspector.get_indexes(table)),
+                            getattr(columns.get('image_path'), 'length', None))
+        return schema
+
+    def test_migrate_from_version_1(self):
+        migrations.stamp(1, engine=self.engine)
+        self.assertEqual(migrations.current_version(self.engine), 1)
+        self.assertEqual(migrations.migrate(engine=self.engine), range(2, migrations.LATEST_VERSION + 1))
+        self.assertEqual(migrations.current_version(self.engine), migrations.LATEST_VERSION)
+        self.assertEqual(self.schema(self.engine), self.schema(db.engine))
+        self.assertEqual(migrations.migrate(engine=self.engine), [])
+
+    def test_create_migrates_existing_tables(self):
+        """`python model.py` on a version 1 database migrates it instead of
+        stamping it as up to date"""
+        model.run_command('create', self.engine)
+        self.assertEqual(migrations.current_version(self.engine), migrations.LATEST_VERSION)
+        self.assertEqual(self.schema(self.engine), self.schema(db.engine))
+
+
 class NerveTestsPageData(unittest.TestCase):
     """Determine if the correct page is showing in the specified route"""
 
@@ -339,8 +1424,6 @@ class NerveTestsPageData(unittest.TestCase):
 
 if __name__ == "__main__":
 
-    os.system('dropdb test_nerve')
-    os.system('createdb test_nerve')
     unittest.main()
 
 
@@ -3,43 +3,448 @@ This script uses the Google Cloud Vision API's label detection capabilities to
 find a label or logo based on an image's content. It can also be used to 
 determine if an image contains adult or violent content.
 
+analyze_image sends SAFE_SEARCH_DETECTION and WEB_DETECTION in a single
+annotate request through a pluggable backend: the Google client, a
+deterministic offline backend, or any HTTP server speaking the same wire
+format (see get_backend and vision_standin.py). Results are cached by a hash
+of the image content (in memory and on disk) so the same bytes are only ever
+sent to the API once. Other backends' answers are cached under keys of their
+own so they are never served in place of the API's.
 """
 
 import argparse
 import base64
-import googleapiclient.discovery
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from cache import LRUCache
+from metrics import record_vision_call
+
+# Results are cached by the sha256 of the image bytes so re-submissions of the
+# same picture never go back to the (paid) API.
+VISION_CACHE_DIR = os.environ.get('NERVE_VISION_CACHE_DIR', '.vision_cache')
+VISION_CACHE_SIZE = int(os.environ.get('NERVE_VISION_CACHE_SIZE', 1024))
+# Most images the API accepts in one annotate request
+VISION_BATCH_SIZE = 16
+
+
+class VisionResultCache(object):
+    """Two tier cache of Vision results keyed by image content hash.
+    The first tier is a bounded in-memory LRU, the second is one JSON file per
+    image under VISION_CACHE_DIR so results survive restarts and are shared by
+    every worker on the machine.
+
+    Entries are dicts that may contain:
+        'safe'     - the safe search verdict (bool)
+        'tags'     - webEntities descriptions in the order the API ranked them
+        'max_tags' - the maxResults the tags were requested with
+    """
+
+    def __init__(self, directory, maxsize=1024):
+        self.directory = directory
+        self.memory = LRUCache(maxsize)
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        """Returns the cached entry for key or None"""
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+        try:
+            with open(self._path(key)) as cached:
+                entry = json.load(cached)
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self.memory.put(key, entry)
+        return entry
+
+    def update(self, key, **fields):
+        """Merges fields into the entry for key in both tiers"""
+        entry = dict(self.memory.get(key) or self._read_disk(key) or {})
+        entry.update(fields)
+        self.memory.put(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key)) as cached:
+                return json.load(cached)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, entry):
+        """Writes the entry atomically; a failure only costs us the disk tier"""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as cached:
+                json.dump(entry, cached)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
+
+    def stats(self):
+        """Returns hit/miss counters for both tiers"""
+        memory = self.memory.stats()
+        with self._lock:
+            return {'memory_hits': memory['hits'],
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'memory_size': memory['size'],
+                    'memory_maxsize': memory['maxsize']}
+
+
+result_cache = VisionResultCache(VISION_CACHE_DIR, VISION_CACHE_SIZE)
+
+
+def cache_stats():
+    """Hit/miss counters for the Vision result cache"""
+    return result_cache.stats()
+
+
+# safe  - False for images LIKELY or VERY_LIKELY to be adult or violent
+# tags  - webEntities descriptions, best match first
+# key   - the cache key, sha256 of the image bytes for the Google backend
+ImageAnalysis = namedtuple('ImageAnalysis', ['safe', 'tags', 'key'])
+
+SAFE_LIKELIHOODS = ('UNLIKELY', 'VERY_UNLIKELY')
+
+# Bundled so building the service never fetches the discovery document
+VISION_DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vision_discovery.json')
+VISION_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
+VISION_TIMEOUT = int(os.environ.get('NERVE_VISION_TIMEOUT', 30))
+
+_service = None
+_credentials = None
+_service_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_service():
+    """Returns the Vision service object, built once per process from the
+    bundled discovery document. Requests made with it must pass
+    http=get_http() since the service's own transport is not thread safe."""
+    global _service
+    if _service is None:
+        # Imported here so the offline backends work without the client library
+        import googleapiclient.discovery
+        import httplib2
+        with _service_lock:
+            if _service is None:
+                with open(VISION_DISCOVERY_DOCUMENT) as document:
+                    _service = googleapiclient.discovery.build_from_document(document.read(),
+                                                                            http=httplib2.Http())
+    return _service
+
+
+def get_http():
+    """Authorized transport for the current thread. httplib2.Http objects
+    can't be shared between threads, each thread keeps its own connection
+    to the API alive between calls."""
+    global _credentials
+    http = getattr(_local, 'http', None)
+    if http is None:
+        import google.auth
+        import google_auth_httplib2
+        import httplib2
+        with _service_lock:
+            if _credentials is None:
+                _credentials, project = google.auth.default(scopes=[VISION_SCOPE])
+        http = _local.http = google_auth_httplib2.AuthorizedHttp(_credentials,
+                                                                http=httplib2.Http(timeout=VISION_TIMEOUT))
+    return http
+
+
+################################################################################
+# Backends. Every backend takes the body of an images:annotate request and
+# returns the decoded response, so they are interchangeable for analyze_image.
+
+class GoogleVisionBackend(object):
+    """Sends annotate requests to the Cloud Vision API"""
+
+    # Cached under the plain image hash (see _cache_key)
+    cache_namespace = None
+
+    def annotate(self, body):
+        return get_service().images().annotate(body=body).execute(http=get_http())
+
+
+class LocalVisionBackend(object):
+    """Deterministic offline backend for tests and benchmarks.
+    If sidecar_dir holds <sha256 of the image>.json, e.g.
+        {"tags": ["snail", "slug"], "adult": "VERY_UNLIKELY", "violence": "UNLIKELY"}
+    that is returned, otherwise tags are picked from LOCAL_VOCABULARY using the
+    image hash so the same bytes always produce the same answer.
+    """
+
+    def __init__(self, sidecar_dir=None):
+        self.sidecar_dir = sidecar_dir
+
+    @property
+    def cache_namespace(self):
+        return '{} {}'.format(type(self).__name__, self.sidecar_dir or '')
+
+    def _sidecar(self, key):
+        if not self.sidecar_dir:
+            return {}
+        try:
+            with open(os.path.join(self.sidecar_dir, key + '.json')) as sidecar:
+                return json.load(sidecar)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def annotate_content(self, content, max_tags):
+        """Builds a single annotate response for raw image bytes"""
+        key = hashlib.sha256(content).hexdigest()
+        sidecar = self._sidecar(key)
+        if 'tags' in sidecar:
+            tags = sidecar['tags'][:max_tags]
+        else:
+            tags = []
+            seed = key
+            while len(tags) < min(max_tags, len(LOCAL_VOCABULARY)):
+                for i in range(0, len(seed) - 4, 4):
+                    tag = LOCAL_VOCABULARY[int(seed[i:i + 4], 16) % len(LOCAL_VOCABULARY)]
+                    if tag not in tags and len(tags) < max_tags:
+                        tags.append(tag)
+                seed = hashlib.sha256(seed).hexdigest()
+        return {
+            'safeSearchAnnotation': {
+                'adult': sidecar.get('adult', 'VERY_UNLIKELY'),
+                'violence': sidecar.get('violence', 'VERY_UNLIKELY'),
+            },
+            'webDetection': {
+                'webEntities': [{'description': tag, 'score': 1.0 - i * 0.05}
+                                for i, tag in enumerate(tags)]
+            }
+        }
+
+    def annotate(self, body):
+        responses = []
+        for image_request in body['requests']:
+            content = base64.b64decode(image_request['image']['content'])
+            max_tags = 10
+            for feature in image_request.get('features', []):
+                if feature['type'] == 'WEB_DETECTION':
+                    max_tags = feature.get('maxResults', max_tags)
+            responses.append(self.annotate_content(content, max_tags))
+        return {'responses': responses}
+
+
+class HttpVisionBackend(object):
+    """Posts annotate requests to a server speaking the images:annotate wire
+    format, such as the local stand-in in vision_standin.py"""
+
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def cache_namespace(self):
+        return '{} {}'.format(type(self).__name__, self.url)
+
+    def annotate(self, body):
+        # One keep-alive session per thread
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        response = session.post(self.url, json=body, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+# Small on purpose so locally analyzed images share tags with each other
+LOCAL_VOCABULARY = ['animal', 'architecture', 'art', 'beach', 'bicycle', 'bird',
+                    'bridge', 'building', 'car', 'cartoon', 'cat', 'city',
+                    'cloud', 'dog', 'drink', 'flower', 'food', 'font', 'fruit',
+                    'games', 'grass', 'illustration', 'insect', 'lake',
+                    'machine', 'mountain', 'music', 'night', 'ocean', 'park',
+                    'people', 'plant', 'river', 'road', 'sculpture', 'sky',
+                    'snow', 'sport', 'street', 'sunset', 'text', 'toy', 'train',
+                    'tree', 'water']
+
+_backend = None
+
+
+def make_backend(name, url=None, sidecar_dir=None):
+    """Builds a backend by name: 'google', 'local' or 'http'"""
+    if name == 'google':
+        return GoogleVisionBackend()
+    elif name == 'local':
+        return LocalVisionBackend(sidecar_dir)
+    elif name == 'http':
+        return HttpVisionBackend(url or 'http://127.0.0.1:5050/v1/images:annotate')
+    raise ValueError('Unknown vision backend: {}'.format(name))
+
+
+def get_backend():
+    """Returns the backend for this process. Chosen with NERVE_VISION_BACKEND
+    (google by default), NERVE_VISION_URL and NERVE_VISION_SIDECAR_DIR."""
+    global _backend
+    if _backend is None:
+        _backend = make_backend(os.environ.get('NERVE_VISION_BACKEND', 'google'),
+                                url=os.environ.get('NERVE_VISION_URL'),
+                                sidecar_dir=os.environ.get('NERVE_VISION_SIDECAR_DIR'))
+    return _backend
+
+
+def set_backend(backend):
+    """Replaces the backend for this process (tests, benchmarks)"""
+    global _backend
+    _backend = backend
+
+################################################################################
+
+
+def _parse_annotation(annotation, max_tags):
+    """Turns a single entry of the annotate 'responses' list into the values
+    stored in the cache"""
+    safe_search = annotation['safeSearchAnnotation']
+    # Safe only when adult AND violence are both unlikely, as image_is_safe
+    # documents. The original check used `or`, which let an image that was
+    # LIKELY adult through as long as it wasn't violent (and vice versa).
+    is_safe = (safe_search['adult'] in SAFE_LIKELIHOODS and
+               safe_search['violence'] in SAFE_LIKELIHOODS)
+    tags = []
+    for entity in annotation.get('webDetection', {}).get('webEntities', []):
+        # Entities without a description are just knowledge graph ids
+        if entity.get('description') and entity['description'] not in tags:
+            tags.append(entity['description'])
+    return {'safe': is_safe, 'tags': tags, 'max_tags': max_tags}
+
+
+def _covers(entry, max_tags):
+    """Can a cached entry answer a request for max_tags tags"""
+    return (entry is not None and 'safe' in entry and 'tags' in entry and
+            (entry['max_tags'] >= max_tags or len(entry['tags']) < entry['max_tags']))
+
+
+def _cache_key(backend, content):
+    """sha256 of the image bytes for the Google backend. Made up answers
+    from any other backend get a key mixed with its cache_namespace (class and
+    endpoint) so they never land where production reads."""
+    key = hashlib.sha256(content).hexdigest()
+    namespace = getattr(backend, 'cache_namespace', type(backend).__name__)
+    if namespace is None:
+        return key
+    return hashlib.sha256('{}\n{}'.format(namespace, key)).hexdigest()
+
+
+def _image_request(encoded, max_tags):
+    return {
+        'image': {
+            'content': encoded
+        },
+        'features': [{
+            'type': 'SAFE_SEARCH_DETECTION'
+        }, {
+            'type': 'WEB_DETECTION',
+            'maxResults': max_tags
+        }]
+    }
+
+
+def analyze_contents(contents, max_tags=10):
+    """Runs safe search and web detection on a list of raw images, sending
+    the ones not in the cache in annotate requests of up to VISION_BATCH_SIZE
+    images. Returns a list of ImageAnalysis in the same order, with None for
+    images the API could not analyze."""
+
+    backend = get_backend()
+    keys = [_cache_key(backend, content) for content in contents]
+    entries = [result_cache.get(key) for key in keys]
+    missing = [i for i, entry in enumerate(entries) if not _covers(entry, max_tags)]
+    for batch_start in range(0, len(missing), VISION_BATCH_SIZE):
+        batch = missing[batch_start:batch_start + VISION_BATCH_SIZE]
+        encoded = [base64.b64encode(contents[i]).decode('UTF-8') for i in batch]
+        body = {'requests': [_image_request(image, max_tags) for image in encoded]}
+        request_bytes = sum(len(image) for image in encoded)
+        start = time.time()
+        try:
+            response = backend.annotate(body)
+        except Exception:
+            record_vision_call(type(backend).__name__, time.time() - start, request_bytes)
+            continue
+        record_vision_call(type(backend).__name__, time.time() - start, request_bytes, len(json.dumps(response)))
+        for i, annotation in zip(batch, response.get('responses', [])):
+            try:
+                entries[i] = result_cache.update(keys[i], **_parse_annotation(annotation, max_tags))
+            except Exception:
+                pass # an error for this image only, e.g. unreadable bytes
+
+    return [ImageAnalysis(safe=entry['safe'], tags=entry['tags'][:max_tags], key=key)
+            if _covers(entry, max_tags) else None
+            for key, entry in zip(keys, entries)]
+
+
+def analyze_content(content, max_tags=10):
+    """Runs safe search and web detection on raw image bytes in one request.
+    Returns an ImageAnalysis, or None if the API call failed."""
+    return analyze_contents([content], max_tags)[0]
+
+
+def analyze_image(image, max_tags=10):
+    """Runs safe search and web detection on an image in one request.
+       image is a filename or an open file-like object.
+
+    >>> analyze_image('static/images/snails.jpg', 5)
+    ImageAnalysis(safe=True, tags=[u'snails and slugs', u'snail', u'invertebrate', u'fauna', u'insect'], key='...')
+    """
+
+    if hasattr(image, 'read'):
+        content = image.read()
+    else:
+        with open(image, 'rb') as image_file:
+            content = image_file.read()
+    return analyze_content(content, max_tags)
+
+
+def analyze_images(images, max_tags=10):
+    """analyze_image for a list of filenames, batched (see analyze_contents)"""
+    contents = []
+    for image in images:
+        with open(image, 'rb') as image_file:
+            contents.append(image_file.read())
+    return analyze_contents(contents, max_tags)
+
 
 def get_tags_for_image(photo_file, maxResults=10):
     """Run a label request on a single image
-       Takes an image and a result limit. Returns list of descriptors.
+       Takes an image and a result limit. Returns set of descriptors.
        If API call returns no descriptors, return False.
 
     >>> get_tags_for_image('static/images/snails.jpg', 10)
-    [u'snails and slugs', u'snail', u'invertebrate', u'fauna', u'insect', u'macro photography', u'molluscs', u'slug']
+    set([u'snails and slugs', u'snail', u'invertebrate', u'fauna', u'insect', u'macro photography', u'molluscs', u'slug'])
     """
 
-    service = googleapiclient.discovery.build('vision', 'v1')
-
     try:
-        with open(photo_file, 'rb') as image:
-            image_content = base64.b64encode(image.read())
-            service_request = service.images().annotate(body={
-                'requests': [{
-                    'image': {
-                        'content': image_content.decode('UTF-8')
-                    },
-                    'features': [{
-                        'type': 'WEB_DETECTION',
-                        'maxResults': maxResults
-                    }]
-                }]
-            })
-            response = service_request.execute()
-
-            tags = {tag['description'] for tag in response['responses'][0]['webDetection']['webEntities']}
-            return tags
-    except:
+        analysis = analyze_image(photo_file, maxResults)
+    except (IOError, OSError):
         return False
+    if not analysis or not analysis.tags:
+        return False
+    return set(analysis.tags)
 
 
 # def get_logo_for_image(photo_file):
@@ -84,35 +489,5 @@ def image_is_safe(photo_file):
        True
        """
 
-    # [START authenticate]
-    service = googleapiclient.discovery.build('vision', 'v1')
-    # [END authenticate]
-
-    # [START construct_request]
-    with open(photo_file, 'rb') as image:
-        image_content = base64.b64encode(image.read())
-        service_request = service.images().annotate(body={
-            'requests': [{
-                'image': {
-                    'content': image_content.decode('UTF-8')
-                },
-                'features': [{
-                    'type': 'SAFE_SEARCH_DETECTION',
-                }]
-            }]
-        })
-        # [END construct_request]
-        # [START parse_response]
-        response = service_request.execute()
-        adult = response['responses'][0]['safeSearchAnnotation']['adult']
-        violent = response['responses'][0]['safeSearchAnnotation']['violence']
-        # [END parse_response]
-        return adult in ['UNLIKELY', 'VERY_UNLIKELY'] or violence in ['UNLIKELY', 'VERY_UNLIKELY']
-
-
-
-
-
-
-
-
+    analysis = analyze_image(photo_file)
+    return bool(analysis and analysis.safe)
@@ -0,0 +1,57 @@
+"""Local stand-in for the Cloud Vision images:annotate endpoint
+
+Answers POST /v1/images:annotate with the same wire format as the real API,
+using vision.LocalVisionBackend for the results, after an injected delay. Point
+the app at it to benchmark /create and /complete/<id> under realistic Vision
+latency without leaving the machine:
+
+    python vision_standin.py --port 5050 --latency 400 --jitter 150
+    NERVE_VISION_BACKEND=http NERVE_VISION_URL=http://127.0.0.1:5050/v1/images:annotate python server.py
+"""
+
+import argparse
+import random
+import time
+from flask import Flask, jsonify, request
+from vision import LocalVisionBackend
+
+app = Flask(__name__)
+
+app.config['LATENCY_MS'] = 0
+app.config['JITTER_MS'] = 0
+backend = LocalVisionBackend()
+
+
+def injected_delay():
+    """Seconds to sleep before answering: latency +/- a uniform jitter"""
+    latency = app.config['LATENCY_MS'] + random.uniform(-app.config['JITTER_MS'],
+                                                        app.config['JITTER_MS'])
+    return max(latency, 0) / 1000.0
+
+
+@app.route('/v1/images:annotate', methods=['POST'])
+def annotate():
+    """Mimics https://vision.googleapis.com/v1/images:annotate"""
+    body = request.get_json(force=True)
+    time.sleep(injected_delay())
+    return jsonify(backend.annotate(body))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='mean injected latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='uniform jitter around the latency in milliseconds')
+    parser.add_argument('--sidecar-dir',
+                        help='directory of <sha256>.json files overriding results')
+    args = parser.parse_args()
+
+    app.config['LATENCY_MS'] = args.latency
+    app.config['JITTER_MS'] = args.jitter
+    backend.sidecar_dir = args.sidecar_dir
+
+    app.run(host=args.host, port=args.port, threaded=True)